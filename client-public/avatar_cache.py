@@ -0,0 +1,155 @@
+import os
+import hashlib
+from collections import OrderedDict
+import numpy as np
+import pygame
+import images
+from logger import logger
+
+AVATAR_DIR = "avatars"  # Pictures kept between runs, named by their hash
+MAX_STORED = 1000  # Most pictures kept on disk, the oldest are deleted
+
+
+class AvatarCache:
+    """
+    Profile pictures decoded once, keyed by a hash of the bytes they arrived
+    as, so the same picture arriving again (after a reconnect, an upload of
+    the same file, lots of users with the same picture) is never decoded
+    twice. Scaled copies for every size they're drawn at are kept too, the
+    least recently used ones are dropped once there are too many.
+
+    Pictures the server names are also kept on disk, so the server never has
+    to send them again, not even after a restart.
+    """
+
+    def __init__(self, max_pictures=128, max_scaled=512, directory=AVATAR_DIR, max_stored=MAX_STORED):
+        self.directory = directory
+        self.max_stored = max_stored
+        self.max_pictures = max_pictures
+        self.max_scaled = max_scaled
+        self.pictures = OrderedDict()  # key -> full size surface
+        self.scaled_pictures = OrderedDict()  # (key, size, alpha) -> surface
+
+        # Stats
+        self.decoded = 0
+        self.hits = 0
+
+    def add(self, data, details):
+        """
+        Decode a picture received from the server, unless it's already here.
+        details is the image message that came before the data. Returns the
+        picture's key.
+        """
+        # Servers that name their pictures hash what's in them, the name
+        # stays the same however the picture was sent
+        key = details.get("hash") or hashlib.blake2b(data, digest_size=16).hexdigest()
+        if key in self.pictures:
+            self.pictures.move_to_end(key)
+            self.hits += 1
+            return key
+
+        shape, dtype = details["shape"], details["dtype"]
+        # Compressed pictures say how they were compressed
+        if details.get("encoding"):
+            data = images.decompress(details, data, shape, dtype)
+        image = np.frombuffer(data, dtype=dtype).reshape(*shape)
+        if details.get("hash"):
+            self.store(key, image)
+
+        self.remember(key, pygame.surfarray.make_surface(image))
+        self.decoded += 1
+        return key
+
+    def remember(self, key, picture):
+        self.pictures[key] = picture
+        while len(self.pictures) > self.max_pictures:
+            self.pictures.popitem(last=False)
+
+    def load(self, key):
+        """
+        Key of a picture the server says we already have, from memory or
+        disk. None if it's gone, then it has to be asked for again.
+        """
+        if key in self.pictures:
+            self.pictures.move_to_end(key)
+            self.hits += 1
+            return key
+        if not key.isalnum():  # Names are hashes, never paths
+            return None
+
+        try:
+            with np.load(self.path(key)) as stored:
+                image = stored["image"]
+            os.utime(self.path(key))  # Recently used, deleted last
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Could not load cached picture {key}: {e}")
+            return None
+
+        self.remember(key, pygame.surfarray.make_surface(image))
+        self.hits += 1
+        return key
+
+    def get(self, key):
+        """The full size picture, or None if it has been dropped."""
+        picture = self.pictures.get(key)
+        if picture is None:
+            # Dropped from memory, but maybe still on disk
+            if os.path.exists(self.path(key)):
+                return self.pictures.get(self.load(key))
+            return None
+        self.pictures.move_to_end(key)
+        return picture
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.npz")
+
+    def store(self, key, image):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            np.savez_compressed(self.path(key), image=image)
+        except OSError as e:
+            logger.warning(f"Could not keep picture {key}: {e}")
+
+    def stored(self):
+        """
+        Hashes of the pictures kept on disk, to tell the server about. Only
+        the most recently used max_stored are kept, the rest are deleted.
+        """
+        try:
+            names = [name for name in os.listdir(self.directory) if name.endswith(".npz")]
+        except OSError:
+            return []
+
+        paths = sorted((os.path.join(self.directory, name) for name in names),
+                       key=os.path.getmtime, reverse=True)
+        for path in paths[self.max_stored:]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        return [os.path.basename(path)[:-len(".npz")] for path in paths[:self.max_stored]]
+
+    def scaled(self, key, size, alpha=None):
+        """The picture scaled to size, with alpha transparency if given."""
+        size = (int(size[0]), int(size[1]))
+        scaled_key = (key, size, alpha)
+        picture = self.scaled_pictures.get(scaled_key)
+        if picture is not None:
+            self.scaled_pictures.move_to_end(scaled_key)
+            return picture
+
+        full = self.get(key)
+        if full is None:
+            return None
+        picture = pygame.transform.scale(full, size)
+        if alpha is not None:
+            picture.set_alpha(alpha)
+
+        self.scaled_pictures[scaled_key] = picture
+        while len(self.scaled_pictures) > self.max_scaled:
+            self.scaled_pictures.popitem(last=False)
+        return picture
+
+
+# Shared by everything that draws profile pictures
+avatars = AvatarCache()
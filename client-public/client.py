@@ -1,11 +1,12 @@
 import pygame
 from pygame import mixer
-import numpy as np
 from network import Network
 from constants import *
 from utilities import *
 from _thread import start_new_thread
 from logger import logger
+import images
+from avatar_cache import avatars
 
 # Initialize the display window
 WINDOW = pygame.display.set_mode((WIDTH, HEIGHT))
@@ -19,6 +20,19 @@ WINDOW_RIGHT = pygame.Surface((RIGHT_WIDTH, HEIGHT))
 clock = pygame.time.Clock()
 fps = 30
 run = True  # Flag to control the main loop
+requested_avatars = set()  # Hashes of the pictures asked for but not here yet
+
+# Servers with a directory send the lobby a page at a time and number every
+# change to it, the version is None with older servers or while starting over
+directory_version = None
+directory_next = None  # Where the next page starts
+directory_more = False  # Whether there are users after it
+directory_requested = False  # Whether a page is on its way
+directory_resync = False  # Whether to ask for the first page again
+# Servers that let us watch only the users we show skip the versions of
+# changes to everyone else, and send a summary of the lobby instead
+directory_watching = False
+watched_users = set()  # The users we last said we show
 
 
 # Function to render text on the screen
@@ -115,8 +129,20 @@ def recieve_active_users():
 
     try:
         active_users = n.recv()
+        # Changes from before our first page are already in it, and anything
+        # else that came first is from after it. The lobby lists us
+        while isinstance(active_users, dict) and not (
+                "directory" in active_users or curr_user_id in active_users):
+            active_users = n.recv()
         if not active_users:
             raise Exception("SERVER CRASHED UNEXPECTEDLY")
+
+        if "directory" in active_users:
+            global directory_version, directory_next, directory_more, directory_watching
+            page = active_users["directory"]
+            directory_version, directory_next = page["version"], page["next"]
+            directory_more, directory_watching = page["more"], page.get("watching", False)
+            return {user["id"]: user for user in page["users"]}
         return active_users
 
     except Exception as e:
@@ -263,7 +289,7 @@ def send_image(img):
     size = len(image_bytes)
 
     # Send the size and metadata of the image to the server
-    send({"image": {"size": size, "shape": img.shape, "dtype": img.dtype}})
+    send({"image": {"size": size, "shape": img.shape, "dtype": str(img.dtype)}})
 
     allowed = n.recv()
     # Check if the image was accepted by the server
@@ -275,6 +301,11 @@ def send_image(img):
         n.send(image_bytes, pickle_data=False, fn=upload_screen)
         logger.debug("Done sending image")
 
+        # Keep it, the server only tells us its name
+        avatars.add(image_bytes, {
+            "shape": img.shape, "dtype": str(img.dtype),
+            "hash": images.content_hash(image_bytes, img.shape, img.dtype)})
+
     return image_bytes, img.dtype, img.shape
 
 
@@ -294,6 +325,114 @@ def on_image_change(path, *args, **kwargs):
             Sound_Effects.error.play()
 
 
+# Whether a numbered change to the directory is the next one, starts over if
+# one was missed
+def next_version(version):
+    global directory_version
+    if directory_version is None or version <= directory_version:
+        return False  # Already in the pages we have, or on its way in one
+    if version != directory_version + 1 and not directory_watching:
+        resync_directory()
+        return False
+
+    directory_version = version
+    return True
+
+
+# Start the directory over with its first page, which replaces everyone we
+# know. Called while receiving, the main loop asks for the page so only it sends
+def resync_directory():
+    global directory_version, directory_requested, directory_resync
+    logger.warning(f"MISSED A CHANGE TO THE DIRECTORY AFTER {directory_version}, STARTING OVER")
+    directory_version = None
+    directory_requested = directory_resync = True
+
+
+# Ask for the first page of the directory if we're starting over
+def restart_directory():
+    global directory_resync
+    if directory_resync:
+        directory_resync = False
+        send({"directory_page": 0})
+
+
+# Add users sent by the directory, or bring the ones we have up to date
+def merge_users(users):
+    for user in users:
+        if user["id"] not in active_users:
+            add_user(user)
+            continue
+        changed = {key: value for key, value in user.items()
+                   if active_users[user["id"]].get(key) != value}
+        if changed:
+            update_user(user["id"], changed)
+
+
+# Add the users of a page of the directory
+def apply_directory_page(page):
+    global directory_version, directory_next, directory_more, directory_requested, directory_watching
+    if not page["after"]:
+        # Starting over, anyone not in the first page is fetched again later
+        listed = {user["id"] for user in page["users"]}
+        for id in list(active_users):
+            if id != curr_user_id and id not in listed:
+                del_user(id)
+        directory_watching = page.get("watching", False)
+    elif page["version"] != directory_version and not directory_watching:
+        if directory_version is not None:  # Not already starting over
+            resync_directory()
+        return
+
+    directory_version, directory_next = page["version"], page["next"]
+    directory_more, directory_requested = page["more"], False
+    merge_users(page["users"])
+
+
+# Ask for the next page of the directory before the lobby pages we have run out
+def fetch_directory():
+    global directory_requested
+    if not directory_more or directory_requested:
+        return
+    if user_buttons.current_page + 2 >= len(user_buttons.user_buttons_list):
+        directory_requested = True
+        send({"directory_page": directory_next})
+
+
+# Tell the server which users we show, only changes to them are sent to us:
+# those on the page being looked at, ourselves, the profile open and our opponents
+def watch_users():
+    global watched_users
+    if not directory_watching:
+        return
+
+    user_ids = {btn.id for btn in user_buttons.buttons_near(0)}
+    user_ids.add(curr_user_id)
+    if active_profile:
+        user_ids.add(active_profile.user["id"])
+    if active_game:
+        user_ids.update(active_game.players)
+
+    if user_ids != watched_users:
+        watched_users = user_ids
+        send({"watch": sorted(user_ids)})
+
+
+# Details of users we've started watching, and those of them that have left
+def apply_watched(watched):
+    for id in watched["gone"]:
+        if id in active_users:
+            del_user(id)
+    merge_users(watched["users"])
+
+
+# How many users there are, and whether some joined after the pages we have
+def apply_lobby_summary(lobby):
+    global directory_more
+    user_buttons.set_total_users(lobby["total"])
+    if directory_next is not None and lobby["last"] > directory_next:
+        directory_more = True
+
+
 # Function to add a new user to the active users list
 def add_user(user_data):
     user_id = user_data["id"]
@@ -375,13 +514,27 @@ def on_recieve(data):
         run = False
         return True
 
-    # Handle a new user connection
-    if data.get("connected"):
+    # Changes to the directory are applied in order, or not at all
+    if "version" in data and not next_version(data["version"]):
+        return
+
+    # A page of the directory we asked for
+    if data.get("directory"):
+        apply_directory_page(data["directory"])
+
+    # Users we started watching, and a summary of the rest
+    if data.get("watched"):
+        apply_watched(data["watched"])
+    if data.get("lobby"):
+        apply_lobby_summary(data["lobby"])
+
+    # Handle a new user connection, who may already be in a page we got
+    if data.get("connected") and data["connected"]["id"] not in active_users:
         # data["connected"] contains the details of the newly connected user
         add_user(data["connected"])
 
-    # Handle a user disconnection
-    if data.get("disconnected"):
+    # Handle a user disconnection, of someone in the pages we have
+    if data.get("disconnected") and data["disconnected"] in active_users:
         # data["disconnected"] contains the id of the disconnected user
         del_user(data["disconnected"])
 
@@ -422,27 +575,27 @@ def on_recieve(data):
 
     # Handle the start of a new game
     if data.get("new_game"):
-        # Game details {game_id, board}
+        # Game details {game_id, board}, the board is a plain dict
         game_details = data["new_game"]["details"]
         game_name = data["new_game"]["game"]  # Game name
 
         # Initialize the game board based on the game type
         if game_name == "tic_tac_toe":
             game_board = TTT_Board(
-                X_id=game_details["board"].X_id,
-                O_id=game_details["board"].O_id,
+                X_id=game_details["board"]["X_id"],
+                O_id=game_details["board"]["O_id"],
                 on_button_click=move,
-                rows=game_details["board"].rows,
-                cols=game_details["board"].cols,
+                rows=game_details["board"]["rows"],
+                cols=game_details["board"]["cols"],
             )
         elif game_name == "connect4":
             game_board = Connect4_Board(
                 curr_user_id,
-                game_details["board"].red_id,
-                game_details["board"].blue_id,
+                game_details["board"]["red_id"],
+                game_details["board"]["blue_id"],
                 on_button_click=move,
-                rows=game_details["board"].rows,
-                cols=game_details["board"].cols,
+                rows=game_details["board"]["rows"],
+                cols=game_details["board"]["cols"],
             )
 
         # Create a wrapper for the game board
@@ -450,7 +603,7 @@ def on_recieve(data):
             curr_user_id,
             data["new_game"]["players"],
             data["new_game"]["identification_dict"],
-            game_details["board"].turn_id,
+            game_details["board"]["turn_id"],
             game_name,
             game_board,
             on_quit=quit_game,
@@ -470,8 +623,13 @@ def on_recieve(data):
         sound_to_play = None
         active_game.game_over_protocol(data["game_over"])
 
+    # The server only says whose picture is whose, it's shown if we have it
+    # and asked for once it's in view otherwise
+    if data.get("image") and data["image"].get("cached"):
+        update_user(data["image"]["user_id"], {"avatar": data["image"]["hash"]})
+
     # Handle profile image update
-    if data.get("image"):
+    elif data.get("image"):
         size, shape, dtype, id = (
             data["image"]["size"],
             data["image"]["shape"],
@@ -486,14 +644,13 @@ def on_recieve(data):
             run = False
             return True
 
-        # Convert the received bytes into an image
-        image = np.frombuffer(full_image, dtype=dtype).reshape(*shape)
-        surf = pygame.surfarray.make_surface(image)
-        changed = {"image": surf}
+        # Decoded once per distinct picture, then shared by everything drawing it
+        changed = {"avatar": avatars.add(full_image, data["image"])}
+        requested_avatars.discard(changed["avatar"])
         update_user(id, changed)
 
     # Handle user profile updates
-    if data.get("updated"):
+    if data.get("updated") and data["updated"]["user_id"] in active_users:
         update_user(data["updated"]["user_id"], data["updated"]["changed"])
 
     # Play the corresponding sound effect if sound effects are enabled
@@ -503,6 +660,21 @@ def on_recieve(data):
     sound_to_play = None
 
 
+# Ask for the pictures of users on the page being looked at and the pages
+# next to it, those further away are fetched when they come into view
+def fetch_avatars():
+    wanted = []
+    for btn in user_buttons.buttons_near(1):
+        if btn.avatar and btn.image is None and btn.avatar not in requested_avatars:
+            btn.set_image()  # Someone else with the same picture may have fetched it
+            if btn.image is None:
+                requested_avatars.add(btn.avatar)
+                wanted.append(btn.id)
+
+    if wanted:
+        send({"image_request": wanted})
+
+
 # Function to receive data from the server in a loop
 def recieve():
     global displays, current_display, game_details, active_game, game_board, run, ind, active_profile, challenge_form, popup
@@ -670,6 +842,13 @@ def main():
             # Check events for navigation buttons
             navigation_buttons.check_event(e, current_display, displays)
 
+        # Fetch the users and pictures on screen
+        if displays[current_display] == "home":
+            fetch_directory()
+            fetch_avatars()
+        restart_directory()
+        watch_users()
+
         # Check for key events if the current display is the user profile
         if displays[current_display] == "user_profile":
             active_profile.check_keys(pygame.key.get_pressed())
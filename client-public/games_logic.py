@@ -1,7 +0,0 @@
-# just need a class named TTT_Logic from the file games_logic
-# hacky way to impress pickle
-class TTTLogic:
-    pass
-
-class ConnectLogic:
-    pass
\ No newline at end of file
@@ -0,0 +1,71 @@
+import zlib
+import hashlib
+import numpy as np
+
+# Ways of compressing profile pictures, a client lists the ones it can read
+ENCODINGS = ("zlib-delta",)
+
+# Axes to take differences along before compressing, the smallest result wins.
+# Neighbouring pixels are usually alike, so their differences are mostly
+# small numbers that compress far better than the pixels themselves
+DELTA_AXES = ((0,), (0, 1))
+
+
+def content_hash(data, shape, dtype, bits=8):
+    """
+    A name for an image made from its contents, the same on the server and
+    every client, so a picture a client already has never needs sending again.
+    Pictures that kept fewer bits of each colour are named apart from originals.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{tuple(shape)} {np.dtype(dtype).name} ".encode())
+    if bits < 8:
+        h.update(f"{bits} bits ".encode())
+    h.update(data)
+    return h.hexdigest()
+
+
+def delta(array, axis):
+    # uint8 arithmetic wraps around, so this is undone exactly by a cumulative sum
+    return np.diff(array, axis=axis, prepend=np.zeros_like(array.take([0], axis=axis)))
+
+
+def compress(data, shape, dtype, bits=8, level=6):
+    """
+    Compress the raw bytes of an image, returns the details to send along
+    with it and the compressed bytes. With fewer than 8 bits the lowest bits
+    of every value are dropped first, which loses detail but compresses better.
+    """
+    array = np.frombuffer(data, dtype=dtype).reshape(shape)
+    if array.dtype != np.uint8 or array.ndim < 2:
+        return {"encoding": "zlib-delta", "axes": []}, zlib.compress(data, level)
+
+    if bits < 8:
+        array = array >> (8 - bits)
+
+    best = None
+    for axes in DELTA_AXES:
+        filtered = array
+        for axis in axes:
+            filtered = delta(filtered, axis)
+        compressed = zlib.compress(filtered.tobytes(), level)
+        if best is None or len(compressed) < len(best[1]):
+            best = ({"encoding": "zlib-delta", "axes": list(axes), "bits": bits}, compressed)
+    return best
+
+
+def decompress(details, data, shape, dtype):
+    """The raw bytes of an image compressed with compress."""
+    data = zlib.decompress(data)
+    if not details["axes"]:
+        return data
+
+    array = np.frombuffer(data, dtype=np.uint8).reshape(shape)
+    for axis in reversed(details["axes"]):
+        array = np.cumsum(array, axis=axis, dtype=np.uint8)
+    bits = details.get("bits", 8)
+    if bits < 8:
+        # Put every value in the middle of the range it was rounded down from
+        shift = 8 - bits
+        array = (array << shift) | (1 << (shift - 1))
+    return array.astype(dtype, copy=False).tobytes()
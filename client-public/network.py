@@ -3,8 +3,15 @@ import pickle
 import struct
 import math
 from logger import logger
+from framing import FrameReader, HEADER_V2
+from codec import codecs
+from images import ENCODINGS
+from avatar_cache import avatars
 
 DEFAULT_BYTES = 1024  # max bytes to be sent in one message
+UPLOAD_CHUNK = 16 * 1024  # big frames are sent in chunks to report progress
+PROTOCOL_VERSION = 2  # newest wire protocol the client can speak
+CODEC = "pickle"  # codec the client asks the server to use, "binary" is smaller but slower
 
 
 class Network:
@@ -24,6 +31,10 @@ class Network:
             self.port,
         )  # complete address, to which we can now connect to
         self.id = None
+        self.reader = FrameReader(self.client)  # assembles incoming frames
+        self.protocol = 1  # upgraded once the server acknowledges protocol 2
+        self.pending = None  # a message read early while negotiating
+        self.codec = codecs["pickle"]  # until the server agrees to CODEC
 
     # function to connect to the server
     def connect(self):
@@ -35,8 +46,14 @@ class Network:
             data = self.recv()
             self.id = data  # the first element in the data will be the id
 
-            # no metadate needed to be sent
-            self.send({})
+            # no metadata needed to be sent, just the protocol, codec,
+            # compressed images we can read and the pictures we already have,
+            # the rest of them and of the lobby we ask for as they're shown
+            self.send({"protocol": PROTOCOL_VERSION, "codec": CODEC,
+                       "image_encodings": list(ENCODINGS),
+                       "image_hashes": avatars.stored(), "lazy_images": True,
+                       "directory": True, "watch": True})
+            self.negotiate()
 
             return data
         except Exception as e:
@@ -44,11 +61,27 @@ class Network:
             logger.warning(f"ERROR WHILE TRYING TO CONNECT: {e}")
             return False
 
+    # switch protocols if the server acknowledged the one we asked for
+    def negotiate(self):
+        reply = self.recv()
+        if isinstance(reply, dict) and reply.get("protocol"):
+            self.protocol = self.reader.protocol = reply["protocol"]
+            self.codec = codecs[reply.get("codec", "pickle")]
+        else:
+            self.pending = reply  # an older server, this is a real message
+
     # send some data to the server
-    def send(self, data, pickle_data=True, fn=lambda: None):
+    def send(self, data, pickle_data=True, fn=lambda *args: None):
         try:
             if pickle_data:
-                data = pickle.dumps(data)
+                data = self.codec.dumps(data)
+
+            # protocol 2 sends everything as one length prefixed frame
+            if self.protocol >= 2:
+                if len(data) >= UPLOAD_CHUNK:
+                    return self.send_frame(data, fn)
+                self.client.sendall(HEADER_V2.pack(len(data)) + data)
+                return True
 
             if len(data) >= DEFAULT_BYTES:
                 return self.send_huge(data, fn)
@@ -63,50 +96,36 @@ class Network:
 
     # recieve some data from the server
     def recv(self, load=True):
-        data = None
-        try:
-            lenData = self.client.recv(2)
-            # print(struct.unpack("h", lenData))
+        if self.pending is not None:
+            data, self.pending = self.pending, None
+            return data
 
-            if not lenData:
+        try:
+            # the reader waits for whole frames and joins huge messages
+            data = self.reader.read_data()
+            if data is None:
                 return ""  # server down
-            lenData = struct.unpack("h", lenData)[
-                0
-            ]  # length of data will be padded to 2  bytes
-            data = self.client.recv(lenData)
-
-            try:
-
-                pickled = pickle.loads(data)
-
-                if isinstance(pickled, dict) and pickled.get("message_type") == "huge":
-                    n_batches = pickled["n_batches"]
-                    # print("batches:",n_batches)
-                    binData = b""
-                    batch_sizes = struct.unpack(
-                        "h" * n_batches, self.client.recv(2 * n_batches)
-                    )
-                    # print("batch size",batch_sizes)
-                    for size in batch_sizes:
-                        batchData = self.client.recv(size)
-
-                        if not batchData:
-                            return ""  # server down
 
-                        binData += batchData
-
-                    return binData
-
-            except Exception as e:
-                logger.error(f"ERROR WHILE TRYING TO RECIEVE HUGE DATA: {e}")
-
-            return pickle.loads(data) if load else data
+            return self.codec.loads(data) if load else data
 
         except Exception as e:
             logger.error(f"ERROR WHILE RECIEVING: {e}")
             return False
 
-    def send_huge(self, data_bytes, fn=lambda: None):
+    # send one big protocol 2 frame, in chunks so that progress can be shown
+    def send_frame(self, data_bytes, fn=lambda *args: None):
+        size = len(data_bytes)
+        n_chunks = math.ceil(size / UPLOAD_CHUNK)
+        view = memoryview(data_bytes)
+
+        self.client.sendall(HEADER_V2.pack(size))
+        for i in range(n_chunks):
+            fn(i, n_chunks)
+            self.client.sendall(view[i * UPLOAD_CHUNK: (i + 1) * UPLOAD_CHUNK])
+
+        return True
+
+    def send_huge(self, data_bytes, fn=lambda *args: None):
 
         size = len(data_bytes)
         n_batches = math.ceil(size / DEFAULT_BYTES)
@@ -116,7 +135,8 @@ class Network:
         fmt = "h" * n_batches
 
         # send the data in batches
-        self.send({"message_type": "huge", "n_batches": n_batches})
+        self.send(pickle.dumps(
+            {"message_type": "huge", "n_batches": n_batches}), pickle_data=False)
 
         self.client.sendall(struct.pack(fmt, *batch_lengths))
         for i in range(n_batches):
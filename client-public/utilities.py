@@ -7,6 +7,7 @@ import pyperclip
 import json
 import time
 import numpy as np
+from avatar_cache import avatars
 
 # List of animations for celebrations and mourns
 celebrations = [FireworksWindow, Fluid]
@@ -458,7 +459,7 @@ class UserButton:
         text,
         curr_user,
         on_click,
-        image=None,
+        avatar=None,
         bot=False,
     ):
         self.curr_user = curr_user
@@ -470,8 +471,8 @@ class UserButton:
         self.color = color
         self.rect = pygame.Rect((x, y, w, h))
         self.username = text
-        self.image = pygame.surfarray.make_surface(
-            image) if image is not None else None
+        self.avatar = avatar  # Key of the profile picture in the avatar cache
+        self.image = None
 
         # Set up button style
         self.button_style = Button_Styles.USER_BUTTON_STYLE.copy()
@@ -480,6 +481,8 @@ class UserButton:
         self.text_color = [255 - c for c in self.avg_color]
 
         self.button_style["font_color"] = self.text_color
+        if self.avatar:
+            self.set_image()
         self.button_style["tags"] = ["YOU"] if self.curr_user else []
         if self.bot:
             self.button_style["tags"].append("BOT")
@@ -508,37 +511,43 @@ class UserButton:
         """Update the button display on the window."""
         self.button.update(win)
 
+    def set_image(self):
+        """Use the cached profile picture and pick a text color that stands out on it."""
+        self.image = avatars.scaled(self.avatar, (self.w, self.h))
+        if self.image is None:
+            return
+
+        # Calculate average color of the image
+        text_rect = (
+            self.button_style["font"]
+            .render(self.username, True, Colors.BLACK)
+            .get_rect(center=self.rect.center)
+        )
+
+        arr = pygame.surfarray.array3d(self.image)[
+            int(text_rect.x - self.rect.x): int(
+                text_rect.x - self.rect.x + text_rect.width,
+            ),
+            int(text_rect.y - self.rect.y): int(
+                text_rect.y - self.rect.y + text_rect.height
+            ),
+        ]
+
+        avg_color_per_row = np.average(arr, axis=0,)
+        self.avg_color = np.round(np.average(
+            avg_color_per_row, axis=0)).astype(np.int64)
+        # Adjust text color
+        self.text_color = [255 - c for c in self.avg_color]
+
+        self.button_style["font_color"] = self.text_color
+
     def update(self, changed: dict):
         """Update button properties and recalculate styles based on new data."""
         self.__dict__.update(changed)
         self.rect = pygame.Rect(self.rect)
-        if self.image:
-            self.image = pygame.transform.scale(
-                self.image, (int(self.w), int(self.h)))
-
-            # Calculate average color of the image
-            text_rect = (
-                self.button_style["font"]
-                .render(self.username, True, Colors.BLACK)
-                .get_rect(center=self.rect.center)
-            )
-
-            arr = pygame.surfarray.array3d(self.image)[
-                int(text_rect.x - self.rect.x): int(
-                    text_rect.x - self.rect.x + text_rect.width,
-                ),
-                int(text_rect.y - self.rect.y): int(
-                    text_rect.y - self.rect.y + text_rect.height
-                ),
-            ]
-
-            avg_color_per_row = np.average(arr, axis=0,)
-            self.avg_color = np.round(np.average(
-                avg_color_per_row, axis=0)).astype(np.int64)
-            # Adjust text color
-            self.text_color = [255 - c for c in self.avg_color]
-
-            self.button_style["font_color"] = self.text_color
+        # Moving the button keeps the picture it already has
+        if self.avatar and ("avatar" in changed or "username" in changed):
+            self.set_image()
 
         if changed.get("bot") is True:
             self.button_style["tags"].append("BOT")
@@ -610,6 +619,7 @@ class UserButton_Container:
             self.title_rect.x + self.title_rect.width + 30,
             self.title_rect.y + self.title_rect.height / 2,
         )
+        self.total_users = None  # Users in the whole lobby, once the server says
         self.num_users_text = Fonts.notification_font.render(
             str(0), True, Colors.WHITE)
         self.num_users_text_rect = self.num_users_text.get_rect(
@@ -748,7 +758,7 @@ class UserButton_Container:
             str(user["username"]),
             curr_user,
             on_click,
-            image=user.get("image"),
+            avatar=user.get("avatar"),
             bot=user.get("bot"),
         )
 
@@ -759,10 +769,23 @@ class UserButton_Container:
         self.update_num_users()
         self.update_pagination()
 
+    def buttons_near(self, pages):
+        """Buttons on the current page and the given number of pages either side of it."""
+        first = max(self.current_page - pages, 0)
+        for page in self.user_buttons_list[first: self.current_page + pages + 1]:
+            for row in page:
+                yield from row
+
+    def set_total_users(self, total):
+        """Show the number of users in the whole lobby, not just those we have."""
+        self.total_users = total
+        self.update_num_users()
+
     def update_num_users(self):
         """Update the displayed number of users."""
+        num_users = self.num_users if self.total_users is None else self.total_users
         self.num_users_text = Fonts.notification_font.render(
-            str(self.num_users), False, Colors.WHITE
+            str(num_users), False, Colors.WHITE
         )
         self.num_users_text_rect = self.num_users_text.get_rect(
             center=self.num_users_text_center
@@ -948,6 +971,8 @@ class Profile:
             )
 
         self.bg_image = None  # Background image for the profile
+        if user.get("avatar"):
+            self.update({"avatar": user["avatar"]})
 
     def create_challenge_buttons(self):
         """Create challenge buttons for the profile."""
@@ -1028,12 +1053,11 @@ class Profile:
                 center=(LEFT_WIDTH // 2, 100)
             )
 
-        if changed.get("image"):
-            self.bg_image = pygame.transform.scale(
-                changed.get("image"), (int(self.w), int(self.h))
+        if changed.get("avatar"):
+            # Faded background image, shared with other profiles showing the same picture
+            self.bg_image = avatars.scaled(
+                changed["avatar"], (self.w, self.h), alpha=50
             )
-            # Set transparency of the background image
-            self.bg_image.set_alpha(50)
 
     def on_disconnect(self):
         """Handle the event when a user disconnects."""
@@ -0,0 +1,86 @@
+import argparse
+import random
+import time
+import ttt_table
+from games_logic import BoardGame
+from utilities import TTT_Board
+
+
+# Random positions with the bot to move, found by playing random moves
+def random_positions(count, min_moves, seed):
+    rng = random.Random(seed)
+    table = ttt_table.load()
+    positions = []
+    while len(positions) < count:
+        cells = [ttt_table.EMPTY] * 9
+        player, other = ttt_table.MINE, ttt_table.THEIRS
+        for _ in range(rng.randint(min_moves, 7)):
+            cells[rng.choice([i for i in range(9) if cells[i] == ttt_table.EMPTY])] = player
+            player, other = other, player
+        if table.won(cells, ttt_table.MINE) or table.won(cells, ttt_table.THEIRS):
+            continue
+
+        # Pieces of whoever moves next are MINE
+        if player == ttt_table.THEIRS:
+            cells = [ttt_table.THEIRS if c == ttt_table.MINE else ttt_table.MINE if c else c
+                     for c in cells]
+        positions.append(cells)
+    return positions
+
+
+# Time each way of picking a move over the same positions, in microseconds per move
+def board_game(cells, use_table):
+    game = BoardGame("bench", "ai", "human", "human", lambda *args: None)
+    if not use_table:
+        game.table = None
+    symbols = {ttt_table.MINE: "ai", ttt_table.THEIRS: "human"}
+    for i, cell in enumerate(cells):
+        if cell:
+            game.board[i // 3][i % 3] = symbols[cell]
+    return game.find_and_place_best_move
+
+
+def ttt_board(cells, use_table):
+    game = TTT_Board("bench", "ai", "ai", "human", lambda *args: None, "human")
+    if not use_table:
+        game.table = None
+    symbols = {ttt_table.MINE: game.user_text, ttt_table.THEIRS: game.opp_text}
+    for i, cell in enumerate(cells):
+        if cell:
+            game.board[i // 3][i % 3] = symbols[cell]
+    return game.move
+
+
+def measure(setup, positions, use_table):
+    moves = [setup(cells, use_table) for cells in positions]
+    start = time.perf_counter()
+    for move in moves:
+        move()
+    return (time.perf_counter() - start) / len(moves) * 1e6
+
+
+def main(count, seed):
+    start = time.perf_counter()
+    ttt_table.load()
+    print(f"Table ready in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    print(f"{'engine':<28}{'us per move':>14}")
+    positions = random_positions(count, 0, seed)
+    late_positions = random_positions(count, 2, seed)  # The full search is too slow from the start
+    for title, setup, use_table, cases in (
+        ("BoardGame table", board_game, True, positions),
+        ("BoardGame minimax (depth 4)", board_game, False, positions),
+        ("TTT_Board table", ttt_board, True, positions),
+        ("TTT_Board minimax (2+ moves)", ttt_board, False, late_positions),
+    ):
+        print(f"{title:<28}{measure(setup, cases, use_table):>14.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare looking tic tac toe moves up with searching for them")
+    parser.add_argument("--positions", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    main(args.positions, args.seed)
@@ -0,0 +1,84 @@
+# Connect Four style boards kept as bitmasks, one mask per player.
+#
+# Every column takes rows + 1 bits, counted from the bottom up, and the spare
+# bit on top of each column stays empty so that shifting a mask never carries
+# a line of pieces over from one column into the next:
+#
+#     6 13 20 27 34 41 48   <- always empty
+#     5 12 19 26 33 40 47   <- row 0 of the board (the top)
+#     4 11 18 25 32 39 46
+#     3 10 17 24 31 38 45
+#     2  9 16 23 30 37 44
+#     1  8 15 22 29 36 43
+#     0  7 14 21 28 35 42   <- row rows - 1 of the board (the bottom)
+#
+# A standard 6x7 board fits in 49 bits.
+
+
+# Distance in bits between neighbouring cells in each direction a line can go:
+# vertical, horizontal, and the two diagonals
+def directions(rows):
+    height = rows + 1
+    return (1, height, height + 1, height - 1)
+
+
+# Bit of the cell at (row, col), rows counted from the top like the board
+def bit(rows, row, col):
+    return 1 << (col * (rows + 1) + rows - 1 - row)
+
+
+# (row, col) of a bit position
+def cell(rows, index):
+    col, height = divmod(index, rows + 1)
+    return (rows - 1 - height, col)
+
+
+# Bits of every run of n pieces in a mask, marked at the lowest cell of the run
+def runs(mask, rows, n):
+    found = 0
+    for step in directions(rows):
+        run = mask
+        for i in range(1, n):
+            run &= mask >> (step * i)
+            if not run:
+                break
+        found |= run
+    return found
+
+
+# Whether a mask has n pieces in a line anywhere
+def has_won(mask, rows, n):
+    return runs(mask, rows, n) != 0
+
+
+# Cells that would complete a run of n pieces if the mask had a piece there.
+# Includes cells off the board and ones already taken, mask those out
+def threats(mask, rows, n):
+    found = 0
+    for step in directions(rows):
+        # The missing piece can be at any of the n positions of the run
+        for gap in range(n):
+            run = -1
+            for i in range(-gap, n - gap):
+                if i > 0:
+                    run &= mask >> (step * i)
+                elif i < 0:
+                    run &= mask << (step * -i)
+            found |= run
+    return found
+
+
+# Cells of a run of n pieces in the mask, or None if there is no such run
+def winning_cells(mask, rows, n):
+    for step in directions(rows):
+        run = mask
+        for i in range(1, n):
+            run &= mask >> (step * i)
+            if not run:
+                break
+
+        if run:
+            start = (run & -run).bit_length() - 1  # Lowest run in this direction
+            return sorted(cell(rows, start + step * i) for i in range(n))
+
+    return None
@@ -1,8 +1,14 @@
+import time
 import pygame
+import argparse
+import threading
 from network import Network
 from _thread import start_new_thread
 from logger import logger
 from games_logic import BoardGame
+from bot_pool import BotPool, DEFAULT_WORKERS
+import opening_book
+from connect4_engine import DEFAULT_BUDGET_MS
 
 # Import network and utility modules
 
@@ -41,9 +47,15 @@ def recieve_active_users():
         run = False  # Stop the main loop if an error occurs
 
 
+# Moves are sent from the main thread and everything else from the receiving
+# thread, so only one of them may write to the socket at a time
+send_lock = threading.Lock()
+
+
 # Send data to the server
 def send(data, pickle_data=True):
-    sent = n.send(data, pickle_data)  # Send data using Network object
+    with send_lock:
+        sent = n.send(data, pickle_data)  # Send data using Network object
     return sent
 
 
@@ -78,7 +90,7 @@ def send_image(img):
     size = len(image_bytes)  # Get the size of the image data
 
     # Send the server the size and metadata of the image
-    send({"image": {"size": size, "shape": img.shape, "dtype": img.dtype}})
+    send({"image": {"size": size, "shape": img.shape, "dtype": str(img.dtype)}})
 
     allowed = n.recv()  # Receive response from the server
     if not allowed.get(
@@ -152,14 +164,15 @@ def recieve():
             )
 
             # Setup the game board based on the game name
+            board = game_details["board"]  # A plain dict describing the game
             if game_name == "tic_tac_toe":
 
                 game_board = BoardGame(game_id, curr_user_id, human_id,
-                                       game_details["board"].turn_id, move, game_details["board"].rows, game_details["board"].cols, game_details["board"].win_condition)
+                                       board["turn_id"], move, board["rows"], board["cols"], board["win_condition"])
 
             elif game_name == "connect4":
                 game_board = BoardGame(game_id, curr_user_id, human_id,
-                                       game_details["board"].turn_id, move, game_details["board"].rows, game_details["board"].cols, game_details["board"].win_condition, connect=True)
+                                       board["turn_id"], move, board["rows"], board["cols"], board["win_condition"], connect=True, pool=pool, book=book, record=True)
 
             games[game_id] = game_board  # Store the game board
 
@@ -167,17 +180,22 @@ def recieve():
         if data.get("error"):
             logger.error(f"[BOT]: ERROR : {data['error']}")
 
+        # Update on a move made by a player. The last move of a game comes
+        # with game_over, it's played but not answered
+        if data.get("moved"):
+            game = games.get(data["moved"]["game_id"])
+            if game:
+                game.make_move(data["moved"]["to"][0], data["moved"]["to"][1],
+                               data["moved"]["who"], respond=not data.get("game_over"))
+
         # Game over message
         if data.get("game_over"):
-            games[game_id].game_over_protocol(
-                data["game_over"].get(
-                    "indices"), data["game_over"]["winner_id"]
-            )
-
-        # Update on a move made by a player
-        elif data.get("moved"):
-            games[data["moved"]["game_id"]].make_move(
-                data["moved"]["to"][0], data["moved"]["to"][1], data["moved"]["who"])
+            game = games.pop(data["game_over"]["game_id"], None)
+            if game:
+                game.game_over_protocol(
+                    data["game_over"].get(
+                        "indices"), data["game_over"]["winner_id"]
+                )
 
         # Update user details
         if data.get("updated"):
@@ -216,12 +234,41 @@ def main():
     # Start receiving data from the server in a separate thread
     start_new_thread(recieve, ())
 
-    # Keep the program running
+    # Send the moves the worker pool comes up with, until the bot stops
     while run:
-        pass
+        result = pool.get_result(timeout=0.5)
+        game = games.get(result["game_id"]) if result else None
+        if game is None or game.start != result["start"]:
+            continue  # Nothing yet, or the game ended (maybe for a rematch) while searching
+
+        took = (time.time() - result["submitted"]) * 1000
+        logger.debug(
+            f"[BOT]: {result['game_id']} column {result['move']} scored {result['score']} at depth {result['depth']} ({result['nodes']} nodes, {took:.0f} ms)")
+        if took > deadline:
+            logger.warning(
+                f"[BOT]: Move in {result['game_id']} took {took:.0f} ms, over the {deadline} ms deadline")
+
+        move(result["game_id"], result["move"])
+
+    pool.close()
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a Sluggy bot")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help="processes searching for moves, one game at a time each")
+    parser.add_argument("--move-time", type=int, default=DEFAULT_BUDGET_MS,
+                        help="milliseconds to search for each move")
+    parser.add_argument("--split-depth", type=int, default=None,
+                        help="search every move this many plies deep using all the workers, "
+                        "instead of one worker per game for --move-time")
+    args = parser.parse_args()
+
+    # Searches stop at the move time, anything much later than this is reported
+    deadline = 2 * args.move_time
+    pool = BotPool(args.workers, args.move_time, args.split_depth)
+    book = opening_book.load()  # Built with opening_book.py, optional
+
     setup()  # Setup and connect
     main()  # Run the main function
     logger.warning("DISCONNECTED")
@@ -0,0 +1,145 @@
+import os
+import time
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from logger import logger
+from connect4_engine import Connect4Engine, DEFAULT_BUDGET_MS
+from parallel_search import root_split
+
+DEFAULT_WORKERS = os.cpu_count() or 1
+
+
+# Body of every worker process. Each game always lands on the same worker, so
+# its engine (and the transposition table in it) lives on from move to move.
+# Games are known by their id and start, a rematch with the same id is a new game
+def worker(inbox, results):
+    engines = {}  # (game_id, start) -> engine
+
+    while True:
+        request = inbox.get()
+        if request is None:  # The pool is shutting down
+            break
+
+        game = request["game_id"], request["start"]
+        if request.get("forget"):  # The game is over
+            engines.pop(game, None)
+            continue
+
+        engine = engines.get(game)
+        history = request["history"]
+        if engine is None or engine.moves > len(history):
+            engine = engines[game] = Connect4Engine(
+                request["rows"], request["cols"], request["win_condition"])
+
+        # Catch up on the moves made since this game was last searched
+        for col in history[engine.moves:]:
+            engine.play(col)
+
+        col, score, depth = engine.search(request["time_budget"])
+        results.put({
+            "game_id": request["game_id"],
+            "start": request["start"],
+            "move": col,
+            "score": score,
+            "depth": depth,
+            "nodes": engine.nodes,
+            "submitted": request["submitted"],
+        })
+
+
+class BotPool:
+    """
+    Worker processes that search for the bot's moves, so that a long search in
+    one game doesn't hold up the others and searches run on every core.
+
+    Results come back on the results queue for the network side to send.
+
+    With a split_depth, every move is instead searched to exactly that depth
+    by all the workers together, splitting up the moves at the root.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS, time_budget=DEFAULT_BUDGET_MS, split_depth=None):
+        self.time_budget = time_budget
+        self.split_depth = split_depth
+
+        # Spawned so that workers don't inherit the sockets and threads of the bot
+        context = multiprocessing.get_context("spawn")
+        self.results = context.Queue()
+        self.inboxes, self.processes = [], []
+        if split_depth:
+            self.executor = ProcessPoolExecutor(workers, mp_context=context)
+            logger.info(
+                f"[BOT POOL]: {workers} workers, splitting searches {split_depth} plies deep")
+            return
+
+        self.inboxes = [context.Queue() for _ in range(workers)]
+        self.processes = [
+            context.Process(target=worker, args=(inbox, self.results), daemon=True)
+            for inbox in self.inboxes
+        ]
+        for process in self.processes:
+            process.start()
+
+        logger.info(f"[BOT POOL]: {workers} workers, {time_budget} ms per move")
+
+    def inbox(self, game_id):
+        return self.inboxes[hash(game_id) % len(self.inboxes)]
+
+    def submit(self, game_id, start, rows, cols, win_condition, history):
+        """
+        Ask for a move in a game, given every column played so far. start
+        tells apart games with the same id, and comes back with the result.
+        """
+        request = {
+            "game_id": game_id,
+            "start": start,
+            "rows": rows,
+            "cols": cols,
+            "win_condition": win_condition,
+            "history": list(history),
+            "time_budget": self.time_budget,
+            "submitted": time.time(),
+        }
+
+        if self.split_depth:
+            # The split search waits on the workers, so it gets a thread of its own
+            threading.Thread(target=self.split, args=(request,), daemon=True).start()
+        else:
+            self.inbox(game_id).put(request)
+
+    def split(self, request):
+        col, score, nodes = root_split(
+            self.executor, request["rows"], request["cols"], request["win_condition"],
+            request["history"], self.split_depth)
+        self.results.put({
+            "game_id": request["game_id"],
+            "start": request["start"],
+            "move": col,
+            "score": score,
+            "depth": self.split_depth,
+            "nodes": nodes,
+            "submitted": request["submitted"],
+        })
+
+    def forget(self, game_id, start):
+        """Drop everything kept about a finished game."""
+        if not self.split_depth:  # Split searches keep nothing between moves
+            self.inbox(game_id).put({"game_id": game_id, "start": start, "forget": True})
+
+    def get_result(self, timeout=None):
+        """The next finished search, or None if there was none within the timeout."""
+        try:
+            return self.results.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        if self.split_depth:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+        for inbox in self.inboxes:
+            inbox.put(None)
+        for process in self.processes:
+            process.join(timeout=1)
@@ -0,0 +1,214 @@
+import math
+import random
+import time
+import bitboard
+
+WIN = 1_000_000  # Score of a won position, less the number of pieces it took
+DEFAULT_BUDGET_MS = 500  # Time to think about a move
+DEFAULT_TABLE_BITS = 18  # Transposition table slots, as a power of two
+# Nodes searched between looks at the clock, a power of two. At ~35k nodes a
+# second that's under 2 ms, so even short budgets are kept to
+DEADLINE_CHECK_NODES = 64
+
+# Transposition table bounds
+EXACT, LOWER, UPPER = range(3)
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+class Connect4Engine:
+    """
+    Negamax search with alpha beta pruning over Connect Four bitboards.
+
+    Positions are kept from the point of view of the player to move: position
+    holds their pieces and mask holds every piece on the board. Searches
+    deepen one ply at a time until the time budget runs out, and a
+    transposition table keyed by Zobrist hashes carries results and best
+    moves from each depth into the next.
+    """
+
+    def __init__(self, rows=6, cols=7, win_condition=4, table_bits=DEFAULT_TABLE_BITS, seed=0):
+        self.rows, self.cols, self.win_condition = rows, cols, win_condition
+        self.size = rows * cols
+        height = rows + 1
+
+        # Masks of the bottom cell and of the whole of every column
+        self.bottom = [1 << (col * height) for col in range(cols)]
+        self.column = [((1 << rows) - 1) << (col * height)
+                       for col in range(cols)]
+        self.top = [1 << (col * height + rows - 1) for col in range(cols)]
+        self.board_mask = sum(self.column)
+        self.bottom_mask = sum(self.bottom)
+
+        # Columns from the middle out, better moves first means more pruning
+        self.order = sorted(range(cols), key=lambda col: abs(2 * col - cols + 1))
+        center = self.order[:2 - cols % 2]
+        self.center_mask = sum(self.column[col] for col in center)
+
+        # A random number for every piece of each player in every cell
+        rng = random.Random(seed)
+        self.zobrist = [[rng.getrandbits(64) for _ in range(cols * height)]
+                        for _ in range(2)]
+
+        # Bounded table, a slot keeps (key, depth, bound, score, best column,
+        # generation) and each new search is a new generation
+        self.table_mask = (1 << table_bits) - 1
+        self.table = [None] * (1 << table_bits)
+        self.generation = 0
+
+        self.reset()
+
+    def reset(self):
+        """Start from an empty board."""
+        self.position = 0
+        self.mask = 0
+        self.moves = 0
+        self.key = 0
+
+    def can_play(self, col):
+        return 0 <= col < self.cols and not self.mask & self.top[col]
+
+    def play(self, col):
+        """Drop a piece for the player to move in a column."""
+        move = (self.mask + self.bottom[col]) & self.column[col]
+        self.key ^= self.zobrist[self.moves & 1][move.bit_length() - 1]
+        self.position ^= self.mask
+        self.mask |= move
+        self.moves += 1
+
+    def winning_cells(self, pieces, mask):
+        """Empty cells that would complete a line of the given pieces."""
+        return bitboard.threats(pieces, self.rows, self.win_condition) & self.board_mask & ~mask
+
+    def evaluate(self, position, mask):
+        """Score a position for the player to move, from its open threats and center pieces."""
+        opponent = position ^ mask
+        threats = self.winning_cells(position, mask).bit_count(
+        ) - self.winning_cells(opponent, mask).bit_count()
+        center = (position & self.center_mask).bit_count() - \
+            (opponent & self.center_mask).bit_count()
+        return 4 * threats + center
+
+    def store(self, key, depth, bound, score, col):
+        index = key & self.table_mask
+        entry = self.table[index]
+
+        # Keep deeper results from this search, anything older can go
+        if entry is None or entry[5] != self.generation or depth >= entry[1]:
+            self.table[index] = (key, depth, bound, score, col, self.generation)
+
+    def negamax(self, position, mask, key, moves, depth, alpha, beta):
+        self.nodes += 1
+        if not self.nodes & (DEADLINE_CHECK_NODES - 1) and time.perf_counter() > self.deadline:
+            raise SearchTimeout()
+
+        possible = (mask + self.bottom_mask) & self.board_mask
+        if not possible:
+            return 0, None  # Board is full, it's a draw
+
+        # Win right away if we can
+        wins = possible & self.winning_cells(position, mask)
+        if wins:
+            return WIN - moves - 1, self.column_of(wins)
+
+        # Never play right under a cell the opponent wins at
+        opponent_wins = self.winning_cells(position ^ mask, mask)
+        forced = possible & opponent_wins
+        if forced & (forced - 1):
+            return -(WIN - moves - 2), None  # Two threats can't both be blocked
+        candidates = forced or possible
+        candidates &= ~(opponent_wins >> 1)
+        if not candidates:
+            return -(WIN - moves - 2), None
+
+        if depth == 0:
+            return self.evaluate(position, mask), None
+
+        # Use what an earlier search found out about this position
+        original_alpha = alpha
+        hint = None
+        entry = self.table[key & self.table_mask]
+        if entry is not None and entry[0] == key:
+            hint = entry[4]
+            if entry[1] >= depth:
+                bound, score = entry[2], entry[3]
+                if bound == EXACT:
+                    return score, hint
+                if bound == LOWER:
+                    alpha = max(alpha, score)
+                elif bound == UPPER:
+                    beta = min(beta, score)
+                if alpha >= beta:
+                    return score, hint
+
+        best_score, best_col = -WIN - 1, None
+        side = self.zobrist[moves & 1]
+        for col in self.ordered(hint):
+            move = candidates & self.column[col]
+            if not move:
+                continue
+
+            score = -self.negamax(position ^ mask, mask | move, key ^ side[move.bit_length() - 1],
+                                  moves + 1, depth - 1, -beta, -alpha)[0]
+            if score > best_score:
+                best_score, best_col = score, col
+                alpha = max(alpha, score)
+                if alpha >= beta:
+                    break
+
+        if best_score <= original_alpha:
+            bound = UPPER
+        elif best_score >= beta:
+            bound = LOWER
+        else:
+            bound = EXACT
+        self.store(key, depth, bound, best_score, best_col)
+
+        return best_score, best_col
+
+    def ordered(self, hint):
+        if hint is None:
+            return self.order
+        return [hint] + [col for col in self.order if col != hint]
+
+    def column_of(self, move):
+        return ((move & -move).bit_length() - 1) // (self.rows + 1)
+
+    def score(self, depth, alpha=-WIN - 1, beta=WIN + 1):
+        """Score and best column of the position searched to exactly depth plies, however long it takes."""
+        self.generation += 1
+        self.nodes = 0
+        self.deadline = math.inf
+        return self.negamax(self.position, self.mask, self.key, self.moves, depth, alpha, beta)
+
+    def search(self, budget_ms=DEFAULT_BUDGET_MS, max_depth=None):
+        """
+        Best column for the player to move, deepening until the budget is used up.
+
+        Returns the column, its score and the deepest depth that was finished.
+        """
+        self.generation += 1
+        self.nodes = 0
+        self.deadline = time.perf_counter() + budget_ms / 1000
+        max_depth = min(max_depth or self.size, self.size - self.moves)
+
+        best_col = next(col for col in self.order if self.can_play(col))
+        best_score, finished = 0, 0
+        for depth in range(1, max_depth + 1):
+            try:
+                score, col = self.negamax(self.position, self.mask, self.key, self.moves,
+                                          depth, -WIN - 1, WIN + 1)
+            except SearchTimeout:
+                break
+
+            if col is not None:
+                best_col = col
+            best_score, finished = score, depth
+
+            # Stop once the result is certain
+            if abs(score) > WIN - self.size - 1:
+                break
+
+        return best_col, best_score, finished
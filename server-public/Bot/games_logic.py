@@ -1,20 +1,18 @@
-# Kinda a hack, but since I'm sending over an object from the server
-# just making this file to avoid errors
 import math
 from logger import logger
+from connect4_engine import Connect4Engine, DEFAULT_BUDGET_MS
+import ttt_table
+import opening_book
 import random
+import itertools
 
-
-class TTTLogic:
-    pass
-
-
-class ConnectLogic:
-    pass
+# Numbers every game the bot starts, to tell apart games that reuse an id
+# (rematches do) in the worker pool
+game_starts = itertools.count()
 
 
 class BoardGame:
-    def __init__(self, game_id, ai, human, turn, make_move_req, rows=3, cols=3, win_condition=3, connect=False):
+    def __init__(self, game_id, ai, human, turn, make_move_req, rows=3, cols=3, win_condition=3, connect=False, time_budget=DEFAULT_BUDGET_MS, pool=None, book=None, record=False):
 
         self.game_id = game_id
         self.rows = rows
@@ -26,17 +24,46 @@ class BoardGame:
         self.ai = ai  # AI
         self.human = human  # Human
         self.turn = turn
+        self.ai_first = turn == ai  # Which plies were the AI's, for measuring the book
 
         self.make_move_req = make_move_req
 
+        # Connect 4 is searched on bitboards, for as long as time_budget (ms) allows.
+        # With a worker pool the search happens there, from the columns played
+        self.time_budget = time_budget
+        self.pool = pool
+        self.start = next(game_starts)
+        self.history = []
+
+        # Opening moves come straight from the book when it has the position
+        self.book = book if connect and book and book.matches(
+            rows, cols, win_condition) else None
+        # Whether Connect 4 games are kept for measuring the book, only real ones are
+        self.record = record
+        # Tic tac toe moves are looked up in a solved table, when the board is small enough
+        if self.connect:
+            self.engine = None if pool else Connect4Engine(
+                rows, cols, win_condition)
+        else:
+            self.table = ttt_table.load(rows, cols, win_condition)
+
         # If it is AI's turn to start
         if self.turn == self.ai:
             self.first_move()
 
     def first_move(self):
-        if self.connect:
-            return self.make_move_req(
-                self.game_id, self.cols//2+1)
+        return self.request_move()
+
+    def request_move(self):
+        """Search for the AI's move, in the worker pool if there is one."""
+        if self.book:
+            col = self.book.lookup(self.history)
+            if col is not None:
+                logger.debug(f"[BOT]: {self.game_id} column {col} from the book")
+                return self.make_move_req(self.game_id, col)
+
+        if self.pool and self.connect:
+            return self.pool.submit(self.game_id, self.start, self.rows, self.cols, self.win_condition, self.history)
 
         return self.find_and_place_best_move()
 
@@ -99,71 +126,88 @@ class BoardGame:
 
         if is_maximizing:
             best_score = -math.inf
-            for col in range(self.cols):
-                for row in range(self.rows-1, -1, -1):
-                    if self.board[row][col] == self.EMPTY:
-                        self.board[row][col] = self.ai  # AI move
-                        score = self.minimax(depth - 1, alpha, beta, False)
-                        self.board[row][col] = self.EMPTY  # Undo move
-                        best_score = max(best_score, score)
-
-                        alpha = max(alpha, score)
-                        if beta <= alpha:
-                            break
+            for row, col in self.empty_cells():
+                self.board[row][col] = self.ai  # AI move
+                score = self.minimax(depth - 1, alpha, beta, False)
+                self.board[row][col] = self.EMPTY  # Undo move
+                best_score = max(best_score, score)
+
+                alpha = max(alpha, score)
+                if beta <= alpha:
+                    break
 
             return best_score
 
         else:
             best_score = math.inf
-            for col in range(self.cols):
-                for row in range(self.rows-1, -1, -1):
-                    if self.board[row][col] == self.EMPTY:
-                        self.board[row][col] = self.human  # Human move
-                        score = self.minimax(depth - 1, alpha, beta, True)
-                        self.board[row][col] = self.EMPTY  # Undo move
-                        best_score = min(best_score, score)
-
-                        beta = min(beta, score)
-                        if beta <= alpha:
-                            break
+            for row, col in self.empty_cells():
+                self.board[row][col] = self.human  # Human move
+                score = self.minimax(depth - 1, alpha, beta, True)
+                self.board[row][col] = self.EMPTY  # Undo move
+                best_score = min(best_score, score)
+
+                beta = min(beta, score)
+                if beta <= alpha:
+                    break
 
             return best_score
 
+    def empty_cells(self):
+        """All the empty cells, as one flat sequence so that pruning stops the whole loop."""
+        return [(row, col) for col in range(self.cols)
+                for row in range(self.rows-1, -1, -1) if self.board[row][col] == self.EMPTY]
+
     def find_and_place_best_move(self, depth=4):
         """Find the best move."""
+        if self.connect:
+            col, score, reached = self.engine.search(self.time_budget)
+            logger.debug(
+                f"[BOT]: {self.game_id} column {col} scored {score} at depth {reached} ({self.engine.nodes} nodes)")
+
+            self.make_move_req(self.game_id, col)
+            return [self.rows - 1 - sum(self.board[row][col] != self.EMPTY for row in range(self.rows)), col]
+
+        if self.table:
+            cells = [ttt_table.MINE if cell == self.ai else ttt_table.THEIRS if cell == self.human else ttt_table.EMPTY
+                     for row in self.board for cell in row]
+            move = self.table.best_move(cells)
+            if move is not None:
+                best_move = [move // self.cols, move % self.cols]
+                self.make_move_req(self.game_id, best_move)
+                return best_move
+
         best_value = -math.inf
         best_move = [-1, -1]
-        for col in range(self.cols):
-            for row in range(self.rows-1, -1, -1):
-                if self.board[row][col] == self.EMPTY:
+        for row, col in self.empty_cells():
+            self.board[row][col] = self.ai  # AI move
+            move_value = self.minimax(
+                depth - 1, -math.inf, math.inf, False)
 
-                    self.board[row][col] = self.ai  # AI move
-                    move_value = self.minimax(
-                        depth - 1, -math.inf, math.inf, False)
+            self.board[row][col] = self.EMPTY  # Undo move
 
-                    self.board[row][col] = self.EMPTY  # Undo move
+            # logger.info(f"{best_value},{move_value}")
+            if move_value > best_value:
+                best_value = move_value
+                best_move = [row, col]
 
-                    # logger.info(f"{best_value},{move_value}")
-                    if move_value > best_value:
-                        best_value = move_value
-                        best_move = [row, col]
-
-                    if self.connect:
-                        break
-
-        self.make_move_req(
-            self.game_id, best_move[1] if self.connect else best_move)
+        self.make_move_req(self.game_id, best_move)
 
         return best_move
 
-    def make_move(self, row, col, player):
-        """Make a move on the board. In Connect 4, moves follow gravity."""
+    def make_move(self, row, col, player, respond=True):
+        """
+        Make a move on the board. In Connect 4, moves follow gravity. Without
+        respond the AI doesn't answer it, for the move that ends the game.
+        """
         if self.connect:
             # For Connect 4, move to the lowest possible row in the column
             for i in range(self.rows - 1, -1, -1):
                 if self.board[i][col] == self.EMPTY:
                     self.board[i][col] = player
                     break
+            if self.engine:
+                self.engine.play(col)
+            self.history.append(col)
 
         else:
             # For Tic-Tac-Toe
@@ -173,9 +217,16 @@ class BoardGame:
         self.turn = self.ai if player == self.human else self.human
 
         # if it's the ai's turn make the best move
-        if self.turn == self.ai:
-            self.find_and_place_best_move()
+        if respond and self.turn == self.ai:
+            self.request_move()
 
     def game_over_protocol(self, indices, winner_id, *args):
         """Handle end-of-game protocol."""
         logger.debug(f"[BOT]: GAME OVER {winner_id} won!")
+
+        if self.pool and self.connect:
+            self.pool.forget(self.game_id, self.start)
+
+        if self.connect and self.record:
+            opening_book.record_game(
+                self.rows, self.cols, self.win_condition, self.history, self.ai_first)
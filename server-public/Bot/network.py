@@ -3,8 +3,12 @@ import pickle
 import struct
 import math
 from logger import logger
+from framing import FrameReader, HEADER_V2
+from codec import codecs
 
 DEFAULT_BYTES = 1024  # Maximum bytes to be sent in one message
+PROTOCOL_VERSION = 2  # Newest wire protocol the bot can speak
+CODEC = "pickle"  # Codec the bot asks the server to use, "binary" is smaller but slower
 
 
 class Network:
@@ -29,6 +33,10 @@ class Network:
         )
 
         self.id = None  # Initialize the client ID as None
+        self.reader = FrameReader(self.client)  # Assembles incoming frames
+        self.protocol = 1  # Upgraded once the server acknowledges protocol 2
+        self.pending = None  # A message read early while negotiating
+        self.codec = codecs["pickle"]  # Until the server agrees to CODEC
 
     # Function to connect to the server
     def connect(self):
@@ -41,7 +49,12 @@ class Network:
             self.id = data  # The first element in the data is the client ID
 
             # Send metadata about the bot
-            self.send({"updated": {"bot": True, "username": "SlUgGyFrOgS"}})
+            self.send({
+                "updated": {"bot": True, "username": "SlUgGyFrOgS"},
+                "protocol": PROTOCOL_VERSION,
+                "codec": CODEC,
+            })
+            self.negotiate()
 
             return data
         except Exception as e:
@@ -49,12 +62,26 @@ class Network:
             logger.warning(f"Error while trying to connect: {e}")
             return False
 
+    # Switch protocols if the server acknowledged the one we asked for
+    def negotiate(self):
+        reply = self.recv()
+        if isinstance(reply, dict) and reply.get("protocol"):
+            self.protocol = self.reader.protocol = reply["protocol"]
+            self.codec = codecs[reply.get("codec", "pickle")]
+        else:
+            self.pending = reply  # An older server, this is a real message
+
     # Send data to the server
     def send(self, data, pickle_data=True):
         try:
-            # Pickle the data if specified
+            # Encode the data if specified
             if pickle_data:
-                data = pickle.dumps(data)
+                data = self.codec.dumps(data)
+
+            # Protocol 2 sends everything as one length prefixed frame
+            if self.protocol >= 2:
+                self.client.sendall(HEADER_V2.pack(len(data)) + data)
+                return True
 
             # Send large data in batches
             if len(data) >= DEFAULT_BYTES:
@@ -71,44 +98,20 @@ class Network:
 
     # Receive data from the server
     def recv(self, load=True):
-        data = None
+        if self.pending is not None:
+            data, self.pending = self.pending, None
+            return data
+
         try:
-            # Receive the length of the data
-            lenData = self.client.recv(2)
-            if not lenData:
+            # The reader waits for whole frames and joins huge messages
+            data = self.reader.read_data()
+            if data is None:
                 return ""  # Server might be down
 
-            # Unpack the length of the data
-            lenData = struct.unpack("h", lenData)[0]
-            data = self.client.recv(lenData)
-
-            try:
-                # Unpickle data and handle large data in batches
-                pickled = pickle.loads(data)
-                if isinstance(pickled, dict) and pickled.get("message_type") == "huge":
-                    n_batches = pickled["n_batches"]
-                    binData = b""
-                    batch_sizes = struct.unpack(
-                        "h" * n_batches, self.client.recv(2 * n_batches)
-                    )
-                    for size in batch_sizes:
-                        batchData = self.client.recv(size)
-
-                        if not batchData:
-                            return ""  # Server might be down
-
-                        binData += batchData
-
-                    return binData
-
-            except Exception as e:
-                logger.error(f"Error while trying to get huge data: {e}")
-
-            return pickle.loads(data) if load else data
+            return self.codec.loads(data) if load else data
 
         except Exception as e:
             logger.error(f"Error while receiving: {e}")
-            # print(data)
             return False
 
     def send_huge(self, data_bytes):
@@ -121,7 +124,8 @@ class Network:
         fmt = "h" * n_batches
 
         # Send the metadata about the large message
-        self.send({"message_type": "huge", "n_batches": n_batches})
+        self.send(pickle.dumps(
+            {"message_type": "huge", "n_batches": n_batches}), pickle_data=False)
 
         # Send batch lengths and data in batches
         self.client.sendall(struct.pack(fmt, *batch_lengths))
@@ -0,0 +1,244 @@
+import os
+import sys
+import json
+import mmap
+import time
+import struct
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from logger import logger
+import bitboard
+from connect4_engine import Connect4Engine
+
+MAGIC = b"C4BK"
+HEADER = struct.Struct("<4sIIII")  # Magic, rows, cols, win condition, number of records
+RECORD = struct.Struct("<QB")  # Position key, best column
+
+BOT_DIR = os.path.dirname(os.path.abspath(__file__))
+BOOK_PATH = os.path.join(BOT_DIR, "connect4.book")
+RECORDED_GAMES_PATH = os.path.join(BOT_DIR, "recorded_games.jsonl")
+MAX_RECORDED_BYTES = 4 * 1024 * 1024  # Past this the recorded games move to a .1 file, replacing the older one
+
+
+class Position:
+    """Just enough of a Connect Four board to work out its book key."""
+
+    def __init__(self, rows, cols, history=()):
+        self.rows, self.cols = rows, cols
+        self.height = rows + 1
+        self.position = self.mask = self.moves = 0
+        for col in history:
+            self.play(col)
+
+    def can_play(self, col):
+        return not self.mask & (1 << (col * self.height + self.rows - 1))
+
+    def play(self, col):
+        self.position ^= self.mask
+        self.mask |= self.mask + (1 << (col * self.height))
+        self.moves += 1
+
+    def mirrored(self, bits):
+        column = (1 << self.height) - 1
+        return sum(((bits >> (col * self.height)) & column) << ((self.cols - 1 - col) * self.height)
+                   for col in range(self.cols))
+
+    def key(self):
+        """
+        The key of the position and whether it's the mirror image that has it.
+
+        position + mask sets one bit per column above the pieces of the player
+        to move, which pins down the whole position. A position and its mirror
+        image share the smaller of their two keys.
+        """
+        key = self.position + self.mask
+        mirror = self.mirrored(self.position) + self.mirrored(self.mask)
+        return (mirror, True) if mirror < key else (key, False)
+
+
+class OpeningBook:
+    """Best replies for the first plies of Connect Four, read straight from a memory mapped file."""
+
+    def __init__(self, path=BOOK_PATH):
+        self.file = open(path, "rb")
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.rows, self.cols, self.win_condition, self.count = HEADER.unpack_from(self.data)
+        if magic != MAGIC or len(self.data) != HEADER.size + self.count * RECORD.size:
+            raise ValueError(f"{path} is not an opening book")
+
+    def matches(self, rows, cols, win_condition):
+        return (rows, cols, win_condition) == (self.rows, self.cols, self.win_condition)
+
+    def find(self, key):
+        # Binary search over the sorted records
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            record_key, col = RECORD.unpack_from(
+                self.data, HEADER.size + middle * RECORD.size)
+            if record_key == key:
+                return col
+            if record_key < key:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def lookup(self, history):
+        """Best column after the columns in history, or None if the book doesn't have it."""
+        key, mirrored = Position(self.rows, self.cols, history).key()
+        col = self.find(key)
+        if col is None:
+            return None
+        return self.cols - 1 - col if mirrored else col
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+
+# The book at path, or None if there isn't a usable one
+def load(path=BOOK_PATH):
+    try:
+        return OpeningBook(path)
+    except (OSError, ValueError) as e:
+        logger.debug(f"[BOT]: No opening book: {e}")
+        return None
+
+
+# One history for every position with fewer than plies pieces, mirrors left
+# out, skipping positions where the game is already over
+def book_positions(rows, cols, win_condition, plies):
+    seen = set()
+    histories = []
+    frontier = [[]]
+    for ply in range(plies):
+        next_frontier = []
+        for history in frontier:
+            position = Position(rows, cols, history)
+            key, _ = position.key()
+            if key in seen:
+                continue
+            seen.add(key)
+            histories.append(history)
+            if ply == plies - 1:
+                continue  # Children of the last ply aren't booked
+
+            for col in range(cols):
+                if position.can_play(col):
+                    child = Position(rows, cols, history + [col])
+                    if not bitboard.has_won(child.position ^ child.mask, rows, win_condition):
+                        next_frontier.append(history + [col])
+        frontier = next_frontier
+    return histories
+
+
+# Runs in the generator's worker processes
+def best_reply(rows, cols, win_condition, history, depth):
+    engine = Connect4Engine(rows, cols, win_condition)
+    for col in history:
+        engine.play(col)
+    _, col = engine.score(depth)
+    if col is None:  # Every move loses, any one will do
+        col = next(col for col in engine.order if engine.can_play(col))
+    return history, col
+
+
+def build(path, rows, cols, win_condition, plies, depth, workers):
+    if cols * (rows + 1) > 64:
+        sys.exit("Positions on boards this big don't fit in a 64 bit key")
+
+    histories = book_positions(rows, cols, win_condition, plies)
+    print(f"Searching {len(histories)} positions {depth} plies deep")
+
+    records = {}
+    start = time.perf_counter()
+    with ProcessPoolExecutor(workers) as executor:
+        futures = [executor.submit(best_reply, rows, cols, win_condition, history, depth)
+                   for history in histories]
+        for done, future in enumerate(futures, 1):
+            history, col = future.result()
+            key, mirrored = Position(rows, cols, history).key()
+            records[key] = cols - 1 - col if mirrored else col
+            if done % 100 == 0:
+                print(f"{done}/{len(futures)} positions, {time.perf_counter() - start:.0f}s")
+
+    # Written to a temporary file first, so a running bot never maps half a book
+    with open(path + ".tmp", "wb") as f:
+        f.write(HEADER.pack(MAGIC, rows, cols, win_condition, len(records)))
+        for key in sorted(records):
+            f.write(RECORD.pack(key, records[key]))
+    os.replace(path + ".tmp", path)
+
+    print(f"Wrote {len(records)} positions to {path} in {time.perf_counter() - start:.0f}s")
+
+
+# Append a finished game to the recorded games, for measuring the book later,
+# with whether the bot made the first move
+def record_game(rows, cols, win_condition, history, bot_first, path=RECORDED_GAMES_PATH):
+    try:
+        if os.path.exists(path) and os.path.getsize(path) >= MAX_RECORDED_BYTES:
+            os.replace(path, path + ".1")
+        with open(path, "a") as f:
+            f.write(json.dumps({"rows": rows, "cols": cols, "win_condition": win_condition,
+                    "history": history, "bot_first": bot_first}) + "\n")
+    except OSError as e:
+        logger.warning(f"[BOT]: Could not record game: {e}")
+
+
+def hit_rate(path, games_path):
+    book = load(path)
+    if not book:
+        sys.exit(f"No opening book at {path}")
+
+    hits, lookups = {}, {}
+    with open(games_path) as f:
+        for line in f:
+            game = json.loads(line)
+            # Games recorded before bot_first can't tell whose moves were whose
+            if "bot_first" not in game or not book.matches(
+                    game["rows"], game["cols"], game["win_condition"]):
+                continue
+
+            # Only the positions the bot looked up, where it was to move
+            history = game["history"]
+            for ply in range(0 if game["bot_first"] else 1, len(history), 2):
+                lookups[ply] = lookups.get(ply, 0) + 1
+                if book.lookup(history[:ply]) is not None:
+                    hits[ply] = hits.get(ply, 0) + 1
+
+    total = sum(lookups.values())
+    if not total:
+        sys.exit("No recorded games for this board size")
+
+    for ply in sorted(lookups):
+        if ply in hits:
+            print(f"ply {ply:>2}: {hits[ply]:>6}/{lookups[ply]:<6} {hits[ply] / lookups[ply]:7.1%}")
+    print(f"overall: {sum(hits.values())}/{total} positions were in the book "
+          f"({sum(hits.values()) / total:.1%})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build and measure the Connect Four opening book")
+    parser.add_argument("--book", default=BOOK_PATH)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = commands.add_parser("build", help="search the opening positions and write the book")
+    build_parser.add_argument("--rows", type=int, default=6)
+    build_parser.add_argument("--cols", type=int, default=7)
+    build_parser.add_argument("--win", type=int, default=4)
+    build_parser.add_argument("--plies", type=int, default=4,
+                              help="book every position with fewer pieces than this")
+    build_parser.add_argument("--depth", type=int, default=8,
+                              help="plies to search each position")
+    build_parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+
+    hit_parser = commands.add_parser("hitrate", help="how many positions of recorded games the book has")
+    hit_parser.add_argument("--games", default=RECORDED_GAMES_PATH)
+
+    args = parser.parse_args()
+    if args.command == "build":
+        build(args.book, args.rows, args.cols, args.win, args.plies, args.depth, args.workers)
+    else:
+        hit_rate(args.book, args.games)
@@ -0,0 +1,56 @@
+from connect4_engine import Connect4Engine, WIN
+
+CHILD_TABLE_BITS = 16  # Every root move is searched with a table of its own
+
+
+# Score of a position for the player to move, searched in a worker process.
+# A fresh engine every time, so the result only depends on the arguments
+def child_score(rows, cols, win_condition, history, depth, alpha, beta):
+    engine = Connect4Engine(rows, cols, win_condition,
+                            table_bits=CHILD_TABLE_BITS)
+    for col in history:
+        engine.play(col)
+
+    score, _ = engine.score(depth, alpha, beta)
+    return score, engine.nodes
+
+
+def root_split(executor, rows, cols, win_condition, history, depth):
+    """
+    Best column after the moves in history, searched depth plies deep with the
+    root moves split across the processes of executor.
+
+    The center move is searched first, and its score bounds the searches of the
+    other moves, which then run in parallel. Neither step depends on timing or
+    on what is left in any table, so the same position and depth always give
+    the same move. Returns the column, its score and the nodes searched.
+    """
+    engine = Connect4Engine(rows, cols, win_condition, table_bits=10)
+    for col in history:
+        engine.play(col)
+
+    # Wins, forced blocks and shallow searches aren't worth splitting
+    score, col = engine.score(min(depth, 1))
+    moves = [col for col in engine.order if engine.can_play(col)]
+    if depth <= 1 or len(moves) == 1 or abs(score) > WIN - engine.size - 1:
+        if depth > 1:
+            score, col = engine.score(depth)
+        return (col if col is not None else moves[0]), score, engine.nodes
+
+    def submit(col, beta):
+        return executor.submit(child_score, rows, cols, win_condition,
+                               history + [col], depth - 1, -WIN - 1, beta)
+
+    first_score, nodes = submit(moves[0], WIN + 1).result()
+    best_col, best_score = moves[0], -first_score
+
+    # The rest only matter if they beat the first move, so their searches
+    # can cut off as soon as they can't
+    futures = [(col, submit(col, -best_score)) for col in moves[1:]]
+    for col, future in futures:  # Ties go to the more central move
+        child, child_nodes = future.result()
+        nodes += child_nodes
+        if -child > best_score:
+            best_col, best_score = col, -child
+
+    return best_col, best_score, nodes
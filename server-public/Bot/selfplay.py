@@ -0,0 +1,229 @@
+import os
+import sys
+import abc
+import time
+import random
+import logging
+import argparse
+import importlib.util
+from games_logic import BoardGame
+from utilities import TTT_Board, Connect4_Board
+from connect4_engine import DEFAULT_BUDGET_MS
+from logger import logger
+
+try:
+    import resource
+except ImportError:  # Only there on Unix
+    resource = None
+
+# The server's games_logic has the same name as the bot's, so it is loaded
+# from its path. Its other imports come from server-public
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(SERVER_DIR)
+spec = importlib.util.spec_from_file_location(
+    "server_games_logic", os.path.join(SERVER_DIR, "games_logic.py"))
+server_games_logic = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(server_games_logic)
+
+LOGIC = {"tic_tac_toe": server_games_logic.TTTLogic,
+         "connect4": server_games_logic.ConnectLogic}
+
+
+class Player(abc.ABC):
+    """Plays one side of a game through the same calls the bot makes for real."""
+
+    def __init__(self, move_time):
+        self.move_time = move_time
+        self.latencies = []  # Seconds taken to come up with each move
+        self.nodes = 0
+        self.search_time = 0
+
+    def start(self, logic, game, my_id, opp_id):
+        self.logic, self.game, self.my_id, self.opp_id = logic, game, my_id, opp_id
+
+    @abc.abstractmethod
+    def choose(self):
+        """The move to make, once it's this player's turn."""
+
+    def observe(self, moved):
+        pass
+
+
+class RandomPlayer(Player):
+    def choose(self):
+        start = time.perf_counter()
+        if self.game == "connect4":
+            move = random.choice([col for col in range(self.logic.cols)
+                                  if self.logic.make_move(col, False)])
+        else:
+            move = random.choice([(row, col) for row in range(self.logic.rows)
+                                  for col in range(self.logic.cols) if self.logic.board[row][col] is None])
+        self.latencies.append(time.perf_counter() - start)
+        return move
+
+
+class BoardGamePlayer(Player):
+    """The bot's BoardGame, searching inline."""
+
+    def start(self, logic, game, my_id, opp_id):
+        super().start(logic, game, my_id, opp_id)
+        self.moves = []
+        self.timed(lambda: setattr(self, "board", BoardGame(
+            "selfplay", my_id, opp_id, logic.turn_id, self.request, logic.rows, logic.cols,
+            logic.win_condition, connect=game == "connect4", time_budget=self.move_time)))
+
+    def request(self, game_id, move):
+        self.moves.append(move)
+
+    def timed(self, fn):
+        # The board searches as soon as it's its turn, which is when this returns
+        start = time.perf_counter()
+        fn()
+        if self.moves:
+            took = time.perf_counter() - start
+            self.latencies.append(took)
+            engine = getattr(self.board, "engine", None)
+            if engine and engine.nodes:
+                self.nodes += engine.nodes
+                self.search_time += took
+
+    def choose(self):
+        move = self.moves.pop()
+        return move if self.game == "connect4" else tuple(move)
+
+    def observe(self, moved):
+        self.timed(lambda: self.board.make_move(
+            moved["to"][0], moved["to"][1], moved["who"]))
+
+
+class TTTBoardPlayer(Player):
+    """The older TTT_Board from utilities, which takes cells as flat indices."""
+
+    def start(self, logic, game, my_id, opp_id):
+        super().start(logic, game, my_id, opp_id)
+        self.moves = []
+        x_id, o_id = logic.X_id, logic.O_id
+        self.timed(lambda: setattr(self, "board", TTT_Board(
+            "selfplay", my_id, x_id, o_id, self.request, logic.turn_id, logic.rows, logic.cols)))
+
+    def request(self, game_id, index):
+        self.moves.append(divmod(index, self.logic.cols))
+
+    def timed(self, fn):
+        start = time.perf_counter()
+        fn()
+        if self.moves:
+            self.latencies.append(time.perf_counter() - start)
+
+    def choose(self):
+        return self.moves.pop()
+
+    def observe(self, moved):
+        row, col = moved["to"]
+        self.timed(lambda: self.board.place({
+            "to": row * self.logic.cols + col,
+            "turn_string": moved["turn_string"],
+            "turn_id": moved["turn_id"],
+        }))
+
+
+class Connect4BoardPlayer(Player):
+    """The older Connect4_Board from utilities, driven directly since its turn tracking never updates."""
+
+    def start(self, logic, game, my_id, opp_id):
+        super().start(logic, game, my_id, opp_id)
+        self.moves = []
+        self.board = Connect4_Board("selfplay", my_id, logic.red_id, logic.blue_id,
+                                    self.request, opp_id, logic.rows, logic.cols)
+
+    def request(self, game_id, col):
+        self.moves.append(col)
+
+    def choose(self):
+        start = time.perf_counter()
+        self.board.move()
+        self.latencies.append(time.perf_counter() - start)
+        return self.moves.pop()
+
+    def observe(self, moved):
+        row, col = moved["to"]
+        self.board.board[row][col] = moved["turn_string"]
+
+
+PLAYERS = {
+    "random": RandomPlayer,
+    "board_game": BoardGamePlayer,
+    "ttt_board": TTTBoardPlayer,
+    "connect4_board": Connect4BoardPlayer,
+}
+
+
+def play(game, players):
+    """Play one game to the end, returns the winner's id or None for a tie."""
+    logic = LOGIC[game]({"id": "player1"}, {"id": "player2"})
+    players["player1"].start(logic, game, "player1", "player2")
+    players["player2"].start(logic, game, "player2", "player1")
+
+    while True:
+        move = players[logic.turn_id].choose()
+        valid, err = logic.validate(logic.turn_id, move)
+        if not valid:
+            raise RuntimeError(f"{logic.turn_id} made a bad move {move}: {err}")
+
+        # Like the bot, players don't see the move that ends the game
+        game_over, r = logic.move(move)
+        if game_over:
+            return game_over["winner_id"]
+
+        for player in players.values():
+            player.observe(r["moved"])
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)] if values else 0
+
+
+def main(game, n_games, names, move_time, seed):
+    logger.setLevel(logging.WARNING)  # The bot logs every move it makes
+    random.seed(seed)
+    players = {"player1": PLAYERS[names[0]](move_time),
+               "player2": PLAYERS[names[1]](move_time)}
+    wins = {"player1": 0, "player2": 0, None: 0}
+
+    start = time.perf_counter()
+    for _ in range(n_games):
+        wins[play(game, players)] += 1
+    elapsed = time.perf_counter() - start
+
+    print(f"{n_games} games of {game} in {elapsed:.1f}s")
+    print(f"{'player':<24}{'wins':>8}{'moves':>8}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}{'nodes/s':>10}")
+    for player_id, name in zip(players, names):
+        player = players[player_id]
+        ms = [latency * 1000 for latency in player.latencies]
+        nodes_per_second = player.nodes / player.search_time if player.search_time else 0
+        print(f"{player_id + ' (' + name + ')':<24}{wins[player_id] / n_games:>8.1%}{len(ms):>8}"
+              f"{percentile(ms, .5):>10.2f}{percentile(ms, .9):>10.2f}{percentile(ms, .99):>10.2f}"
+              f"{max(ms, default=0):>10.2f}{nodes_per_second:>10.0f}")
+    print(f"{'ties':<24}{wins[None] / n_games:>8.1%}")
+
+    if resource:
+        # Kilobytes on Linux, bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak_mb = peak / 1024 / (1024 if sys.platform == "darwin" else 1)
+        print(f"peak memory {peak_mb:.1f} MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Play the bot's engines against each other without a server or pygame")
+    parser.add_argument("--game", choices=LOGIC, default="connect4")
+    parser.add_argument("--games", type=int, default=100)
+    parser.add_argument("--player1", choices=PLAYERS, default="board_game")
+    parser.add_argument("--player2", choices=PLAYERS, default="random")
+    parser.add_argument("--move-time", type=int, default=DEFAULT_BUDGET_MS,
+                        help="milliseconds the bot searches each Connect Four move")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    main(args.game, args.games, [args.player1, args.player2], args.move_time, args.seed)
@@ -0,0 +1,201 @@
+import os
+import sys
+import time
+import argparse
+from array import array
+from logger import logger
+
+# Boards with more cells than this take too long to solve up front
+MAX_CELLS = 12
+
+# Cells are EMPTY, taken by the player to move, or taken by their opponent
+EMPTY, MINE, THEIRS = range(3)
+
+
+# Cell permutations that map the board onto itself, as lists where the piece
+# in cell i goes to cell perm[i]. Square boards have 8, the others 4
+def symmetries(rows, cols):
+    def index(r, c):
+        return r * cols + c
+
+    perms = []
+    for flip_rows in (False, True):
+        for flip_cols in (False, True):
+            perm = [0] * (rows * cols)
+            for r in range(rows):
+                for c in range(cols):
+                    perm[index(r, c)] = index(
+                        rows - 1 - r if flip_rows else r, cols - 1 - c if flip_cols else c)
+            perms.append(perm)
+
+            if rows == cols:  # Transposed as well
+                perms.append([perm[index(c, r)] for r in range(rows)
+                              for c in range(cols)])
+
+    return perms
+
+
+# Every line of win_condition cells on the board
+def win_lines(rows, cols, win_condition):
+    lines = []
+    for r in range(rows):
+        for c in range(cols):
+            for d_r, d_c in ((0, 1), (1, 0), (1, 1), (1, -1)):
+                end_r, end_c = r + d_r * (win_condition - 1), c + d_c * (win_condition - 1)
+                if 0 <= end_r < rows and 0 <= end_c < cols:
+                    lines.append([(r + d_r * i) * cols + c + d_c * i
+                                  for i in range(win_condition)])
+    return lines
+
+
+class TTTTable:
+    """
+    Best move of every reachable tic tac toe position, solved once.
+
+    Positions are stored in the orientation with the smallest key, so each
+    entry also covers its rotations and reflections. Looking a move up is
+    a dictionary access plus mapping the move back onto the real board.
+    """
+
+    def __init__(self, rows=3, cols=3, win_condition=None, moves=None):
+        self.rows, self.cols = rows, cols
+        self.win_condition = win_condition or min(rows, cols)
+        self.size = rows * cols
+        self.perms = symmetries(rows, cols)
+        self.lines = win_lines(rows, cols, self.win_condition)
+        self.powers = [3 ** i for i in range(self.size)]
+
+        self.moves = moves if moves is not None else {}  # Canonical key -> best cell
+        if moves is None:
+            self.solve()
+
+    def key(self, cells):
+        return sum(cell * power for cell, power in zip(cells, self.powers))
+
+    def canonical(self, cells):
+        """Smallest key among the symmetries of the board, and the permutation giving it."""
+        best_key, best_perm = None, None
+        for perm in self.perms:
+            moved = [EMPTY] * self.size
+            for i, cell in enumerate(cells):
+                moved[perm[i]] = cell
+            key = self.key(moved)
+            if best_key is None or key < best_key:
+                best_key, best_perm = key, perm
+        return best_key, best_perm
+
+    def won(self, cells, player):
+        return any(all(cells[i] == player for i in line) for line in self.lines)
+
+    def solve(self):
+        """Solve every position reachable from the empty board."""
+        scores = {}
+
+        # Score for the player to move: positive wins, sooner is better
+        def negamax(cells, empty):
+            key, perm = self.canonical(cells)
+            if key in scores:
+                return scores[key]
+
+            best_score, best_cell = -self.size - 2, None
+            for cell in range(self.size):
+                if cells[cell] != EMPTY:
+                    continue
+
+                cells[cell] = MINE
+                if self.won(cells, MINE):
+                    score = empty
+                elif empty == 1:
+                    score = 0
+                else:
+                    # Swap sides so the opponent is the one to move
+                    swapped = [(MINE + THEIRS) - c if c else EMPTY for c in cells]
+                    score = -negamax(swapped, empty - 1)
+                cells[cell] = EMPTY
+
+                if score > best_score:
+                    best_score, best_cell = score, cell
+
+            scores[key] = best_score
+            self.moves[key] = perm[best_cell]  # Kept in the canonical orientation
+            return best_score
+
+        negamax([EMPTY] * self.size, self.size)
+
+    def best_move(self, cells):
+        """Best cell index for the player to move, cells hold EMPTY, MINE and THEIRS."""
+        key, perm = self.canonical(cells)
+        move = self.moves.get(key)
+        if move is None:
+            return None
+        return perm.index(move)
+
+    def save(self, path):
+        keys = array("Q", sorted(self.moves))
+        moves = array("B", (self.moves[key] for key in keys))
+        with open(path, "wb") as f:
+            array("I", [self.rows, self.cols, self.win_condition, len(keys)]).tofile(f)
+            keys.tofile(f)
+            moves.tofile(f)
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, "rb") as f:
+            header = array("I")
+            header.fromfile(f, 4)
+            rows, cols, win_condition, count = header
+            keys, moves = array("Q"), array("B")
+            keys.fromfile(f, count)
+            moves.fromfile(f, count)
+        return cls(rows, cols, win_condition, dict(zip(keys, moves)))
+
+
+def table_path(rows, cols, win_condition):
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        f"ttt_{rows}x{cols}_{win_condition}.table")
+
+
+_tables = {}
+
+
+# The table for a board size, read from its cached file or solved and cached.
+# None for boards too big to solve
+def load(rows=3, cols=3, win_condition=None):
+    win_condition = win_condition or min(rows, cols)
+    key = (rows, cols, win_condition)
+    if key in _tables:
+        return _tables[key]
+
+    table = None
+    if rows * cols <= MAX_CELLS:
+        path = table_path(*key)
+        try:
+            table = TTTTable.from_file(path)
+        except (OSError, EOFError, ValueError):
+            table = TTTTable(*key)
+            try:
+                table.save(path)
+            except OSError as e:
+                logger.warning(f"Could not cache tic tac toe table: {e}")
+
+    _tables[key] = table
+    return table
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Solve tic tac toe for a board size and cache the table")
+    parser.add_argument("--rows", type=int, default=3)
+    parser.add_argument("--cols", type=int, default=3)
+    parser.add_argument("--win", type=int, default=None,
+                        help="pieces in a row needed to win, defaults to the shorter side")
+    args = parser.parse_args()
+
+    if args.rows * args.cols > 16:
+        sys.exit("Boards above 16 cells can't be solved in reasonable time")
+
+    start = time.perf_counter()
+    table = TTTTable(args.rows, args.cols, args.win)
+    path = table_path(args.rows, args.cols, table.win_condition)
+    table.save(path)
+    print(f"Solved {len(table.moves)} positions in {time.perf_counter() - start:.2f}s, saved to {path}")
@@ -1,4 +1,5 @@
 import random
+import ttt_table
 from logger import logger
 
 # Class to represent the Tic Tac Toe board
@@ -23,6 +24,7 @@ class TTT_Board:
         self.board = []
         self.move_req = move
         self.scores = {self.user_text: 1, self.opp_text: -1, "tie": 0}
+        self.table = ttt_table.load(rows, cols)
         self.generate_board()
 
         # Make an initial move if it's the current user's turn
@@ -36,25 +38,37 @@ class TTT_Board:
             self.board.append([None] * self.cols)
 
     def move(self):
-        """Determine and make the best move using minimax."""
-        best_score = -float("inf")
-        best_move = None
+        """Determine and make the best move, from the solved table if there is one."""
+        best_move = self.table_move()
 
-        for r in range(self.rows):
-            for c in range(self.cols):
-                if self.board[r][c] is None:
-                    self.board[r][c] = self.user_text
-                    score = self.minimax(0, False, self.opp_text, ["X", "O"])
-                    self.board[r][c] = None
-                    if score > best_score:
-                        best_score = score
-                        best_move = (r, c)
+        if best_move is None:
+            best_score = -float("inf")
+            for r in range(self.rows):
+                for c in range(self.cols):
+                    if self.board[r][c] is None:
+                        self.board[r][c] = self.user_text
+                        score = self.minimax(
+                            0, False, self.opp_text, ["X", "O"])
+                        self.board[r][c] = None
+                        if score > best_score:
+                            best_score = score
+                            best_move = (r, c)
 
         # Request the best move
         self.move_req(self.game_id, self.cols * best_move[0] + best_move[1])
         self.turn = self.opp_text
         self.turn_id = self.opp_id
 
+    def table_move(self):
+        """Best (row, col) from the solved table, or None if there's no table."""
+        if not self.table:
+            return None
+
+        cells = [ttt_table.MINE if cell == self.user_text else ttt_table.THEIRS if cell == self.opp_text else ttt_table.EMPTY
+                 for row in self.board for cell in row]
+        move = self.table.best_move(cells)
+        return None if move is None else divmod(move, self.cols)
+
     def place(self, data):
         """Place a move on the board."""
         id = data["to"]
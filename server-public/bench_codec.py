@@ -0,0 +1,126 @@
+import argparse
+import random
+import timeit
+from codec import codecs
+from constants import USER_COLORS
+from games_logic import TTTLogic, ConnectLogic
+
+
+# Stats of a user, as the server keeps them in active_users
+def make_user(user_id):
+    return {
+        "id": user_id,
+        "username": f"USER#{user_id}",
+        "image": None,
+        "color": random.choice(USER_COLORS),
+        "engaged": False,
+        "challenged": {},
+        "pending": {},
+        "game": None,
+        "bot": False,
+    }
+
+
+# One example of every kind of message the server sends
+def sample_messages(n_users):
+    player1, player2 = make_user("1"), make_user("2")
+    game_id = "1-2-connect4"
+
+    def new_game(game, board):
+        return {
+            "new_game": {
+                "players": {"1": player1, "2": player2},
+                "game": game,
+                "identification_dict": board.get_identification_dict(),
+                "details": {"game_id": game_id, "board": board},
+            },
+            "message": {"id": game_id, "title": "Game started.", "text": "Have fun!"},
+        }
+
+    return {
+        "connected": {"connected": make_user("17")},
+        "disconnected": {"disconnected": "17"},
+        "challenge": {
+            "message": {
+                "title": "Challenge from USER#1: connect4",
+                "buttons": ["accept", "reject"],
+                "context": {"challenger_id": "1", "game": "connect4"},
+                "closeable": False,
+                "id": game_id,
+            },
+            "challenge": {"challenger_id": "1", "game": "connect4"},
+        },
+        "moved": {
+            "moved": {
+                "who": "1",
+                "to": (5, 3),
+                "turn_string": "red",
+                "turn_id": "2",
+                "game_id": game_id,
+            }
+        },
+        "game_over": {
+            "moved": {
+                "who": "1",
+                "to": (2, 3),
+                "turn_string": "red",
+                "turn_id": "2",
+                "game_id": game_id,
+            },
+            "game_over": {
+                "game_id": game_id,
+                "winner_id": "1",
+                "indices": [(5, 3), (4, 3), (3, 3), (2, 3)],
+            },
+        },
+        "updated": {"updated": {"user_id": "1", "changed": {"username": "Sluggy"}}},
+        "image": {
+            "image": {
+                "size": 256 * 256 * 3,
+                "user_id": "1",
+                "shape": (256, 256, 3),
+                "dtype": "uint8",
+            }
+        },
+        "new_game (tic_tac_toe)": new_game("tic_tac_toe", TTTLogic(player1, player2)),
+        "new_game (connect4)": new_game("connect4", ConnectLogic(player1, player2)),
+        f"active_users ({n_users})": {
+            str(i): make_user(str(i)) for i in range(n_users)
+        },
+    }
+
+
+# Time encoding and decoding one message with one codec, in microseconds
+def measure(codec, message, iterations):
+    encoded = codec.dumps(message)
+    encode_time = timeit.timeit(
+        lambda: codec.dumps(message), number=iterations)
+    decode_time = timeit.timeit(
+        lambda: codec.loads(encoded), number=iterations)
+
+    return len(encoded), encode_time / iterations * 1e6, decode_time / iterations * 1e6
+
+
+def main(iterations, n_users):
+    names = list(codecs)
+    print(f"{'message':<24}" + "".join(
+        f"{name + ' bytes':>14}{name + ' enc us':>16}{name + ' dec us':>16}" for name in names))
+
+    for title, message in sample_messages(n_users).items():
+        row = f"{title:<24}"
+        for name in names:
+            size, encode_us, decode_us = measure(
+                codecs[name], message, iterations)
+            row += f"{size:>14}{encode_us:>16.2f}{decode_us:>16.2f}"
+        print(row)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the wire codecs on the messages the server sends")
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--users", type=int, default=100,
+                        help="users in the active_users snapshot")
+    args = parser.parse_args()
+
+    main(args.iterations, args.users)
@@ -0,0 +1,83 @@
+import argparse
+import logging
+import time
+import server
+from codec import codecs
+from logger import logger
+from bench_dispatch import NullQueue
+
+
+class RecordingQueue(NullQueue):
+    """Send queue that keeps the frames, to count their bytes."""
+
+    def __init__(self):
+        self.frames = []
+
+    def append(self, items):
+        self.frames.extend(items)
+
+    def take_bytes(self, codec):
+        size = sum(len(frame.to_bytes(codec, 2)) for frame in self.frames)
+        self.frames = []
+        return size
+
+
+# Fill the lobby straight through the server's state, without telling anyone
+def fill_lobby(n_users, codec):
+    for i in range(n_users):
+        user_id = str(i)
+        user = server.register_user(user_id, None, NullQueue())
+        user["username"] = f"Player {i}"
+        server.user_codecs[user_id] = codec
+        server.directory.connect(user, lambda message, watchers: None)
+
+
+# Bytes queued and seconds taken to build and encode the lobby for a joiner,
+# with the first page of the directory if they're sent pages
+def join(user_id, codec, paged):
+    queue = RecordingQueue()
+    server.register_user(user_id, None, queue)
+    server.user_codecs[user_id] = codec
+    server.protocols[user_id] = 2
+    if paged:
+        server.directory_users.add(user_id)
+
+    start = time.perf_counter()
+    server.send_all_users(user_id)
+    frame = queue.frames[0]
+    size = queue.take_bytes(codec)  # Encoding is part of the time
+    seconds = time.perf_counter() - start
+    return queue, frame.data.get("directory"), size, seconds
+
+
+def main(n_users, codec_name):
+    logger.setLevel(logging.WARNING)
+    codec = codecs[codec_name]
+    fill_lobby(n_users, codec)
+
+    _, _, snapshot_bytes, snapshot_seconds = join("old", codec, paged=False)
+    queue, first_page, page_bytes, page_seconds = join("new", codec, paged=True)
+
+    # Everything is still there for a client that pages all the way through
+    pages, total_bytes = 1, page_bytes
+    page = first_page
+    while page["more"]:
+        server.handle_data("new", {"directory_page": page["next"]})
+        page = queue.frames[-1].data["directory"]
+        pages += 1
+        total_bytes += queue.take_bytes(codec)
+
+    print(f"{n_users} users in the lobby, {codec_name} codec")
+    print(f"whole lobby at once        {snapshot_bytes / 1e3:10.1f} kB {snapshot_seconds * 1000:8.2f} ms")
+    print(f"first page of directory    {page_bytes / 1e3:10.1f} kB {page_seconds * 1000:8.2f} ms")
+    print(f"every page, {pages:5d} pages   {total_bytes / 1e3:10.1f} kB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Bytes and time to send a joiner the lobby, all at once and as directory pages")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--codec", default="binary", choices=sorted(codecs))
+    args = parser.parse_args()
+
+    main(args.users, args.codec)
@@ -0,0 +1,110 @@
+import argparse
+import logging
+import time
+import server
+from codec import codecs
+from logger import logger
+
+# Moves that end a game on the seventh move whoever starts, the first
+# player making every other one
+TTT_MOVES = [(0, 0), (0, 1), (0, 2), (1, 0), (1, 1), (1, 2), (2, 0)]
+CONNECT4_MOVES = [0, 1, 0, 1, 0, 1, 0]
+
+
+class NullQueue:
+    """Send queue that drops everything, only the handling is timed."""
+
+    def append(self, items):
+        pass
+
+    def close(self):
+        pass
+
+    depth = 0
+
+
+# Connect n users straight to the server's state, without sockets
+def connect_users(n_users, codec):
+    for i in range(n_users):
+        user_id = str(i)
+        server.register_user(user_id, None, NullQueue())
+        server.user_codecs[user_id] = codec
+
+
+# Messages from the two players of a whole game, challenge to game over
+def game_messages(codec, game, moves):
+    return {
+        "game_id": f"0-1-{game}",
+        "start": [
+            ("0", codec.dumps({"challenge": ("1", game)})),
+            ("1", codec.dumps({"accepted": {"player1_id": "0", "player2_id": "1", "game": game}})),
+        ],
+        "moves": [codec.dumps({"move": {"game_id": f"0-1-{game}", "move": move}}) for move in moves],
+    }
+
+
+def play_game(messages):
+    for user_id, data in messages["start"]:
+        server.process_frame(user_id, data)
+
+    # The starting player is random, so who sends which move is only known now
+    first = server.games[messages["game_id"]]["details"]["board"].turn_id
+    second = "1" if first == "0" else "0"
+    for i, data in enumerate(messages["moves"]):
+        server.process_frame(first if i % 2 == 0 else second, data)
+
+    return len(messages["start"]) + len(messages["moves"])
+
+
+# Messages per second through the server's handling of one scenario
+def measure(scenario, seconds):
+    handled, start = 0, time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        handled += scenario()
+    return handled / (time.perf_counter() - start)
+
+
+def main(n_users, codec_name, seconds):
+    logger.setLevel(logging.WARNING)  # Logging every message would be all we measured
+    codec = codecs[codec_name]
+    connect_users(n_users, codec)
+
+    unknown = codec.dumps({"ping": True})
+    cancel = [
+        ("0", codec.dumps({"challenge": ("1", "connect4")})),
+        ("0", codec.dumps({"cancel_challenge": {"opp_id": "1", "game": "connect4"}})),
+    ]
+    updated = codec.dumps({"updated": {"username": "Sluggy"}})
+    ttt = game_messages(codec, "tic_tac_toe", TTT_MOVES)
+    connect4 = game_messages(codec, "connect4", CONNECT4_MOVES)
+
+    def run(messages):
+        for user_id, data in messages:
+            server.process_frame(user_id, data)
+        return len(messages)
+
+    scenarios = {
+        "unknown message": lambda: run([("0", unknown)] * 100),
+        "challenge + cancel": lambda: run(cancel),
+        "tic tac toe game": lambda: play_game(ttt),
+        "connect4 game": lambda: play_game(connect4),
+        f"updated ({n_users} users)": lambda: run([("0", updated)]),
+    }
+
+    print(f"{n_users} users, {codec_name} codec")
+    print(f"{'scenario':<28}{'messages/s':>14}{'us/message':>14}")
+    for title, scenario in scenarios.items():
+        rate = measure(scenario, seconds)
+        print(f"{title:<28}{rate:>14.0f}{1e6 / rate:>14.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure how many messages a second the server's handlers get through")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--codec", choices=codecs, default="binary")
+    parser.add_argument("--seconds", type=float, default=2,
+                        help="time to spend on each scenario")
+    args = parser.parse_args()
+
+    main(args.users, args.codec, args.seconds)
@@ -0,0 +1,108 @@
+import argparse
+import logging
+import time
+import numpy as np
+import server
+import images
+from codec import codecs
+from logger import logger
+from bench_dispatch import NullQueue, connect_users
+
+SHAPE = (256, 256, 3)
+PAGE_SIZE = 8  # Users on one page of the lobby
+
+
+# Profile pictures like people pick: some drawn with a few flat colours,
+# some photos with smooth shading and sensor noise
+def avatar(rng, photo):
+    y, x = np.mgrid[0:SHAPE[0], 0:SHAPE[1]]
+    if photo:
+        image = np.stack([
+            (x + y) / 2 + rng.uniform(0, 60),
+            128 + 60 * np.sin(x / rng.uniform(10, 40)) * np.cos(y / rng.uniform(10, 40)),
+            255 - y * rng.uniform(0.3, 1),
+        ], -1) + rng.normal(0, 6, SHAPE)
+        return np.clip(image, 0, 255).astype(np.uint8)
+
+    image = np.empty(SHAPE, dtype=np.uint8)
+    image[:] = rng.integers(0, 256, 3)
+    for _ in range(rng.integers(2, 6)):
+        cx, cy, r = rng.integers(0, 256, 2).tolist() + [rng.integers(20, 90)]
+        image[(x - cx) ** 2 + (y - cy) ** 2 < r * r] = rng.integers(0, 256, 3)
+    return image
+
+
+# Upload a picture for every user through the server's own pipeline
+def upload_all(n_users, photos, rng):
+    start = time.perf_counter()
+    for i in range(n_users):
+        user_id = str(i)
+        data = avatar(rng, i < n_users * photos).tobytes()
+        server.pending_images[user_id] = {
+            "size": len(data), "shape": SHAPE, "dtype": "uint8", "reply": {}}
+        server.recieve_profile_picture(user_id, data)
+    return (time.perf_counter() - start) / n_users
+
+
+# Bytes of every picture sent to a user who just joined
+def join_bytes(user_id, codec, protocol):
+    return sum(len(frame.to_bytes(codec, protocol))
+               for picture in server.profile_pictures.values()
+               for frame in server.picture_frames(picture, user_id))
+
+
+def main(n_users, photos, bits, seed):
+    logger.setLevel(logging.WARNING)
+    server.IMAGE_BITS = bits
+    codec = codecs["binary"]
+    connect_users(n_users, codec)
+
+    per_upload = upload_all(n_users, photos, np.random.default_rng(seed))
+
+    # One joiner that reads compressed pictures, one that doesn't and one
+    # coming back with every picture from last time
+    hashes = {picture["hash"] for picture in server.profile_pictures.values()}
+    for user_id, encodings, cached in (("old", set(), None), ("new", set(images.ENCODINGS), set()),
+                                       ("back", set(images.ENCODINGS), hashes)):
+        server.register_user(user_id, None, NullQueue())
+        server.image_encodings[user_id] = encodings
+        if cached is not None:
+            server.cached_images[user_id] = set(cached)
+    raw, compressed = join_bytes("old", codec, 2), join_bytes("new", codec, 2)
+    returning = join_bytes("back", codec, 2)
+
+    # A joiner that asks for the pictures of the page they see and the next
+    server.register_user("lazy", None, NullQueue())
+    server.image_encodings["lazy"] = set(images.ENCODINGS)
+    server.cached_images["lazy"] = set()
+    server.lazy_images.add("lazy")
+    lazy = sum(len(frame.to_bytes(codec, 2))
+               for picture in list(server.profile_pictures.values())[:2 * PAGE_SIZE]
+               for frame in server.picture_frames(picture, "lazy", requested=True))
+
+    start = time.perf_counter()
+    for picture in server.profile_pictures.values():
+        frames = picture["compressed_frames"]
+        images.decompress(frames[0].data["image"], frames[1].data, SHAPE, "uint8")
+    per_decode = (time.perf_counter() - start) / n_users
+
+    print(f"{n_users} users with pictures, {photos:.0%} photos, {bits} bits kept")
+    print(f"compressing each upload      {per_upload * 1000:8.1f} ms")
+    print(f"decompressing each picture   {per_decode * 1000:8.1f} ms")
+    print(f"join without compression     {raw / 1e6:8.1f} MB")
+    print(f"join with compression        {compressed / 1e6:8.1f} MB ({compressed / raw:.0%})")
+    print(f"rejoin with pictures kept    {returning / 1e6:8.3f} MB ({returning / raw:.2%})")
+    print(f"join fetching two pages      {lazy / 1e6:8.3f} MB ({lazy / raw:.2%})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="How many bytes of profile pictures a new user is sent, raw and compressed")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--photos", type=float, default=0.5,
+                        help="share of pictures that are photos rather than drawings")
+    parser.add_argument("--bits", type=int, default=8, choices=range(1, 9))
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    main(args.users, args.photos, args.bits, args.seed)
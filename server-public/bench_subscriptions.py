@@ -0,0 +1,91 @@
+import argparse
+import logging
+import random
+import server
+from codec import codecs
+from logger import logger
+
+WATCHED = 8  # Users each watching client shows, the ones on its page
+
+
+class CountingQueue:
+    """Send queue that only adds up the bytes of the frames queued."""
+
+    sent = 0  # Bytes queued to every client, shared
+
+    def __init__(self, codec):
+        self.codec = codec
+
+    def append(self, items):
+        # Frames keep their encoding, so this encodes each message once
+        CountingQueue.sent += sum(len(frame.to_bytes(self.codec, 2)) for frame in items)
+
+    def close(self):
+        pass
+
+    depth = 0
+
+
+# Connect a client straight to the server's state, the way it says it
+# wants the lobby, and tell everyone about them
+def join(user_id, codec, setup):
+    user = server.register_user(user_id, None, CountingQueue(codec))
+    server.user_codecs[user_id] = codec
+    server.protocols[user_id] = 2
+    if setup != "whole lobby":
+        server.directory_users.add(user_id)
+    if setup == "watching":
+        server.watching_users.add(user_id)
+    server.announce_user(user_id, user)
+
+    if setup == "watching":
+        # Itself and a few others, wherever they are in the lobby
+        others = list(server.directory.entries)
+        ids = [user_id] + random.sample(others, min(WATCHED, len(others)))
+        server.handle_data(user_id, {"watch": ids})
+
+
+def simulate(setup, n_users, churn, seconds, codec):
+    random.seed(0)
+
+    for i in range(n_users):
+        join(str(i), codec, setup)
+
+    CountingQueue.sent = 0
+    next_id = n_users
+    for _ in range(seconds):
+        for _ in range(churn):
+            # Someone leaves, someone joins and someone changes their name
+            server.disconnect_user(random.choice(list(server.active_users)), None)
+            join(str(next_id), codec, setup)
+            next_id += 1
+            user_id = random.choice(list(server.active_users))
+            server.handle_data(user_id, {"updated": {"username": f"Player {next_id}"}})
+        server.send_summary()
+
+    sent = CountingQueue.sent
+    for user_id in list(server.active_users):  # Empty for the next setup
+        server.disconnect_user(user_id, None)
+    return sent / seconds
+
+
+def main(n_users, churn, seconds, codec_name):
+    logger.setLevel(logging.ERROR)  # Every leaver is a warning
+    codec = codecs[codec_name]
+
+    print(f"{n_users} users, {churn} joins, leaves and renames a second, {codec_name} codec")
+    for setup in ("whole lobby", "directory", "watching"):
+        per_second = simulate(setup, n_users, churn, seconds, codec)
+        print(f"{setup:12s} {per_second / 1e6:10.2f} MB/s sent to every client together")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Bytes the server sends a busy lobby when clients get every change or only the ones they watch")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--churn", type=int, default=20)
+    parser.add_argument("--seconds", type=int, default=5)
+    parser.add_argument("--codec", default="binary", choices=sorted(codecs))
+    args = parser.parse_args()
+
+    main(args.users, args.churn, args.seconds, args.codec)
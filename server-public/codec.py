@@ -0,0 +1,196 @@
+import struct
+import pickle
+
+# Strings that show up in almost every message, sent as a one byte index.
+# Only ever append to this list, the position of each string is part of the format
+KEYS = [
+    # Message types
+    "connected", "disconnected", "challenge", "cancel_challenge", "cancel",
+    "accepted", "rejected", "new_game", "moved", "move", "game_over", "quit",
+    "updated", "image", "image_allowed", "message", "error", "status",
+    "protocol", "codec", "message_type",
+    # User stats
+    "id", "username", "color", "engaged", "challenged", "pending", "game",
+    "bot", "user_id", "changed",
+    # Messages
+    "title", "text", "buttons", "context", "closeable", "accept", "reject",
+    "challenger_id", "opp_id", "player1_id", "player2_id",
+    # Games
+    "players", "identification_dict", "details", "game_id", "board",
+    "player1", "player2", "winner_id", "indices", "tie", "who", "to",
+    "turn_string", "turn_id", "rows", "cols", "win_condition",
+    "X_id", "O_id", "red_id", "blue_id", "tic_tac_toe", "connect4",
+    "X", "O", "red", "blue",
+    # Images
+    "size", "shape", "dtype", "uint8",
+]
+KEY_INDEX = {key: index for index, key in enumerate(KEYS)}
+
+# Type tags, every value starts with one of these
+NONE, FALSE, TRUE, INT, FLOAT, STR, BYTES, LIST, DICT, KEY = range(10)
+FIXINT = 0x80  # Tags from 0x80 up are the integers 0 to 127 themselves
+
+DOUBLE = struct.Struct("!d")
+
+
+def write_varint(value, out):
+    # 7 bits at a time, the high bit says whether more bytes follow
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def read_varint(data, pos):
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+class PickleCodec:
+    """The original wire format, which can carry any Python object."""
+
+    name = "pickle"
+
+    def dumps(self, data):
+        return pickle.dumps(data)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+class BinaryCodec:
+    """
+    Compact tagged binary format for the plain data messages are made of.
+
+    Objects with a to_dict method (like the game boards) are sent as that dict,
+    so clients never need the server's classes to read a message. Tuples come
+    back as lists.
+    """
+
+    name = "binary"
+
+    def dumps(self, data):
+        out = bytearray()
+        self.encode(data, out)
+        return bytes(out)
+
+    def loads(self, data):
+        value, pos = self.decode(data, 0)
+        if pos != len(data):
+            raise ValueError("Trailing data after message")
+        return value
+
+    def encode(self, value, out):
+        kind = type(value)
+
+        if kind is str:
+            index = KEY_INDEX.get(value)
+            if index is not None:
+                out.append(KEY)
+                out.append(index)
+            else:
+                raw = value.encode()
+                out.append(STR)
+                write_varint(len(raw), out)
+                out += raw
+
+        elif kind is dict:
+            out.append(DICT)
+            write_varint(len(value), out)
+            for key, item in value.items():
+                self.encode(key, out)
+                self.encode(item, out)
+
+        elif kind is int:
+            if 0 <= value < 0x80:
+                out.append(FIXINT | value)
+            else:
+                # Zigzag so that small negative numbers stay small
+                out.append(INT)
+                write_varint(value << 1 if value >= 0 else (-value << 1) - 1, out)
+
+        elif value is None:
+            out.append(NONE)
+
+        elif kind is bool:
+            out.append(TRUE if value else FALSE)
+
+        elif kind is list or kind is tuple:
+            out.append(LIST)
+            write_varint(len(value), out)
+            for item in value:
+                self.encode(item, out)
+
+        elif kind is bytes or kind is bytearray or kind is memoryview:
+            out.append(BYTES)
+            write_varint(len(value), out)
+            out += value
+
+        elif kind is float:
+            out.append(FLOAT)
+            out += DOUBLE.pack(value)
+
+        elif hasattr(value, "to_dict"):
+            self.encode(value.to_dict(), out)
+
+        else:
+            raise TypeError(f"Can't encode {kind.__name__}")
+
+    def decode(self, data, pos):
+        tag = data[pos]
+        pos += 1
+
+        if tag >= FIXINT:
+            return tag - FIXINT, pos
+
+        if tag == KEY:
+            return KEYS[data[pos]], pos + 1
+
+        if tag == DICT:
+            length, pos = read_varint(data, pos)
+            value = {}
+            for _ in range(length):
+                key, pos = self.decode(data, pos)
+                value[key], pos = self.decode(data, pos)
+            return value, pos
+
+        if tag == STR:
+            length, pos = read_varint(data, pos)
+            return str(data[pos:pos + length], "utf-8"), pos + length
+
+        if tag == LIST:
+            length, pos = read_varint(data, pos)
+            value = []
+            for _ in range(length):
+                item, pos = self.decode(data, pos)
+                value.append(item)
+            return value, pos
+
+        if tag == NONE:
+            return None, pos
+
+        if tag == TRUE or tag == FALSE:
+            return tag == TRUE, pos
+
+        if tag == INT:
+            value, pos = read_varint(data, pos)
+            return (value >> 1) if not value & 1 else -((value + 1) >> 1), pos
+
+        if tag == BYTES:
+            length, pos = read_varint(data, pos)
+            return bytes(data[pos:pos + length]), pos + length
+
+        if tag == FLOAT:
+            return DOUBLE.unpack_from(data, pos)[0], pos + DOUBLE.size
+
+        raise ValueError(f"Unknown tag {tag}")
+
+
+# Every codec a connection can pick from, by name
+codecs = {codec.name: codec for codec in (PickleCodec(), BinaryCodec())}
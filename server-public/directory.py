@@ -0,0 +1,165 @@
+import bisect
+import threading
+
+PAGE_SIZE = 32  # Users sent in one page of the directory
+MAX_WATCHED = 64  # Most users one client may watch at once
+FIELDS = ("id", "username", "color", "bot", "avatar")  # What clients list of each user
+
+
+class Directory:
+    """
+    The public details of every user, what clients show in their lobby.
+
+    Every change gets the next version number and is handed to publish while
+    the directory is locked, and so are pages, so whoever queues them sends
+    them in version order. A client that gets a page of version 7 and then
+    change 9 knows it missed 8.
+
+    Pages run in the order users joined, from a cursor to the next, so users
+    leaving or joining while a client pages through never shift the pages.
+
+    Clients can instead watch a few users, the ones they show. Changes to a
+    user are then only published to the clients watching them, and the rest
+    only hear how many users there are from a summary every now and then.
+    Their versions skip the changes they weren't sent.
+    """
+
+    def __init__(self, page_size=PAGE_SIZE):
+        self.page_size = page_size
+        self.lock = threading.Lock()
+        self.version = 0
+        self.entries = {}  # user_id -> entry
+        self.joined = {}  # user_id -> cursor of the user, counting up as they join
+        self.cursors = []  # Cursors of every user, in order
+        self.users = {}  # cursor -> user_id
+        self.next_cursor = 0
+        self.watching = {}  # Client watching only some users -> those users
+        self.watchers = {}  # user_id -> clients watching them
+        self.summarised = None  # Version of the last summary
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, user_id):
+        return user_id in self.entries
+
+    # Each change is published with the clients watching the user it's about,
+    # publish sends it to them and to every client that isn't watching a few
+
+    def connect(self, user, publish):
+        with self.lock:
+            entry = {key: user.get(key) for key in FIELDS}
+            self.next_cursor += 1
+            self.entries[user["id"]] = entry
+            self.joined[user["id"]] = self.next_cursor
+            self.cursors.append(self.next_cursor)
+            self.users[self.next_cursor] = user["id"]
+            self.version += 1
+            # Nobody watches someone new, they show up in summaries
+            publish({"connected": dict(entry), "version": self.version}, set())
+
+    def disconnect(self, user_id, publish):
+        with self.lock:
+            for other_id in self.watching.pop(user_id, ()):
+                self.unwatch(user_id, other_id)
+
+            if self.entries.pop(user_id, None) is None:
+                return  # Never listed, or already gone
+            cursor = self.joined.pop(user_id)
+            self.cursors.pop(bisect.bisect_left(self.cursors, cursor))
+            del self.users[cursor]
+            self.version += 1
+
+            watchers = self.watchers.pop(user_id, set())
+            for watcher_id in watchers:
+                self.watching[watcher_id].discard(user_id)
+            publish({"disconnected": user_id, "version": self.version}, watchers)
+
+    def update(self, user_id, changed, publish):
+        """Publish changes to a user, the public ones are kept for later pages."""
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is not None:
+                entry.update((key, value) for key, value in changed.items() if key in FIELDS)
+            self.version += 1
+            publish({"updated": {"user_id": user_id, "changed": changed},
+                     "version": self.version}, set(self.watchers.get(user_id, ())))
+
+    def page(self, after, send, user_id=None, watch=False):
+        """
+        Send the page of users that joined after the cursor after, cursors
+        start at 1 so 0 is the first page. The user user_id is always
+        included, so the first page a client gets says who they are and
+        whether they only watch some users. With watch, user_id starts
+        watching nobody along with the page, so no summary gets there first.
+        """
+        with self.lock:
+            if watch:
+                self.watching.setdefault(user_id, set())
+            start = bisect.bisect_right(self.cursors, after)
+            cursors = self.cursors[start: start + self.page_size]
+            # Copied, entries change while the page waits to be sent
+            users = [dict(self.entries[self.users[cursor]]) for cursor in cursors]
+            if user_id in self.entries and self.joined[user_id] not in cursors:
+                users.append(dict(self.entries[user_id]))
+
+            page = {
+                "version": self.version,
+                "after": after,
+                "users": users,
+                "next": cursors[-1] if cursors else after,  # Where the next page starts
+                "more": start + self.page_size < len(self.cursors),
+                "total": len(self.entries),
+            }
+            if user_id is not None:
+                page["watching"] = user_id in self.watching
+            send({"directory": page})
+
+    def watch(self, client_id, user_ids, send):
+        """
+        Only publish the changes to the users given to the client from now
+        on. Sends the details of the ones they weren't watching yet, and
+        which of those are gone.
+        """
+        with self.lock:
+            old = self.watching.get(client_id, set())
+            new = set(list(user_ids)[:MAX_WATCHED])
+            gone = {user_id for user_id in new - old if user_id not in self.entries}
+            new -= gone
+
+            for user_id in old - new:
+                self.unwatch(client_id, user_id)
+            for user_id in new - old:
+                self.watchers.setdefault(user_id, set()).add(client_id)
+            self.watching[client_id] = new
+
+            if new - old or gone:
+                send({"watched": {
+                    "version": self.version,
+                    "users": [dict(self.entries[user_id]) for user_id in new - old],
+                    "gone": list(gone),
+                }})
+
+    def unwatch(self, client_id, user_id):
+        watchers = self.watchers.get(user_id)
+        if watchers is not None:
+            watchers.discard(client_id)
+            if not watchers:
+                del self.watchers[user_id]
+
+    def summary(self, publish):
+        """
+        Publish how many users there are and where the lobby ends to the
+        clients watching only some users, unless nothing has changed since
+        the last summary. Like changes, it's published while locked so it
+        never gets to a client after a later change.
+        """
+        with self.lock:
+            if self.summarised == self.version:
+                return
+            self.summarised = self.version
+            publish({"lobby": {
+                "version": self.version,
+                "total": len(self.entries),
+                "last": self.cursors[-1] if self.cursors else 0,
+            }}, list(self.watching))
@@ -0,0 +1,125 @@
+import struct
+import pickle
+import time
+
+HEADER_V1 = struct.Struct("h")  # Protocol 1 frames start with a 2 byte length
+HEADER_V2 = struct.Struct("!I")  # Protocol 2 frames start with a 4 byte length
+
+
+class FrameReader:
+    """Buffered reader that turns the byte stream of a socket into frames."""
+
+    def __init__(self, sock, protocol=1, buffer_size=16 * 1024, max_frame_size=None):
+        self.sock = sock
+        self.protocol = protocol
+        self.max_frame_size = max_frame_size
+
+        # Everything is received into this buffer, which may hold several
+        # pipelined frames at once. Unread bytes live in [start:end]
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+        # Stats
+        self.bytes_read = 0
+        self.frames_read = 0
+        self.started_at = time.monotonic()
+
+    def fill(self, size):
+        """Buffer at least size unread bytes. Returns False if the peer left."""
+        if len(self.buffer) - self.start < size:
+            # Move the unread bytes to the front to make room
+            unread = self.end - self.start
+            self.buffer[:unread] = self.buffer[self.start:self.end]
+            self.start, self.end = 0, unread
+
+        while self.end - self.start < size:
+            received = self.sock.recv_into(self.view[self.end:])
+            if not received:
+                return False
+            self.end += received
+            self.bytes_read += received
+
+        return True
+
+    def read_exact(self, size):
+        """Read exactly size bytes, or None if the peer left."""
+        if size <= len(self.buffer):
+            if not self.fill(size):
+                return None
+            data = bytes(self.view[self.start:self.start + size])
+            self.start += size
+            if self.start == self.end:
+                self.start = self.end = 0
+            return data
+
+        # Too big for the buffer, so receive it straight into one of its own
+        data = bytearray(size)
+        unread = self.end - self.start
+        data[:unread] = self.view[self.start:self.end]
+        self.start = self.end = 0
+
+        target = memoryview(data)[unread:]
+        while target:
+            received = self.sock.recv_into(target)
+            if not received:
+                return None
+            target = target[received:]
+            self.bytes_read += received
+
+        return data
+
+    def read_frame(self):
+        """Read one length prefixed frame, or None if the peer left."""
+        header = HEADER_V2 if self.protocol >= 2 else HEADER_V1
+        lenData = self.read_exact(header.size)
+        if lenData is None:
+            return None
+
+        lenData = header.unpack(lenData)[0]
+        if lenData < 0 or (self.max_frame_size and lenData > self.max_frame_size):
+            raise ValueError(f"Invalid frame length: {lenData}")
+
+        data = self.read_exact(lenData)
+        if data is not None:
+            self.frames_read += 1
+
+        return data
+
+    def read_data(self):
+        """Read one message, putting protocol 1 huge messages back together."""
+        data = self.read_frame()
+        if data is None or self.protocol >= 2 or b"n_batches" not in data:
+            return data
+
+        try:
+            pickled = pickle.loads(data)
+        except Exception:
+            return data  # Raw data that happened to contain the marker
+
+        if isinstance(pickled, dict) and pickled.get("message_type") == "huge":
+            # Read the table of batch sizes, then all the batches in one go
+            n_batches = pickled["n_batches"]
+            if not isinstance(n_batches, int) or n_batches <= 0 or (
+                    self.max_frame_size and HEADER_V1.size * n_batches > self.max_frame_size):
+                raise ValueError(f"Invalid number of batches: {n_batches}")
+            batch_sizes = self.read_exact(HEADER_V1.size * n_batches)
+            if batch_sizes is None:
+                return None
+            size = sum(struct.unpack("h" * n_batches, batch_sizes))
+            if size < 0 or (self.max_frame_size and size > self.max_frame_size):
+                raise ValueError(f"Invalid huge message length: {size}")
+            return self.read_exact(size)
+
+        return data
+
+    def stats(self):
+        """Bytes and frames read so far, and the rate at which they came in."""
+        elapsed = max(time.monotonic() - self.started_at, 1e-9)
+        return {
+            "bytes": self.bytes_read,
+            "frames": self.frames_read,
+            "bytes_per_second": self.bytes_read / elapsed,
+            "frames_per_second": self.frames_read / elapsed,
+        }
@@ -1,4 +1,5 @@
 import random
+import bitboard
 from constants import *
 from logger import logger
 
@@ -22,6 +23,7 @@ class GameLogic:
 
         self.board = [[None for _ in range(self.cols)]
                       for _ in range(self.rows)]
+        self.moves_made = 0  # Pieces on the board, so a tie is a comparison
 
     def validate(self, id, move):
 
@@ -36,6 +38,7 @@ class GameLogic:
     def move(self, to):
 
         to = self.make_move(to)
+        self.moves_made += 1
 
         # Prepare response
         r = {}
@@ -46,7 +49,8 @@ class GameLogic:
 
         }
 
-        game_over = self.is_game_over(self.turn_id)
+        # Only lines through the new piece can have been completed
+        game_over = self.is_game_over(self.turn_id, to)
 
         self.switch_turn()
 
@@ -58,8 +62,31 @@ class GameLogic:
 
         return self.turn_id
 
-    def is_game_over(self, player):
-        """Check if there is a winning sequence"""
+    def to_dict(self):
+        """Plain data describing the game, for clients that can't unpickle it."""
+        return {
+            "player1_id": self.player1_id,
+            "player2_id": self.player2_id,
+            "turn_id": self.turn_id,
+            "turn_string": self.turn_string,
+            "rows": self.rows,
+            "cols": self.cols,
+            "win_condition": self.win_condition,
+        }
+
+    def is_game_over(self, player, last=None):
+        """Check if there is a winning sequence, through the last move if given"""
+        if last is not None:
+            indices = self.line_through(player, last)
+            if indices:
+                return {"winner_id": player, "indices": indices, "tie": False}
+
+            # Tie match
+            if self.is_full():
+                return {"winner_id": None, "indices": None, "tie": True}
+
+            return False
+
         # Check rows
         for row in range(self.rows):
             for col in range(self.cols - self.win_condition + 1):
@@ -92,9 +119,37 @@ class GameLogic:
 
         return False
 
+    def line_through(self, player, cell):
+        """Cells of a winning line through cell, or None if there is none."""
+        row, col = cell
+        n = self.win_condition
+
+        # Horizontal, vertical, and both diagonals
+        for d_row, d_col in ((0, 1), (1, 0), (1, 1), (1, -1)):
+            # Walk back to where the player's pieces in this line start
+            start = 0
+            while start > -n:
+                r, c = row + (start - 1) * d_row, col + (start - 1) * d_col
+                if not (0 <= r < self.rows and 0 <= c < self.cols) or self.board[r][c] != player:
+                    break
+                start -= 1
+
+            # Then count forward through the cell
+            end = 1
+            while end - start < n:
+                r, c = row + end * d_row, col + end * d_col
+                if not (0 <= r < self.rows and 0 <= c < self.cols) or self.board[r][c] != player:
+                    break
+                end += 1
+
+            if end - start >= n:
+                return [(row + i * d_row, col + i * d_col) for i in range(start, start + n)]
+
+        return None
+
     def is_full(self):
         """Check if the board is full."""
-        return all(self.board[i][j] != None for i in range(self.rows) for j in range(self.cols))
+        return self.moves_made == self.rows * self.cols
 
 
 # Class to handle the logic for Tic Tac Toe
@@ -124,6 +179,9 @@ class TTTLogic(GameLogic):
             self.turn_id = self.X_id
 
     def make_move(self, to, place=True):
+        # Negative indices would wrap around to the other side of the board
+        if not (0 <= to[0] < self.rows and 0 <= to[1] < self.cols):
+            return False
         if self.board[to[0]][to[1]] is None:
             if place:
                 # Place the move
@@ -136,6 +194,10 @@ class TTTLogic(GameLogic):
 
         return {self.X_id: "X", self.O_id: "O", "player1": self.player1_id, "player2": self.player2_id}
 
+    def to_dict(self):
+
+        return {**super().to_dict(), "X_id": self.X_id, "O_id": self.O_id}
+
 
 # Class to handle the logic for Connect4
 class ConnectLogic(GameLogic):
@@ -155,20 +217,45 @@ class ConnectLogic(GameLogic):
 
         self.win_condition = connect4_number
 
+        # Bitboards of each colour and the height of every column, so that a
+        # move and the win check after it don't have to look at the grid
+        self.masks = {"red": 0, "blue": 0}
+        self.heights = [0] * self.cols
+
     def get_identification_dict(self):
 
         return {self.red_id: "red", self.blue_id: "blue", "player1": self.player1_id, "player2": self.player2_id}
 
+    def to_dict(self):
+
+        return {**super().to_dict(), "red_id": self.red_id, "blue_id": self.blue_id}
+
     def make_move(self, col, place=True):
         # Place a piece in the lowest available row for the specified column
-        for r in range(self.rows - 1, -1, -1):
-            if self.board[r][col] is None:
-                if place:
-                    self.board[r][col] = self.turn_id
-                return (r, col)
-        else:
+        if not 0 <= col < self.cols or self.heights[col] == self.rows:
             return False
 
+        r = self.rows - 1 - self.heights[col]
+        if place:
+            self.board[r][col] = self.turn_id
+            self.masks[self.turn_string] |= bitboard.bit(self.rows, r, col)
+            self.heights[col] += 1
+        return (r, col)
+
+    def is_game_over(self, player, last=None):
+        """Check the bitboard of the player for a winning sequence"""
+        colour = "red" if player == self.red_id else "blue"
+        indices = bitboard.winning_cells(
+            self.masks[colour], self.rows, self.win_condition)
+        if indices:
+            return {"winner_id": player, "indices": indices, "tie": False}
+
+        # Tie match
+        if self.is_full():
+            return {"winner_id": None, "indices": None, "tie": True}
+
+        return False
+
     def switch_turn(self):
         # Switch turns
         if self.turn_string == "red":
@@ -0,0 +1,330 @@
+import time
+import pickle
+import random
+import asyncio
+import argparse
+import multiprocessing
+from codec import codecs
+from framing import HEADER_V1, HEADER_V2
+from constants import tic_tac_toe_rows, tic_tac_toe_cols, connect4_rows, connect4_cols
+
+CODEC = codecs["binary"]
+IMAGE_SHAPE = (64, 64, 3)
+
+
+class Stats:
+    """Counters and latencies of every simulated client in one process."""
+
+    def __init__(self):
+        self.counters = {}
+        self.latencies = {}  # Name -> seconds
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def time(self, name, seconds):
+        self.latencies.setdefault(name, []).append(seconds)
+
+    def merge(self, other):
+        for name, value in other["counters"].items():
+            self.count(name, value)
+        for name, values in other["latencies"].items():
+            self.latencies.setdefault(name, []).extend(values)
+
+
+class LoadClient:
+    """
+    One scripted player. Clients come in pairs: the challenger keeps
+    challenging its partner, who always accepts, and both play random moves.
+    """
+
+    def __init__(self, number, stats, options):
+        self.number = number
+        self.stats = stats
+        self.options = options
+        self.partner = None
+        self.challenger = False
+        self.user_id = None
+        self.connected = asyncio.Event()
+        self.game = None
+
+    # Framing
+    async def read_v1(self):
+        size = HEADER_V1.unpack(await self.reader.readexactly(HEADER_V1.size))[0]
+        return await self.reader.readexactly(size)
+
+    async def read_frame(self):
+        size = HEADER_V2.unpack(await self.reader.readexactly(HEADER_V2.size))[0]
+        data = await self.reader.readexactly(size)
+        self.stats.count("bytes_in", HEADER_V2.size + size)
+        self.stats.count("frames_in")
+        return data
+
+    def send(self, data, encode=True):
+        payload = CODEC.dumps(data) if encode else data
+        self.writer.write(HEADER_V2.pack(len(payload)) + payload)
+        self.stats.count("bytes_out", HEADER_V2.size + len(payload))
+        self.stats.count("frames_out")
+
+    async def connect(self):
+        """Connect and negotiate protocol 2 with the binary codec, like the client does."""
+        start = time.perf_counter()
+        self.reader, self.writer = await asyncio.open_connection(
+            self.options.host, self.options.port)
+
+        self.user_id = pickle.loads(await self.read_v1())
+        metadata = pickle.dumps({
+            "updated": {"username": f"LOAD#{self.number}"},
+            "protocol": 2,
+            "codec": CODEC.name,
+        })
+        self.writer.write(HEADER_V1.pack(len(metadata)) + metadata)
+
+        ack = pickle.loads(await self.read_v1())
+        if ack.get("protocol") != 2:
+            raise ConnectionError(f"Server did not accept protocol 2: {ack}")
+
+        self.stats.time("connect", time.perf_counter() - start)
+        self.stats.count("connections")
+        self.game = None
+        self.uploading = None
+        self.connected.set()
+
+    async def run(self, stop_at):
+        while time.time() < stop_at:
+            try:
+                # Each session runs until an abrupt disconnect, a dropped connection, or the end
+                await asyncio.wait_for(self.session(), timeout=max(stop_at - time.time(), 0))
+            except asyncio.TimeoutError:
+                break
+            except (OSError, asyncio.IncompleteReadError) as e:
+                self.stats.count(f"error: {type(e).__name__}")
+                await asyncio.sleep(0.5)
+
+            finally:
+                self.connected.clear()
+                if hasattr(self, "writer"):
+                    self.writer.transport.abort()
+
+    async def session(self):
+        await self.connect()
+        if self.challenger:
+            await self.partner.connected.wait()
+            self.challenge()
+        await self.listen()
+
+    async def listen(self):
+        while True:
+            message = CODEC.loads(await self.read_frame())
+
+            # Profile pictures are followed by the raw image, unless only named
+            if message.get("image") and not message["image"].get("cached"):
+                await self.read_frame()
+
+            if message.get("error"):
+                self.stats.count("error replies")
+                if self.challenger and not self.game and not self.uploading:
+                    # Most likely the partner dropped, challenge them once they're back
+                    await asyncio.sleep(0.5)
+                    await self.partner.connected.wait()
+                    self.challenge()
+            if message.get("challenge") and message["challenge"]["challenger_id"] == self.partner.user_id:
+                self.accept(message["challenge"])
+            if message.get("new_game"):
+                self.start_game(message["new_game"])
+            if message.get("image_allowed") and self.uploading:
+                self.send(bytes(self.uploading), encode=False)
+            if self.uploading and message.get("message", {}).get("title") == "Uploaded successfully!":
+                self.stats.time("image", time.perf_counter() - self.upload_sent)
+                self.uploading = None
+                self.challenge()
+
+            if message.get("moved"):
+                if not await self.moved(message):
+                    return  # Disconnected on purpose
+            elif message.get("game_over") and self.game:
+                if not await self.game_over():
+                    return
+
+    # Scenario
+    def challenge(self):
+        self.challenge_sent = time.perf_counter()
+        self.send({"challenge": (self.partner.user_id, random.choice(self.options.games))})
+        self.stats.count("challenge")
+
+    def accept(self, challenge):
+        self.send({"accepted": {
+            "player1_id": challenge["challenger_id"],
+            "player2_id": self.user_id,
+            "game": challenge["game"],
+        }})
+        self.stats.count("accepted")
+
+    def start_game(self, new_game):
+        details = new_game["details"]
+        if self.challenger:
+            self.stats.time("challenge -> new_game",
+                            time.perf_counter() - self.challenge_sent)
+
+        self.game = {
+            "id": details["game_id"],
+            "name": new_game["game"],
+            "taken": set(),  # Cells in tic tac toe
+            "heights": [0] * connect4_cols,  # Pieces in each connect4 column
+        }
+        if details["board"]["turn_id"] == self.user_id:
+            self.move()
+
+    def move(self):
+        game = self.game
+        if random.random() < self.options.quit_rate:
+            self.send({"quit": game["id"]})
+            self.stats.count("quit")
+            return
+
+        if game["name"] == "tic_tac_toe":
+            move = random.choice([(r, c) for r in range(tic_tac_toe_rows) for c in range(tic_tac_toe_cols)
+                                  if (r, c) not in game["taken"]])
+        else:
+            move = random.choice([c for c in range(connect4_cols)
+                                  if game["heights"][c] < connect4_rows])
+
+        self.move_sent = time.perf_counter()
+        self.send({"move": {"game_id": game["id"], "move": move}})
+        self.stats.count("move")
+
+    async def moved(self, message):
+        moved = message["moved"]
+        if not self.game or moved["game_id"] != self.game["id"]:
+            return True
+
+        if moved["who"] == self.user_id:
+            self.stats.time("move -> moved", time.perf_counter() - self.move_sent)
+
+        row, col = moved["to"]
+        self.game["taken"].add((row, col))
+        self.game["heights"][col] += 1
+
+        if message.get("game_over"):
+            return await self.game_over()
+
+        if moved["turn_id"] == self.user_id:
+            await asyncio.sleep(self.options.think / 1000)
+            if self.game:
+                self.move()
+        return True
+
+    async def game_over(self):
+        self.game = None
+        self.stats.count("games")
+        if not self.challenger:
+            return True
+
+        await asyncio.sleep(self.options.think / 1000)
+        roll = random.random()
+        if roll < self.options.disconnect_rate:
+            self.stats.count("abrupt disconnects")
+            return False  # run() drops the connection and comes back as a new user
+
+        if roll < self.options.disconnect_rate + self.options.image_rate:
+            self.upload_image()
+        else:
+            self.challenge()
+        return True
+
+    def upload_image(self):
+        size = IMAGE_SHAPE[0] * IMAGE_SHAPE[1] * IMAGE_SHAPE[2]
+        self.uploading = random.randbytes(size)
+        self.upload_sent = time.perf_counter()
+        self.send({"image": {"size": size, "shape": IMAGE_SHAPE, "dtype": "uint8"}})
+        self.stats.count("image")
+
+
+async def run_clients(first_number, count, options, stop_at):
+    stats = Stats()
+    clients = [LoadClient(first_number + i, stats, options) for i in range(count)]
+    for challenger, partner in zip(clients[::2], clients[1::2]):
+        challenger.partner, partner.partner = partner, challenger
+        challenger.challenger = True
+
+    # Spread the connections out over the ramp up
+    tasks = []
+    for client in clients:
+        if client.partner is None:
+            continue  # An odd one out has nobody to play with
+        tasks.append(asyncio.create_task(client.run(stop_at)))
+        await asyncio.sleep(options.ramp / max(count, 1))
+
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return stats
+
+
+def process_main(first_number, count, options, stop_at, results):
+    stats = asyncio.run(run_clients(first_number, count, options, stop_at))
+    results.put({"counters": stats.counters, "latencies": stats.latencies})
+
+
+def percentile(values, fraction):
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def report(stats, duration):
+    print(f"\n{'latency':<24}{'count':>8}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, values in sorted(stats.latencies.items()):
+        values.sort()
+        ms = [value * 1000 for value in values]
+        print(f"{name:<24}{len(ms):>8}{percentile(ms, .5):>10.1f}{percentile(ms, .9):>10.1f}"
+              f"{percentile(ms, .99):>10.1f}{ms[-1]:>10.1f}")
+
+    print(f"\n{'counter':<24}{'total':>12}{'per second':>12}")
+    for name, value in sorted(stats.counters.items()):
+        print(f"{name:<24}{value:>12}{value / duration:>12.1f}")
+
+
+def main(options):
+    per_process = options.clients // options.processes
+    per_process -= per_process % 2  # Every process pairs up its own clients
+    stop_at = time.time() + options.ramp + options.duration
+
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=process_main, args=(
+            i * per_process, per_process, options, stop_at, results))
+        for i in range(options.processes)
+    ]
+    for process in processes:
+        process.start()
+
+    stats = Stats()
+    for _ in processes:
+        stats.merge(results.get())
+    for process in processes:
+        process.join()
+
+    print(f"{per_process * options.processes} clients in {options.processes} processes, "
+          f"{options.duration}s after a {options.ramp}s ramp up")
+    report(stats, options.ramp + options.duration)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Simulate lots of players against a running server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5555)
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--processes", type=int, default=2)
+    parser.add_argument("--duration", type=float, default=30,
+                        help="seconds to run after everyone connected")
+    parser.add_argument("--ramp", type=float, default=5,
+                        help="seconds over which the clients connect")
+    parser.add_argument("--think", type=float, default=20,
+                        help="milliseconds to wait before each move or challenge")
+    parser.add_argument("--games", nargs="+", default=["tic_tac_toe", "connect4"],
+                        choices=["tic_tac_toe", "connect4"])
+    parser.add_argument("--quit-rate", type=float, default=0.01,
+                        help="chance of quitting instead of making a move")
+    parser.add_argument("--image-rate", type=float, default=0.02,
+                        help="chance of uploading a profile picture after a game")
+    parser.add_argument("--disconnect-rate", type=float, default=0.02,
+                        help="chance of dropping the connection after a game")
+    main(parser.parse_args())
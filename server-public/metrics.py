@@ -0,0 +1,169 @@
+import os
+import time
+import bisect
+import weakref
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from logger import logger
+
+# Upper bounds of the latency buckets in seconds, 25 us doubling up to ~0.8 s
+BUCKETS = [0.000025 * 2 ** i for i in range(16)]
+
+
+class Shard:
+    """
+    The counters and histograms of a single thread. Only its own thread ever
+    writes to it, so recording needs no lock, snapshots just add shards up.
+    """
+
+    def __init__(self):
+        self.finished = False  # Set once its thread has exited
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [bucket counts..., sum]
+
+    def merge(self, other):
+        for key, value in other.counters.copy().items():
+            self.counters[key] = self.counters.get(key, 0) + value
+        for key, values in other.histograms.copy().items():
+            mine = self.histograms.setdefault(key, [0] * len(values))
+            for i, value in enumerate(values):
+                mine[i] += value
+
+
+local = threading.local()
+shards = []  # Shards of every thread that has recorded something
+retired = Shard()  # Totals of threads that have since exited
+shards_lock = threading.Lock()  # Only taken for a thread's first record and for snapshots
+gauges = {}  # name -> function returning a value or {labels: value}
+
+
+class ThreadExit:
+    """Kept only in a thread's local storage, so it is freed when the thread exits."""
+
+
+def shard():
+    try:
+        return local.shard
+    except AttributeError:
+        s = local.shard = Shard()
+        local.exit = ThreadExit()
+        weakref.finalize(local.exit, setattr, s, "finished", True)
+        with shards_lock:
+            shards.append(s)
+        return s
+
+
+def count(name, amount=1, **labels):
+    """Add to a counter, like count("messages", type="move")."""
+    counters = shard().counters
+    key = (name, tuple(labels.items()))
+    counters[key] = counters.get(key, 0) + amount
+
+
+def observe(name, seconds, **labels):
+    """Record one duration in a histogram."""
+    histograms = shard().histograms
+    key = (name, tuple(labels.items()))
+    values = histograms.get(key)
+    if values is None:
+        values = histograms[key] = [0] * (len(BUCKETS) + 2)
+    values[bisect.bisect_left(BUCKETS, seconds)] += 1
+    values[-1] += seconds
+
+
+def gauge(name, function):
+    """Register a value that is read whenever a snapshot is taken."""
+    gauges[name] = function
+
+
+# Everything recorded so far, added up over all threads
+def collect():
+    total = Shard()
+    with shards_lock:
+        # Fold the shards of finished threads away, so they don't pile up
+        for s in list(shards):
+            if s.finished:
+                retired.merge(s)
+                shards.remove(s)
+        total.merge(retired)
+        for s in shards:
+            total.merge(s)
+    return total
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+# All metrics in the Prometheus text format
+def snapshot():
+    total = collect()
+    lines = []
+
+    for (name, labels), value in sorted(total.counters.items()):
+        lines.append(f"{name}_total{format_labels(labels)} {value}")
+
+    for (name, labels), values in sorted(total.histograms.items()):
+        cumulative = 0
+        for bound, bucket in zip(BUCKETS + ["+Inf"], values):
+            cumulative += bucket
+            le = bound if bound == "+Inf" else f"{bound:g}"
+            lines.append(
+                f"{name}_bucket{format_labels(labels + (('le', le),))} {cumulative}")
+        lines.append(f"{name}_sum{format_labels(labels)} {values[-1]:.6f}")
+        lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+
+    for name, function in sorted(gauges.items()):
+        try:
+            value = function()
+        except Exception as e:  # The server's dicts change under our feet
+            logger.debug(f"[METRICS]: Could not read {name}: {e}")
+            continue
+        if isinstance(value, dict):
+            for labels, v in sorted(value.items()):
+                lines.append(f"{name}{format_labels(labels)} {v}")
+        else:
+            lines.append(f"{name} {value}")
+
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = snapshot().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes would flood the server's log
+
+
+# Serve the metrics over http on localhost from a thread of their own
+def serve(port, host="127.0.0.1"):
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"[METRICS]: http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+
+# Write a snapshot to path every interval seconds from a thread of their own
+def write_periodically(path, interval=10):
+    def writer():
+        while True:
+            time.sleep(interval)
+            try:
+                # Written to a temporary file first, so readers never see half a snapshot
+                with open(path + ".tmp", "w") as f:
+                    f.write(snapshot())
+                os.replace(path + ".tmp", path)
+            except OSError as e:
+                logger.warning(f"[METRICS]: Could not write {path}: {e}")
+
+    threading.Thread(target=writer, daemon=True).start()
+    logger.info(f"[METRICS]: Writing to {path} every {interval}s")
@@ -1,17 +1,31 @@
 import socket
+import asyncio
+import argparse
 import struct
 import math
+import time
 import pickle
 import random
+import threading
 from _thread import start_new_thread
 from constants import *
 from games_logic import TTTLogic, ConnectLogic
+from framing import FrameReader, HEADER_V2
+from codec import codecs
+import images
+from state import StripedLocks
+from directory import Directory
 from logger import logger
+import metrics
 
 # IP address and port for the server to bind to
 IP = "0.0.0.0"  # Address to bind to (localhost)
 PORT = 5555  # Arbitrary non-privileged port
 DEFAULT_BYTES = 1024  # Max bytes that can be sent in one message
+SEND_BATCH_BYTES = 64 * 1024  # Bytes to gather into one sendall call
+ASYNC_BACKLOG = 4096  # Pending connections the asyncio server will queue
+PROTOCOL_VERSION = 2  # Newest wire protocol the server can speak
+MAX_FRAME_SIZE = 4 * max_image_size  # Largest frame a client may send
 total_connections_so_far = 0  # Keep track of total connections
 total_games_so_far = 0  # Track total games played
 
@@ -20,10 +34,31 @@ active_users = {}  # {id:{"conn":conn,"engaged":False}} - Active users data
 connections = {}  # Store the connections in a dict, for easy access
 send_queue = {}  # Queue for sending data to each user
 profile_pictures = {}  # Store profile pics for users
+pending_images = {}  # Image uploads waiting for their raw data frame
+protocols = {}  # Wire protocol version negotiated with each user
+user_codecs = {}  # Codec each user's messages are encoded with
+image_encodings = {}  # Compressed image encodings each user can read
+cached_images = {}  # Hashes of the pictures each user already has, if they say
+MAX_CACHED_IMAGES = 10000  # Most picture hashes a client may say it has
+lazy_images = set()  # Users who ask for the pictures they show instead of getting them all
+MAX_IMAGE_REQUEST = 64  # Most pictures a user may ask for at once
+IMAGE_BITS = 8  # Bits of every colour value kept when compressing pictures
+
+# What every client lists of each user, clients that say "directory" are sent
+# it a page at a time, the rest get all of active_users at once
+directory = Directory()
+directory_users = set()
+watching_users = set()  # Of those, the ones that will only watch the users they show
+SUMMARY_INTERVAL = 1  # Seconds between lobby summaries to clients watching only some users
 
 # Pending game requests and ongoing games
 pending = {}  # {"challenger_id":(challenged_to,game)} - Pending game requests
 games = {}  # {game_id:{players:[],game:<string>,game_details:{board:<Board>}}}
+user_games = {}  # {user_id:{game_id,...}} - Games each user is playing, bots play many
+
+# Anything that changes the stats of several users, their challenges or their
+# games holds the locks of all of those users while it does
+user_locks = StripedLocks()
 
 # Dictionary to look up game logic for specific games
 games_lookup = {
@@ -31,19 +66,21 @@ games_lookup = {
     "connect4": ConnectLogic,
 }  # Easily extendable for more games
 
-# Function to set up a new user
+# Stats only the server changes, users can't update them. The avatar is set
+# by uploading a picture
+SERVER_OWNED_STATS = {"id", "image", "avatar", "engaged", "challenged", "pending", "game"}
 
+# Function to register the default stats of a new user
 
-def create_user(conn, addr):
-    # Generate a user ID based on the total connections so far
-    user_id = str(total_connections_so_far)
 
+def register_user(user_id, conn, queue):
     # Create a default username and user stats
     username = f"USER#{user_id}"
     user_stats = {
         "id": user_id,
         "username": username,
         "image": None,
+        "avatar": None,  # Hash of the user's profile picture, once they have one
         "color": random.choice(USER_COLORS),  # Randomly assign a color
         "engaged": False,
         "challenged": {},  # Requests this user sent but not yet accepted
@@ -52,28 +89,84 @@ def create_user(conn, addr):
         "bot": False,  # User is not a bot by default
     }
 
-    # Add user to the active users and connection dictionaries
-    active_users[user_id] = user_stats
-    connections[user_id] = conn
-    send_queue[user_id] = []  # Initialize an empty send queue
+    # Add user to the active users and connection dictionaries, all at once
+    # as far as anyone holding every lock can tell
+    with user_locks.hold(user_id):
+        active_users[user_id] = user_stats
+        connections[user_id] = conn
+        send_queue[user_id] = queue  # Initialize an empty send queue
+        protocols[user_id] = 1  # Every connection starts out on protocol 1
+        user_codecs[user_id] = codecs["pickle"]  # And on pickled messages
+    metrics.count("connections")
 
     logger.debug(f"[NEW USER] {user_stats['username']} ({user_id})")
 
+    return user_stats
+
+
+# Apply the metadata a client sends right after connecting
+def apply_user_metadata(user_id, data):
+    data = pickle.loads(data)  # Deserialize the received data
+    if data.get("updated"):  # If there's updated data, update user stats
+        update_user(user_id, data["updated"], send_all=False)
+
+    # Clients that speak a newer protocol or codec say so, old ones don't
+    protocol = min(data.get("protocol", 1), PROTOCOL_VERSION)
+    codec = codecs.get(data.get("codec"), codecs["pickle"])
+    protocols[user_id] = protocol
+    user_codecs[user_id] = codec
+    image_encodings[user_id] = set(data.get("image_encodings", ())) & set(images.ENCODINGS)
+    # Clients that keep pictures between runs list the ones they have, only
+    # they are sent pictures by name
+    if "image_hashes" in data:
+        cached_images[user_id] = {
+            h for h in list(data["image_hashes"])[:MAX_CACHED_IMAGES] if isinstance(h, str)}
+    if data.get("directory"):
+        directory_users.add(user_id)
+    # Clients that watch only the users they show, from their first page on
+    if data.get("watch"):
+        watching_users.add(user_id)
+    # Clients that fetch pictures as they're shown are only told the hashes
+    if data.get("lazy_images"):
+        lazy_images.add(user_id)
+        cached_images.setdefault(user_id, set())
+
+    # Acknowledgement to send back, everything after it uses the new format
+    if protocol > 1 or codec.name != "pickle":
+        return {"protocol": protocol, "codec": codec.name}
+
+    return None
+
+
+# Function to set up a new user
+
+
+def create_user(conn, addr):
+    # Generate a user ID based on the total connections so far
+    user_id = str(total_connections_so_far)
+    user_stats = register_user(user_id, conn, SendQueue())
+    reader = FrameReader(conn, max_frame_size=MAX_FRAME_SIZE)
+
     # Send user their ID and all active users' data
     send(user_id, conn)
 
     # Receive additional user data
-    data = recieve_data(conn)
+    try:
+        data = reader.read_data()
+    except (OSError, ValueError):
+        data = None
     if not data:  # If no data is received, disconnect the user
         disconnect_user(user_id, addr)
         conn.close()
-        return None, None
+        return None, None, None
 
-    data = pickle.loads(data)  # Deserialize the received data
-    if data.get("updated"):  # If there's updated data, update user stats
-        update_user(user_id, data["updated"], send_all=False)
+    # Acknowledge a newer protocol, everything after this frame uses it
+    ack = apply_user_metadata(user_id, data)
+    if ack:
+        send(ack, conn)
+        reader.protocol = ack["protocol"]
 
-    return user_id, user_stats
+    return user_id, user_stats, reader
 
 
 # Update user data and optionally broadcast the update to all users
@@ -82,17 +175,16 @@ def update_user(user_id, updated, send_all=True):
 
     # Loop through the updated keys to modify user data
     for key in updated:
-        if key in active_users[user_id]:
+        if key in active_users[user_id] and key not in SERVER_OWNED_STATS:
             active_users[user_id][key] = updated[key]  # Update existing data
         else:
-            updated_copy.pop(key)  # Remove unknown keys
+            updated_copy.pop(key)  # Remove unknown keys, and those only the server sets
     if len(updated_copy) == 0:
         return {"error": "Unknown keys!"}  # Return an error for unknown keys
     else:
         if send_all:
             # Broadcast the updated data to all users
-            r = {"updated": {"user_id": user_id, "changed": updated}}
-            send_to_all(r, user_id, True)
+            directory.update(user_id, updated_copy, publish_change(user_id, True))
 
         logger.info(
             f"[UPDATED STATS]: {active_users[user_id]['username']} ({user_id}) \n {updated}"
@@ -101,74 +193,213 @@ def update_user(user_id, updated, send_all=True):
         return {"message": {"title": "Updated successfully!"}}
 
 
+# Outbound queue of a user served by a thread, which sleeps until items arrive
+class SendQueue:
+    def __init__(self):
+        self.items = []
+        self.condition = threading.Condition()
+        self.closed = False
+
+    def append(self, items):
+        with self.condition:
+            self.items.append(items)
+            self.condition.notify()
+
+    def close(self):
+        # Wake the sending thread up so that it can exit
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+    def get_batch(self):
+        # Block until something is queued, then take everything at once
+        with self.condition:
+            while not self.items and not self.closed:
+                self.condition.wait()
+            if self.closed:
+                return []
+            batch, self.items = self.items, []
+            return batch
+
+    @property
+    def depth(self):
+        return len(self.items)
+
+
+# A message that is encoded once and then shared by every queue it is added to.
+# The complete frame, header included, is built once for each wire format in
+# use and the same bytes object goes out to every user on that format
+class Frame:
+    __slots__ = ("data", "raw", "wire")
+
+    def __init__(self, data, raw=False):
+        self.data = data
+        self.raw = raw  # Raw bytes (like images) are sent as they are
+        self.wire = {}  # (codec name, protocol) -> complete frame
+
+    def to_bytes(self, codec, protocol=1):
+        key = (None if self.raw else codec.name, protocol)
+        wire = self.wire.get(key)
+        if wire is None:
+            payload = self.data if self.raw else codec.dumps(self.data)
+            wire = self.wire[key] = frame_data(payload, protocol)
+        return wire
+
+
+# Join queued messages into as few sendall calls as possible
+def batch_frames(batch, codec, protocol=1):
+    chunk, chunk_size = [], 0
+    for frames in batch:
+        for frame in frames:
+            frame = frame.to_bytes(codec, protocol)
+            chunk.append(frame)
+            chunk_size += len(frame)
+            if chunk_size >= SEND_BATCH_BYTES:
+                yield b"".join(chunk)
+                chunk, chunk_size = [], 0
+    if chunk:
+        yield b"".join(chunk)
+
+
 # Function to send data in the send queue for a specific user
-def execute_send_queue(user_id):
+def execute_send_queue(conn, queue, codec, protocol=1):
 
-    while active_users.get(user_id):  # Run while user is still active
+    while True:  # Run while user is still active
+        batch = queue.get_batch()
+        if not batch:  # The queue was closed, the user disconnected
+            break
         try:
-            conn = connections[user_id]  # Get the connection for the user
-            # Iterate over the send queue and send all items
-            for ind, items in enumerate(send_queue[user_id].copy()):
-                for item in items:
-                    lenData = len(item)
-                    if lenData >= DEFAULT_BYTES:  # If data is too large
-                        # Use special method for large data
-                        send_huge(conn, item)
-                    else:
-                        send(item, conn, pickle_data=False)
-
-                send_queue[user_id].remove(items)  # Remove items after sending
+            for data in batch_frames(batch, codec, protocol):
+                conn.sendall(data)
+                metrics.count("bytes_out", len(data))
 
         # Break the loop if any exception occurs (user might be disconnected)
         except:
             break
 
 
-# Add items to the user's send queue
-def add_to_send_queue(user_id, items):
-    send_queue[user_id].append(items)
+# Number of messages waiting to be sent to a user
+def queue_depth(user_id):
+    queue = send_queue.get(user_id)
+    return queue.depth if queue is not None else 0
 
 
-# Send data to all users (with options to filter certain users)
-def send_to_all(
-    data, curr_user_id, to_current_user=False, pickle_data=True, to_bots=True
-):
-    if pickle_data:
-        data = pickle.dumps(data)  # Serialize the data
+# Add frames to the user's send queue
+def add_to_send_queue(user_id, frames):
+    # Encode right away, while the message still says what it said when it
+    # was queued. Frames queued before a new user picked their codec are
+    # encoded again by the sending thread, which only starts after that
+    queue = send_queue.get(user_id)
+    codec, protocol = user_codecs.get(user_id), protocols.get(user_id)
+    if queue is None or codec is None or protocol is None:
+        return  # The user disconnected while this was on its way to them
+
+    for frame in frames:
+        frame.to_bytes(codec, protocol)
+
+    queue.append(frames)
+
+
+# Queue the same frames for every user id given
+def broadcast(frames, user_ids):
+    for user_id in user_ids:
+        add_to_send_queue(user_id, frames)
+
+
+# Ids of all users that pass the filters
+def recipients(curr_user_id=None, to_current_user=False, to_bots=True, predicate=None):
     for user in list(active_users.values()):
         if user["id"] == curr_user_id and not to_current_user:
             continue  # Skip current user if instructed
         if not to_bots and user["bot"]:
             continue  # Skip bots if instructed
+        if predicate and not predicate(user):
+            continue
 
-        add_to_send_queue(user["id"], [data])
+        yield user["id"]
 
 
-# Send an image to all users
-def send_image_to_all(image_data, img):
-    for user in list(active_users.values()):
-        if not user["bot"]:  # Skip bots
-            add_to_send_queue(user["id"], [pickle.dumps(image_data), img])
+# Send data to all users (with options to filter certain users)
+def send_to_all(
+    data, curr_user_id, to_current_user=False, pickle_data=True, to_bots=True,
+    predicate=None,
+):
+    frame = Frame(data, raw=not pickle_data)
+    broadcast([frame], recipients(
+        curr_user_id, to_current_user, to_bots, predicate))
 
 
-# Send large data in batches to handle size limitations
-def send_huge(conn, data_bytes):
+# Publishes a change to the directory about a user, to the clients watching
+# them and every client that isn't watching only some users
+def publish_change(user_id, to_current_user=False):
+    def publish(data, watchers):
+        frame = Frame(data)
+        broadcast([frame], recipients(user_id, to_current_user,
+                                      predicate=lambda user: user["id"] not in directory.watching))
+        # The user hears about their own changes even if they don't watch themselves
+        if to_current_user and user_id in directory.watching:
+            watchers = watchers | {user_id}
+        broadcast([frame], watchers)
+    return publish
+
+
+# Tell the clients watching only some users how many users there are, when
+# that may have changed
+def send_summary():
+    directory.summary(lambda summary, user_ids: broadcast([Frame(summary)], user_ids))
+
+
+def summarise_periodically(interval=SUMMARY_INTERVAL):
+    while True:
+        time.sleep(interval)
+        send_summary()
+
+
+# The frames of a profile picture in the best form a user can read, just
+# its name if they already have it or will ask for it when they need it
+def picture_frames(picture, user_id, requested=False):
+    cached = cached_images.get(user_id)
+    if cached is not None:
+        if picture["hash"] in cached or (user_id in lazy_images and not requested):
+            return picture["cached_frames"]
+        cached.add(picture["hash"])  # They keep it once they have it
+
+    if picture["encoding"] in image_encodings.get(user_id, ()):
+        return picture["compressed_frames"]
+    return picture["frames"]
+
+
+# Send an image to all users, but those who fetch pictures themselves, the
+# directory tells them the new hash
+def send_image_to_all(picture):
+    for user_id in recipients(to_current_user=True, to_bots=False,
+                              predicate=lambda user: user["id"] not in lazy_images):
+        add_to_send_queue(user_id, picture_frames(picture, user_id))
+
+
+# Build the complete bytes of one message, sending huge data in batches
+def frame_data(data_bytes, protocol=1):
     size = len(data_bytes)
-    n_batches = math.ceil(size / DEFAULT_BYTES)  # Calculate number of batches
+    if protocol >= 2:  # A single frame, however big the data is
+        return HEADER_V2.pack(size) + data_bytes
+
+    if size < DEFAULT_BYTES:
+        return struct.pack("h", size) + data_bytes
 
-    # Create batch lengths list
+    n_batches = math.ceil(size / DEFAULT_BYTES)  # Calculate number of batches
     batch_lengths = [DEFAULT_BYTES] * (n_batches - 1) + [
         size - (n_batches - 1) * DEFAULT_BYTES
     ]
-    fmt = "h" * n_batches  # Struct format for batch sizes
-
-    # Inform the receiver about the huge data
-    send({"message_type": "huge", "n_batches": n_batches}, conn)
+    header = pickle.dumps({"message_type": "huge", "n_batches": n_batches})
 
-    # Send the batch sizes and the data in parts
-    conn.sendall(struct.pack(fmt, *batch_lengths))
-    for i in range(n_batches):
-        conn.sendall(data_bytes[i * DEFAULT_BYTES: (i + 1) * DEFAULT_BYTES])
+    return b"".join(
+        [
+            struct.pack("h", len(header)),
+            header,
+            struct.pack("h" * n_batches, *batch_lengths),
+            data_bytes,
+        ]
+    )
 
 
 # Send data to a connection
@@ -188,84 +419,92 @@ def send(data, conn, pickle_data=True):
 
 # Send active user data to a specific user
 def send_all_users(user_id):
-    pickledData = pickle.dumps(active_users)
-    add_to_send_queue(user_id, [pickledData])
+    if user_id in directory_users:
+        # Just the first page, the rest are asked for as they're needed. Lobby
+        # summaries only start once it's queued
+        directory.page(0, lambda page: add_to_send_queue(user_id, [Frame(page)]), user_id,
+                       watch=user_id in watching_users)
+        return
+
+    # Only users that have been announced, anyone else is never told about
+    # leaving again
+    snapshot = {id: user_snapshot(user) for id, user in list(active_users.items())
+                if id in directory}
+    add_to_send_queue(user_id, [Frame(snapshot)])
     # Optionally convert the active users data to JSON (commented out)
 
 
 # Send all profile pictures to a specific user
 def send_all_user_images(user_id):
 
-    for key, image_details in profile_pictures.items():
+    for image_details in list(profile_pictures.values()):
         if image_details is not None:  # If the user has a profile picture
-            imageMetaData = {
-                "image": {
-                    "size": image_details["size"],
-                    "user_id": key,
-                    "shape": image_details["shape"],
-                    "dtype": image_details["dtype"],
-                }
-            }
-
-            # Serialize metadata and image, then add to send queue
-            pickledMetaData = pickle.dumps(imageMetaData)
-            encodedImage = image_details["image"]
-            add_to_send_queue(user_id, [pickledMetaData, encodedImage])
-
-# Function to recieve data
-
-
-def recieve_data(conn):
-    # Receive the length of the incoming data (2 bytes)
-    lenData = conn.recv(2)
-    if not lenData:  # If no data is received, the user has disconnected
-        return ""
-
-    # Unpack the length of the data from the received bytes (2 bytes)
-    lenData = struct.unpack("h", lenData)[0]
-
-    # Receive the data of the specified length
-    data = conn.recv(lenData)
-
-    try:
-        # Try to unpickle the received data
-        pickled = pickle.loads(data)
-        if isinstance(pickled, dict) and pickled.get("message_type") == "huge":
-            # Handle large data sent in batches
-            n_batches = pickled["n_batches"]
-            binData = b""
-            # Receive batch sizes
-            batch_sizes = struct.unpack(
-                "h" * n_batches, conn.recv(2 * n_batches))
-            for size in batch_sizes:
-                try:
-                    # Receive each batch of data
-                    batchData = conn.recv(size)
-                except Exception as e:
-                    logger.error(f"Error while recieving data: {e}")
+            # The metadata and image frames are shared with every other user
+            add_to_send_queue(user_id, picture_frames(image_details, user_id))
+
+# Start a game, with the locks of its players held
+def add_game(game_id, game):
+    games[game_id] = game
+    for player_id in game["players"]:
+        user_games.setdefault(player_id, set()).add(game_id)
+
+
+# Remove a game that is over, with the locks of its players held
+def end_game(game_id):
+    game = games.pop(game_id, None)
+    if game is None:
+        return
+    for player_id in game["players"]:
+        game_ids = user_games.get(player_id)
+        if game_ids is not None:
+            game_ids.discard(game_id)
+            if not game_ids:
+                user_games.pop(player_id)
+
+
+# Ids of the games a user is playing
+def games_of(user_id):
+    return list(user_games.get(user_id, ()))
+
+
+# Ids of every user that disconnecting a user changes the state of
+def related_users(user_id):
+    related = {user_id}
+    user = active_users.get(user_id)
+    if user is not None:
+        related.update(user["challenged"])
+        related.update(user["pending"])
+        for game_id in games_of(user_id):
+            related.update(game_players(game_id))
+    return related
 
-                if not batchData:
-                    return ""  # If no data is received, the user has disconnected
-
-                binData += batchData  # Append batch data to complete the data
-
-            return binData  # Return the complete binary data
-    except Exception as e:
-        # If an exception occurs during unpickling, return the original data
-        pass
-
-    return data  # Return the data if it's not a huge message
 
 # Function to properly disconnect user
+def disconnect_user(user_id, addr):
+    # Nobody can challenge this user or start a game with them without its
+    # lock, so once the users it touches are all locked they stay the same
+    related = related_users(user_id)
+    while True:
+        with user_locks.hold(*related):
+            now_related = related_users(user_id)
+            if user_locks.holds(related, now_related):
+                remove_user(user_id, addr)
+                return
+        related |= now_related  # Someone got involved before the locks were taken
 
 
-def disconnect_user(user_id, addr):
+# Remove a user from everything, with the locks of everyone involved held
+def remove_user(user_id, addr):
+    user_name = user_id
     try:
-        # If the user was engaged in a game, handle game termination
-        if active_users[user_id]["engaged"]:
-            for game_id in games:
-                player_ids = games[game_id]["players"]
-                if user_id in player_ids:
+        # End every game the user was playing
+        for game_id in games_of(user_id):
+            game = games[game_id]
+            for player in game["players"].values():
+                id = player["id"]
+                if id != user_id:
+                    # Inform the other player that the game is over and they win
+                    player["engaged"] = False
                     r = {}
                     r["message"] = {
                         "title": "Player left",
@@ -273,18 +512,13 @@ def disconnect_user(user_id, addr):
                     }
                     r["game_over"] = {
                         "game_id": game_id,
+                        "winner_id": id,
                     }
-
-                    for player in games[game_id]["players"].values():
-                        id = player["id"]
-                        if id != user_id:
-                            # Inform the other player that the game is over and they win
-                            active_users[id]["engaged"] = False
-                            r["game_over"]["winner_id"] = id
-                            add_to_send_queue(id, [pickle.dumps(r)])
+                    add_to_send_queue(id, [Frame(r)])
 
             # Remove the game from the active games list
-            games.pop(game_id)
+            end_game(game_id)
+            metrics.count("games_finished", reason="disconnect")
             logger.info(f"[GAME OVER]: {game_id}")
 
         # Handle challenges if the user was involved in any
@@ -298,7 +532,7 @@ def disconnect_user(user_id, addr):
                     "title": "User disconnected.",
                     "text": u["username"],
                 }
-                add_to_send_queue(u["id"], [pickle.dumps(r)])
+                add_to_send_queue(u["id"], [Frame(r)])
                 logger.info(
                     f"[CANCELLED CHALLENGE]: {active_users[user_id]['username']} ({user_id}) to {u['username']} ({u['id']})")
 
@@ -313,7 +547,7 @@ def disconnect_user(user_id, addr):
                     "title": "User disconnected.",
                     "text": active_users[user_id]["username"],
                 }
-                add_to_send_queue(u["id"], [pickle.dumps(r)])
+                add_to_send_queue(u["id"], [Frame(r)])
                 logger.info(
                     f"[REJECTED CHALLENGE]: {active_users[user_id]['username']} ({user_id}) from {u['username']} ({u['id']})")
 
@@ -323,12 +557,19 @@ def disconnect_user(user_id, addr):
             profile_pictures.pop(user_id)
         active_users.pop(user_id)
         connections.pop(user_id)
-        send_queue.pop(user_id)
+        send_queue.pop(user_id).close()
+        protocols.pop(user_id, None)
+        user_codecs.pop(user_id, None)
+        image_encodings.pop(user_id, None)
+        cached_images.pop(user_id, None)
+        lazy_images.discard(user_id)
+        directory_users.discard(user_id)
+        watching_users.discard(user_id)
+        pending_images.pop(user_id, None)
 
         # Notify all active users that this user has disconnected
-        d = {}
-        d["disconnected"] = user_id
-        send_to_all(d, user_id, False)
+        directory.disconnect(user_id, publish_change(user_id))
+        metrics.count("disconnections")
 
     except Exception as e:
         # If an exception occurs during disconnection, handle cleanup and notification
@@ -339,361 +580,581 @@ def disconnect_user(user_id, addr):
             user_name = active_users[user_id]["username"]
             active_users.pop(user_id)
             connections.pop(user_id)
-            send_queue.pop(user_id)
+            send_queue.pop(user_id).close()
+            protocols.pop(user_id, None)
+            user_codecs.pop(user_id, None)
+            image_encodings.pop(user_id, None)
+            cached_images.pop(user_id, None)
+            lazy_images.discard(user_id)
+            directory_users.discard(user_id)
+            watching_users.discard(user_id)
+            pending_images.pop(user_id, None)
 
         # Notify all active users that this user has disconnected
-        d = {}
-        d["disconnected"] = user_id
-        send_to_all(d, user_id, False)
+        directory.disconnect(user_id, publish_change(user_id))
 
     logger.warning(
         f"[DISCONNECTED]: {user_name} ({user_id}) | ADDRESS: {addr}")
 
 
-# Handle communication with a single client
-def threaded_client(conn, addr, user_id, user_stats):
+# Handlers for every kind of message a client sends, filled in by @handles.
+# Each one gets the sender's stats, the value sent under its key and the reply
+# to fill in, so a new kind of message only needs a new handler.
+# touches gives the ids of the other users a message changes, whose locks
+# are held along with the sender's while the handler runs. Empty values (None,
+# 0, [], {}) are skipped, unless empty says they mean something to the handler
+handlers = {}  # kind -> (handler, touches, empty)
+
+
+def handles(kind, touches=lambda value: (), empty=False):
+    def register(handler):
+        handlers[kind] = (handler, touches, empty)
+        return handler
+    return register
+
+
+# Ids of the players of a game, if it exists
+def game_players(game_id):
+    game = games.get(game_id)
+    return tuple(game["players"]) if game else ()
+
+
+# A new game as a player can read it. Clients from before protocol 2 unpickle
+# the server's board, newer ones get it as plain data whatever their codec
+def game_for(new_game, user_id):
+    board = new_game["details"]["board"]
+    if protocols.get(user_id, 1) > 1:
+        board = board.to_dict()
+    return {**new_game, "details": {**new_game["details"], "board": board}}
+
+
+# Copy of a user's stats to send, which other threads can't change while it's encoded
+def user_snapshot(user):
+    return {**user, "challenged": dict(user["challenged"]), "pending": dict(user["pending"])}
+
+
+# Handle challenge requests
+@handles("challenge", touches=lambda challenge: challenge[:1])
+def handle_challenge(user, challenge, reply):
+    user_id = user["id"]
+    challenged_user_id, game = challenge
+    challenged = active_users.get(challenged_user_id)
+
+    # Check for errors in the challenge request
+    if challenged is None or challenged_user_id not in connections:
+        reply["error"] = "Invalid User ID!"
+    elif len(user["challenged"]) > 0:
+        reply["error"] = "You have already challenged someone!"
+    elif len(user["pending"]) > 0:
+        reply["error"] = "You have a pending request!"
+    elif user["engaged"]:
+        reply["error"] = "You are in a game"
+    elif challenged["engaged"] and not challenged["bot"]:
+        reply["error"] = "User is in a game!"
+    elif len(challenged["pending"]) and not challenged["bot"]:
+        reply["error"] = "That user has a pending request!"
+    else:
+        # Prepare the challenge request message for the challenged user
+        challenge_req = {}
+        game_id = f"{user_id}-{challenged_user_id}-{game}"
+        challenge_req["message"] = {
+            "title": f"Challenge from {user['username']}: {game}",
+            "buttons": ["accept", "reject"],
+            "context": {"challenger_id": user_id, "game": game},
+            "closeable": False,
+            "id": game_id,
+        }
+        challenge_req["challenge"] = {
+            "challenger_id": user_id,
+            "game": game,
+        }
+
+        # Add the challenge request to the challenged user's send queue
+        add_to_send_queue(challenged_user_id, [Frame(challenge_req)])
+
+        # Update the challenge and pending request status for both users
+        user["challenged"][challenged_user_id] = game
+        challenged["pending"][user_id] = game
+
+        # Send confirmation to the user who initiated the challenge
+        reply["message"] = {
+            "closeable": False,
+            "title": "Sent successfully",
+            "buttons": ["cancel"],
+            "context": {"opp_id": challenged_user_id, "game": game},
+            "id": game_id,
+        }
 
-    # Send all active users' information to the connected user
-    send_all_users(user_id)  # Done
+        logger.info(
+            f"[CHALLENGE]: {user['username']} ({user_id}) challenged {challenged['username']} ({challenged_user_id}) for {game}")
 
-    # If the user is not a bot, send all user images to the connected user
-    if not user_stats["bot"]:
-        send_all_user_images(user_id)  # Done
 
-    # Notify all other users about this new user's connection
-    d = {"connected": user_stats}
-    send_to_all(d, user_id, to_current_user=False)  # Done
+# Handle canceling a challenge
+@handles("cancel_challenge", touches=lambda cancel: (cancel["opp_id"],))
+def handle_cancel_challenge(user, cancel, reply):
+    user_id = user["id"]
+    opp_id = cancel["opp_id"]
+    game = cancel["game"]
 
-    while True:
-        try:
-            # Receive data from the client
-            data = recieve_data(conn)
+    if user["challenged"].get(opp_id):
+        opponent = active_users[opp_id]
 
-            # If no data is received, the client has disconnected
-            if not data:
-                break
+        # Remove challenge from the user's challenges and opponent's pending requests
+        user["challenged"].pop(opp_id)
+        opponent["pending"].pop(user_id)
 
-            # Deserialize the received data from bytes
-            data = pickle.loads(data)
-
-            # Initialize a reply dictionary to respond to the client
-            reply = {"status": "connected"}
-
-            # Handle challenge requests
-            if data.get("challenge"):
-                challenged_user_id, game = data["challenge"]
-
-                # Check for errors in the challenge request
-                if challenged_user_id not in connections.keys():
-                    reply["error"] = "Invalid User ID!"
-                elif len(active_users[user_id]["challenged"]) > 0:
-                    reply["error"] = "You have already challenged someone!"
-                elif len(active_users[user_id]["pending"]) > 0:
-                    reply["error"] = "You have a pending request!"
-                elif active_users[user_id]["engaged"]:
-                    reply["error"] = "You are in a game"
-                elif (
-                    active_users[challenged_user_id]["engaged"]
-                    and not active_users[challenged_user_id]["bot"]
-                ):
-                    reply["error"] = "User is in a game!"
-                elif (
-                    len(active_users[challenged_user_id]["pending"])
-                    and not active_users[challenged_user_id]["bot"]
-                ):
-                    reply["error"] = "That user has a pending request!"
-                else:
-                    # Prepare the challenge request message for the challenged user
-                    challenge_req = {}
-                    game_id = f"{user_id}-{challenged_user_id}-{game}"
-                    challenge_req["message"] = {
-                        "title": f"Challenge from {active_users[user_id]['username']}: {game}",
-                        "buttons": ["accept", "reject"],
-                        "context": {"challenger_id": user_id, "game": game},
-                        "closeable": False,
-                        "id": game_id,
-                    }
-                    challenge_req["challenge"] = {
-                        "challenger_id": user_id,
-                        "game": game,
-                    }
+        # Send a cancellation message to the opponent
+        reply_to_opp = {}
+        reply_to_opp["cancel"] = {"id": user_id, "game": game}
+        reply_to_opp["message"] = {
+            "id": f"{user_id}-{opp_id}-{game}",
+            "title": "Challenge canceled",
+            "text": f"by {user['username']}",
+        }
 
-                    # Add the challenge request to the challenged user's send queue
-                    add_to_send_queue(challenged_user_id, [
-                                      pickle.dumps(challenge_req)])
-
-                    # Update the challenge and pending request status for both users
-                    active_users[user_id]["challenged"][challenged_user_id] = game
-                    active_users[challenged_user_id]["pending"][user_id] = game
-
-                    # Send confirmation to the user who initiated the challenge
-                    reply["message"] = {
-                        "closeable": False,
-                        "title": "Sent successfully",
-                        "buttons": ["cancel"],
-                        "context": {"opp_id": challenged_user_id, "game": game},
-                        "id": game_id,
-                    }
+        add_to_send_queue(opp_id, [Frame(reply_to_opp)])
 
-                    logger.info(
-                        f"[CHALLENGE]: {active_users[user_id]['username']} ({user_id}) challenged {active_users[challenged_user_id]['username']} ({challenged_user_id}) for {game}")
-
-            # Handle canceling a challenge
-            if data.get("cancel_challenge"):
-                opp_id = data["cancel_challenge"]["opp_id"]
-                game = data["cancel_challenge"]["game"]
-
-                if active_users[user_id]["challenged"].get(opp_id):
-                    # Remove challenge from the user's challenges and opponent's pending requests
-                    active_users[user_id]["challenged"].pop(opp_id)
-                    active_users[opp_id]["pending"].pop(user_id)
-
-                    # Send a cancellation message to the opponent
-                    reply_to_opp = {}
-                    reply_to_opp["cancel"] = {"id": user_id, "game": game}
-                    reply_to_opp["message"] = {
-                        "id": f"{user_id}-{opp_id}-{game}",
-                        "title": "Challenge canceled",
-                        "text": f"by {active_users[user_id]['username']}",
-                    }
+        # Send confirmation to the user who canceled the challenge
+        reply["message"] = {
+            "id": f"{user_id}-{opp_id}-{game}",
+            "title": "Message",
+            "text": "Cancelled successfully.",
+        }
 
-                    add_to_send_queue(opp_id, [pickle.dumps(reply_to_opp)])
+        logger.info(
+            f"[CANCELLED CHALLENGE] {user['username']} ({user_id}) to {opponent['username']} ({opp_id})")
 
-                    # Send confirmation to the user who canceled the challenge
-                    reply["message"] = {
-                        "id": f"{user_id}-{opp_id}-{game}",
-                        "title": "Message",
-                        "text": "Cancelled successfully.",
-                    }
+    else:
+        reply["error"] = "No pending challenges from that user!"
+
+
+# Handle accepting a challenge and starting the game
+@handles("accepted", touches=lambda d: (d["player1_id"],))
+def handle_accepted(player2, d, reply):
+    user_id = player2["id"]
+    player1 = active_users.get(d["player1_id"])
+    game = d["game"]
+
+    # Check for errors in accepting the challenge
+    if not player1:
+        reply["error"] = "Invalid user id!"
+    elif player1["engaged"]:
+        reply["error"] = "User is in a game!"
+    elif player2["engaged"] and not player2["bot"]:
+        reply["error"] = "You are in a game"
+    elif player1["challenged"].get(user_id) != game:
+        reply["error"] = f"{player1['username']} hasn't challenged you!"
+    elif not games_lookup.get(game):
+        reply["error"] = "Invalid game!"
+    else:
+        # Setup the game
+        player1["challenged"].pop(user_id)
+        player2["pending"].pop(player1["id"])
+
+        game_id = f"{player1['id']}-{user_id}-{game}"
+        board = games_lookup.get(game)(player1, player2)
+        identification_dict = board.get_identification_dict()
+
+        new_game = {
+            "players": {player1["id"]: player1, player2["id"]: player2},
+            "game": game,
+            "identification_dict": identification_dict,
+            "details": {"game_id": game_id, "board": board},
+        }
+
+        add_game(game_id, new_game)
+        metrics.count("games_started", game=game)
+
+        player1["engaged"], player2["engaged"] = True, True
+
+        # The game keeps the players' own stats, the messages get copies
+        new_game = {**new_game, "players": {
+            player1["id"]: user_snapshot(player1), player2["id"]: user_snapshot(player2)}}
+
+        # Notify both players that the game has started
+        reply_to_player1 = {}
+        reply_to_player1["new_game"] = game_for(new_game, player1["id"])
+        reply_to_player1["message"] = {
+            "id": game_id,
+            "title": "Game started.",
+            "text": "Have fun!",
+        }
+
+        add_to_send_queue(player1["id"], [Frame(reply_to_player1)])
+
+        reply["new_game"] = game_for(new_game, user_id)
+        reply["message"] = {
+            "title": "Game started.",
+            "text": "Have fun!",
+            "id": game_id,
+        }
 
-                    logger.info(
-                        f"[CANCELLED CHALLENGE] {active_users[user_id]['username']} ({user_id}) to {active_users[opp_id]['username']} ({opp_id})")
-
-                else:
-                    reply["error"] = "No pending challenges from that user!"
-
-            # Handle accepting a challenge and starting the game
-            if data.get("accepted"):
-                d = data["accepted"]
-
-                player1 = active_users.get(d["player1_id"])
-                player2 = active_users[user_id]
-                game = d["game"]
-
-                # Check for errors in accepting the challenge
-                if not player1:
-                    reply["error"] = "Invalid user id!"
-                elif player1["engaged"]:
-                    reply["error"] = "User is in a game!"
-                elif player1["challenged"].get(user_id) != game:
-                    reply["error"] = f"{player1['username']} hasn't challenged you!"
-                elif not games_lookup.get(game):
-                    reply["error"] = "Invalid game!"
-                else:
-                    # Setup the game
-                    player1["challenged"].pop(user_id)
-                    player2["pending"].pop(player1["id"])
-
-                    game_id = f"{player1['id']}-{user_id}-{game}"
-                    board = games_lookup.get(game)(player1, player2)
-                    identification_dict = board.get_identification_dict()
-
-                    new_game = {
-                        "players": {player1["id"]: player1, player2["id"]: player2},
-                        "game": game,
-                        "identification_dict": identification_dict,
-                        "details": {"game_id": game_id, "board": board},
-                    }
+        logger.info(
+            f"[ACCEPTED CHALLENGE]: {player2['username']} ({player2['id']}) from {player1['username']} ({player1['id']})")
 
-                    games[game_id] = new_game
 
-                    player1["engaged"], player2["engaged"] = True, True
+# Handle rejecting a challenge
+@handles("rejected", touches=lambda d: (d["player1_id"],))
+def handle_rejected(player2, d, reply):
+    user_id = player2["id"]
+    player1 = active_users.get(d["player1_id"])
+    game = d["game"]
 
-                    # Notify both players that the game has started
-                    reply_to_player1 = {}
-                    reply_to_player1["new_game"] = new_game
-                    reply_to_player1["message"] = {
-                        "id": game_id,
-                        "title": "Game started.",
-                        "text": "Have fun!",
-                    }
+    # Check for errors in rejecting the challenge
+    if not player1:
+        reply["error"] = "Invalid user id!"
+    elif not player1["challenged"].get(user_id):
+        reply["error"] = "User hasn't challenged you!"
+    else:
+        # Notify the challenger that their challenge was rejected
+        player1["challenged"].pop(user_id)
+        player2["pending"].pop(player1["id"])
 
-                    add_to_send_queue(
-                        player1["id"], [pickle.dumps(reply_to_player1)])
+        reply_to_player1 = {}
+        reply_to_player1["message"] = {
+            "id": f"{player1['id']}-{user_id}-{game}",
+            "title": "Challenge rejected",
+            "text": f"for {game} by {player2['username']}",
+        }
 
-                    reply["new_game"] = new_game
-                    reply["message"] = {
-                        "title": "Game started.",
-                        "text": "Have fun!",
-                        "id": game_id,
-                    }
+        add_to_send_queue(player1["id"], [Frame(reply_to_player1)])
 
-                    logger.info(
-                        f"[ACCEPTED CHALLENGE]: {player2['username']} ({player2['id']}) from {player1['username']} ({player1['id']})")
-
-            # Handle rejecting a challenge
-            if data.get("rejected"):
-                d = data["rejected"]
-                player1 = active_users.get(d["player1_id"])
-                player2 = active_users[user_id]
-                game = d["game"]
-
-                # Check for errors in rejecting the challenge
-                if not player1:
-                    reply["error"] = "Invalid user id!"
-                elif not player1["challenged"].get(user_id):
-                    reply["error"] = "User hasn't challenged you!"
-                else:
-                    # Notify the challenger that their challenge was rejected
-                    player1["challenged"].pop(user_id)
-                    player2["pending"].pop(player1["id"])
-
-                    reply_to_player1 = {}
-                    reply_to_player1["message"] = {
-                        "id": f"{player1['id']}-{user_id}-{game}",
-                        "title": "Challenge rejected",
-                        "text": f"for {game} by {player2['username']}",
-                    }
+        logger.info(
+            f"[REJECTED CHALLENGE]: {player2['username']} ({player2['id']}) from {player1['username']} ({player1['id']})")
+
+
+# Handle quitting a game
+@handles("quit", touches=game_players)
+def handle_quit(user, game_id, reply):
+    user_id = user["id"]
+    game = games.get(game_id)
+
+    if game and user_id in game["players"]:
+        r = {}
+        r["message"] = {
+            "title": f"Game ended by {user['username']}"
+        }
+
+        winner_id = None
+
+        # Determine the winner if it's a two-player game
+        if len(game["players"]) == 2:
+            for id in game["players"].keys():
+                if id != user_id:
+                    winner_id = id
+                    break
+            r["game_over"] = {
+                "game_id": game_id,
+                "winner_id": winner_id,
+            }
 
-                    add_to_send_queue(
-                        player1["id"], [pickle.dumps(reply_to_player1)])
+        # Disengage all players and delete the game
+        for player in game["players"].values():
+            player["engaged"] = False
+        broadcast([Frame(r)], game["players"].keys())
 
-                    logger.info(
-                        f"[REJECTED CHALLENGE]: {player2['username']} ({player2['id']}) from {player1['username']} ({player1['id']})")
+        end_game(game_id)  # Delete the game
+        metrics.count("games_finished", reason="quit")
 
-            # Handle quitting a game
-            if data.get("quit"):
-                game_id = data["quit"]
+        logger.info(
+            f"[QUIT GAME]: {user['username']} ({user_id}) | GAME ID: {game_id}")
 
-                if games.get(game_id) and user_id in games.get(game_id)["players"]:
-                    r = {}
-                    r["message"] = {
-                        "title": f"Game ended by {active_users[user_id]['username']}"
-                    }
+    else:
+        reply["error"] = "Invalid game details!"
+
+
+# Handle making a move in a game
+@handles("move", touches=lambda move: game_players(move.get("game_id")))
+def handle_move(user, move, reply):
+    game_id = move.get("game_id")
+    game = games.get(game_id)
+    if not game:
+        reply["error"] = "Game does not exist!"
+        return
+
+    # Validate and make the move if it's valid
+    board = game["details"]["board"]
+    is_valid, err = board.validate(user["id"], move.get("move"))
+    if not is_valid:
+        reply["error"] = err
+        return
+
+    game_over, r = board.move(move.get("move"))
+    r["moved"]["game_id"] = game_id
+
+    # Handle game over condition
+    if game_over:
+        r["game_over"] = {
+            "game_id": game_id,
+            "winner_id": game_over["winner_id"],
+            "indices": game_over.get("indices"),
+        }
+        logger.info(f"[GAME OVER]: {game_id}")
+
+        for player in game["players"].values():
+            player["engaged"] = False
+        end_game(game_id)
+        metrics.count("games_finished", reason="result")
+
+    # Both players get the same frame
+    broadcast([Frame(r)], game["players"].keys())
+
+
+# Handle updating the user's profile image
+@handles("image")
+def handle_image(user, image, reply):
+    user_id = user["id"]
+    logger.info(f"[UPLOADING IMAGE]: {user['username']} ({user_id})")
+    size, shape, dtype = (
+        image["size"],
+        image["shape"],
+        str(image["dtype"]),  # Plain names like "uint8" work anywhere
+    )
+    if size > max_image_size:
+        error = {"error": "Image too large.",
+                 "image_allowed": False}
+        add_to_send_queue(user_id, [Frame(error)])
+        logger.info(
+            f"[CANCELLED UPLOADING]: {user['username']} ({user_id})")
+    else:
+        add_to_send_queue(user_id, [Frame({"image_allowed": True})])
+
+        # The actual image data arrives as the next frame from this user
+        pending_images[user_id] = {
+            "size": size,
+            "shape": shape,
+            "dtype": dtype,
+            "reply": reply,
+        }
+
+
+# Send the pictures of some users, asked for by clients that fetch the ones
+# they show or that were told they had one but lost it
+@handles("image_request")
+def handle_image_request(user, user_ids, reply):
+    cached = cached_images.get(user["id"], set())
+    for picture_user_id in list(user_ids)[:MAX_IMAGE_REQUEST]:
+        picture = profile_pictures.get(picture_user_id)
+        if picture is not None:
+            cached.discard(picture["hash"])
+            add_to_send_queue(user["id"], picture_frames(picture, user["id"], requested=True))
+
+
+# Send the next page of the directory, or the first (0) to start over
+@handles("directory_page", empty=True)  # 0 is the first page
+def handle_directory_page(user, after, reply):
+    if not isinstance(after, int):
+        reply["error"] = "Bad directory page."
+        return
+    directory.page(after, lambda page: add_to_send_queue(user["id"], [Frame(page)]),
+                   None if after else user["id"])
+
+
+# Only send changes to these users from now on, plus summaries of the rest
+@handles("watch", empty=True)  # Watching nobody
+def handle_watch(user, user_ids, reply):
+    if not isinstance(user_ids, (list, tuple)):
+        reply["error"] = "Bad list of users to watch."
+        return
+    directory.watch(user["id"], user_ids, lambda watched: add_to_send_queue(user["id"], [Frame(watched)]))
+
+
+# Handle updating user information (e.g., username)
+@handles("updated")
+def handle_updated(user, updated, reply):
+    reply.update(update_user(user["id"], updated))
+
+
+# The kind of a decoded message, for the metrics
+def message_type(data):
+    for kind in data:
+        if kind in handlers:
+            return kind
+    return "other"
+
+
+# Handle a single decoded message from a client and build the reply to it
+def handle_data(user_id, data):
+    # Initialize a reply dictionary to respond to the client
+    reply = {"status": "connected"}
+    user = active_users[user_id]
+
+    # Clients send one kind of message at a time, but any mix is handled
+    for kind, value in data.items():
+        if kind not in handlers:
+            continue
+        handler, touches, empty = handlers[kind]
+        if not value and not (empty and value is not None):
+            continue
+        with user_locks.hold(user_id, *touches(value)):
+            handler(user, value, reply)
+
+    # Hold the reply back until the image data itself has arrived
+    if user_id in pending_images:
+        return None
+
+    return reply
+
+
+# Name, compress and frame an uploaded profile picture, None if it can't be.
+# This is the slow part of an upload, and touches nothing shared, so the
+# asyncio server runs it off the event loop
+def encode_picture(user_id, full_image, details):
+    size, shape, dtype = details["size"], details["shape"], details["dtype"]
+
+    # Compressed once here, for every client that can read it
+    try:
+        compression, compressed = images.compress(full_image, shape, dtype, IMAGE_BITS)
+    except (ValueError, TypeError) as e:
+        # The data doesn't fit its shape or dtype, so it's passed on as it came
+        logger.warning(f"[IMAGE NOT COMPRESSED]: {user_id} {e}")
+        compression, compressed = {"encoding": None}, None
+
+    # With bits dropped, everyone gets the same lossy picture, named as such
+    # so clients never mistake it for the original
+    bits = compression.get("bits", 8)
+    if bits < 8:
+        full_image = images.decompress(compression, compressed, shape, dtype)
+
+    # A picture is named by its shape and dtype too, without them it's refused
+    try:
+        image_hash = images.content_hash(full_image, shape, dtype, bits)
+    except (ValueError, TypeError) as e:
+        logger.warning(f"[IMAGE REFUSED]: {user_id} {e}")
+        return None
+
+    # Frame the metadata and image once, every user who gets this picture
+    # now or when they connect later is sent the same bytes
+    image_data = {
+        "image": {
+            "size": size,
+            "user_id": user_id,
+            "shape": shape,
+            "dtype": dtype,
+            "hash": image_hash,
+        }
+    }
+    frames = [Frame(image_data), Frame(full_image, raw=True)]
+    # Users who already have the picture are only told whose it is
+    cached_frames = [Frame({"image": {"user_id": user_id, "hash": image_hash, "cached": True}})]
+
+    compressed_frames = None
+    if compressed is not None:
+        compressed_data = {"image": {**image_data["image"], **compression}}
+        compressed_frames = [Frame(compressed_data), Frame(compressed, raw=True)]
+        metrics.count("image_bytes_uploaded", size)
+        metrics.count("image_bytes_compressed", len(compressed))
+
+    return {
+        "size": size,
+        "user_id": user_id,
+        "shape": shape,
+        "dtype": dtype,
+        "image": full_image,
+        "frames": frames,
+        "encoding": compression["encoding"],
+        "compressed_frames": compressed_frames,
+        "hash": image_hash,
+        "cached_frames": cached_frames,
+    }
 
-                    winner_id = None
-
-                    # Determine the winner if it's a two-player game
-                    if len(games.get(game_id)["players"]) == 2:
-                        for id in games.get(game_id)["players"].keys():
-                            if id != user_id:
-                                winner_id = id
-                                break
-                        r["game_over"] = {
-                            "game_id": game_id,
-                            "winner_id": winner_id,
-                        }
-
-                    # Disengage all players and delete the game
-                    for player in games.get(game_id)["players"].values():
-                        player["engaged"] = False
-                        add_to_send_queue(player["id"], [pickle.dumps(r)])
-
-                    games.pop(game_id)  # Delete the game
-
-                    logger.info(
-                        f"[QUIT GAME]: {active_users[user_id]['username']} ({user_id}) | GAME ID: {game_id}")
-
-                else:
-                    reply["error"] = "Invalid game details!"
-
-            # Handle making a move in a game
-            if data.get("move") is not None:
-                game_id = data["move"].get("game_id")
-                game = games.get(game_id)
-                if not game:
-                    reply["error"] = "Game does not exist!"
-
-                else:
-                    # Validate and make the move if it's valid
-                    is_valid, err = game["details"]["board"].validate(
-                        user_id, data["move"].get("move")
-                    )
-                    if is_valid:
-                        game_over, r = game["details"]["board"].move(
-                            data["move"].get("move")
-                        )
-                        r["moved"]["game_id"] = game_id
-
-                        # Handle game over condition
-                        if game_over:
-                            r["game_over"] = {
-                                "game_id": game_id,
-                                "winner_id": game_over["winner_id"],
-                                "indices": game_over.get("indices"),
-                            }
-                            logger.info(f"[GAME OVER]: {game_id}")
-
-                        for id in game["players"].keys():
-                            if game_over:
-                                active_users[id]["engaged"] = False
-
-                            add_to_send_queue(id, [pickle.dumps(r)])
-
-                    else:
-                        reply["error"] = err
-
-            # Handle updating the user's profile image
-            if data.get("image"):
-                logger.info(
-                    f"[UPLOADING IMAGE]: {active_users[user_id]['username']} ({user_id})")
-                size, shape, dtype = (
-                    data["image"]["size"],
-                    data["image"]["shape"],
-                    data["image"]["dtype"],
-                )
-                if size > max_image_size:
-                    error = {"error": "Image too large.",
-                             "image_allowed": False}
-                    add_to_send_queue(user_id, [pickle.dumps(error)])
-                    logger.info(
-                        f"[CANCELLED UPLOADING]: {active_users[user_id]['username']} ({user_id})")
-                else:
-                    add_to_send_queue(
-                        user_id, [pickle.dumps({"image_allowed": True})])
-
-                    # Receive the actual image data
-                    full_image = recieve_data(conn)
-
-                    # If the user disconnected before the image was fully received
-                    if full_image == "":
-                        continue
-
-                    logger.info(
-                        f"[UPLOADED IMAGE]: {active_users[user_id]['username']} ({user_id})")
-
-                    # Update the profile picture dictionary
-                    profile_pictures[user_id] = {
-                        "size": size,
-                        "user_id": user_id,
-                        "shape": shape,
-                        "dtype": dtype,
-                        "image": full_image,
-                    }
 
-                    # Send the updated image to all users
-                    image_data = {
-                        "image": {
-                            "size": size,
-                            "user_id": user_id,
-                            "shape": shape,
-                            "dtype": dtype,
-                        }
-                    }
+# Store an uploaded profile picture and share it with everyone, encoding it
+# first unless that's been done already
+def recieve_profile_picture(user_id, full_image, picture=None):
+    details = pending_images.pop(user_id)
+    reply = details["reply"]
+
+    logger.info(
+        f"[UPLOADED IMAGE]: {active_users[user_id]['username']} ({user_id})")
+
+    if picture is None:
+        picture = encode_picture(user_id, full_image, details)
+    if picture is None:
+        reply["error"] = "Bad image shape or dtype."
+        return reply
+
+    # Update the profile picture dictionary
+    profile_pictures[user_id] = picture
+    active_users[user_id]["avatar"] = picture["hash"]
+    directory.update(user_id, {"avatar": picture["hash"]}, publish_change(user_id, True))
+
+    # Send the updated image to all users
+    send_image_to_all(picture)
+
+    # Finish the reply that was held back when the upload started
+    reply["message"] = {"title": "Uploaded successfully!"}
+
+    logger.debug(
+        f"[FINISHED UPLOAD]: {active_users[user_id]['username']} ({user_id})")
+
+    return reply
+
+
+# Send a freshly connected user the lobby and announce them to everyone
+def announce_user(user_id, user_stats):
+
+    # Notify all other users about this new user's connection
+    directory.connect(user_stats, publish_change(user_id))
+
+    # Send all active users' information to the connected user
+    send_all_users(user_id)  # Done
+
+    # If the user is not a bot, send all user images to the connected user,
+    # unless they ask for the ones they show
+    if not user_stats["bot"] and user_id not in lazy_images:
+        send_all_user_images(user_id)  # Done
+
 
-                    send_image_to_all(image_data, full_image)
+# Process one frame received from a client and queue the reply
+def process_frame(user_id, data, picture=None):
+    start = time.perf_counter()
+    metrics.count("bytes_in", len(data))
 
-                    reply["message"] = {"title": "Uploaded successfully!"}
+    # The frame following an accepted image upload is the raw image, maybe
+    # already encoded
+    if user_id in pending_images:
+        kind = "image_data"
+        reply = recieve_profile_picture(user_id, data, picture)
+    else:
+        # Deserialize the received data from bytes
+        data = user_codecs[user_id].loads(data)
+        kind = message_type(data)
+        reply = handle_data(user_id, data)
+
+    # Send the reply back to the client
+    if reply:
+        add_to_send_queue(user_id, [Frame(reply)])
+
+    metrics.count("messages", type=kind)
+    metrics.observe("handler_seconds", time.perf_counter() - start, type=kind)
+
+
+# Values the metrics read from the server's state whenever they are scraped
+def register_gauges():
+    metrics.gauge("active_connections", lambda: len(connections))
+    metrics.gauge("active_games", lambda: len(games))
+    metrics.gauge("pending_images", lambda: len(pending_images))
+    metrics.gauge("send_queue_depth", lambda: {
+        (("user", user_id),): queue.depth for user_id, queue in list(send_queue.items())})
+
+
+# Handle communication with a single client
+def threaded_client(conn, addr, user_id, user_stats, reader):
 
-                    logger.debug(
-                        f"[FINISHED UPLOAD]: {active_users[user_id]['username']} ({user_id})")
+    # Bring the new user up to date and tell everyone about them
+    announce_user(user_id, user_stats)
 
-            # Handle updating user information (e.g., username)
-            if data.get("updated"):
-                reply.update(update_user(user_id, data["updated"]))
+    while True:
+        try:
+            # Receive data from the client
+            data = reader.read_data()
+
+            # If no data is received, the client has disconnected
+            if not data:
+                break
 
-            # Send the reply back to the client
-            add_to_send_queue(user_id, [pickle.dumps(reply)])
+            process_frame(user_id, data)
 
         except Exception as e:
             # Print an error message if there was an issue processing the data
@@ -706,6 +1167,8 @@ def threaded_client(conn, addr, user_id, user_stats):
                 logger.warning(f"No data received from {user_id}")
             break
 
+    logger.debug(f"[RECEIVED]: {user_id} {reader.stats()}")
+
     # Clean up when the user disconnects
     disconnect_user(user_id, addr)
     # Close the connection
@@ -714,6 +1177,7 @@ def threaded_client(conn, addr, user_id, user_stats):
 
 def main():
     global total_connections_so_far
+    start_new_thread(summarise_periodically, ())
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         # bind the socket to the host address and port
         s.bind((IP, PORT))
@@ -728,15 +1192,227 @@ def main():
             logger.debug("[CONNECTED]: {addr}")
             total_connections_so_far += 1  # Increment the totoal connections
             # Generate default stats for new user
-            user_id, user_stats = create_user(conn, addr)
+            user_id, user_stats, reader = create_user(conn, addr)
             if not user_id:
                 continue
+            queue = send_queue[user_id]
+            codec, protocol = user_codecs[user_id], protocols[user_id]
             # Start a thread for the new client
             start_new_thread(
-                threaded_client, (conn, addr, user_id, user_stats))
+                threaded_client, (conn, addr, user_id, user_stats, reader))
             # Start a thread to send messages to the new client
-            start_new_thread(execute_send_queue, (user_id,))
+            start_new_thread(
+                execute_send_queue, (conn, queue, codec, protocol))
+
+
+# Outbound queue of a user connected through the asyncio server
+class AsyncSendQueue:
+    def __init__(self):
+        self.queue = asyncio.Queue()
+
+    def append(self, items):
+        # Same interface as SendQueue, waking up the writer coroutine
+        self.queue.put_nowait(items)
+
+    def close(self):
+        self.queue.put_nowait(None)
+
+    async def get_batch(self):
+        # Wait for something to be queued, then take everything at once
+        batch = [await self.queue.get()]
+        while not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        if None in batch:
+            return []
+        return batch
+
+    @property
+    def depth(self):
+        return self.queue.qsize()
+
+
+# Asyncio counterpart of FrameReader.read_data, reading from a stream
+async def async_recieve_data(reader, protocol=1):
+    if protocol >= 2:
+        try:
+            lenData = HEADER_V2.unpack(
+                await reader.readexactly(HEADER_V2.size))[0]
+            if lenData > MAX_FRAME_SIZE:
+                logger.error(f"Frame of {lenData} bytes is too large")
+                return ""
+            return await reader.readexactly(lenData)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return ""  # The user has disconnected
+
+    try:
+        # Receive the length of the incoming data (2 bytes)
+        lenData = struct.unpack("h", await reader.readexactly(2))[0]
+        data = await reader.readexactly(lenData)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return ""  # The user has disconnected
+
+    if b"n_batches" not in data:
+        return data  # Can't be the start of a huge message
+
+    try:
+        pickled = pickle.loads(data)
+    except Exception:
+        return data  # Raw data that was small enough to fit in one frame
+
+    if isinstance(pickled, dict) and pickled.get("message_type") == "huge":
+        # Handle large data sent in batches
+        n_batches = pickled["n_batches"]
+        if not isinstance(n_batches, int) or not 0 < 2 * n_batches <= MAX_FRAME_SIZE:
+            logger.error(f"Huge message of {n_batches} batches is too large")
+            return ""
+        try:
+            batch_sizes = struct.unpack(
+                "h" * n_batches, await reader.readexactly(2 * n_batches))
+            # Limited like any other frame, before anything is buffered
+            size = sum(batch_sizes)
+            if not 0 <= size <= MAX_FRAME_SIZE:
+                logger.error(f"Huge message of {size} bytes is too large")
+                return ""
+            return await reader.readexactly(size)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return ""
+
+    return data
+
+
+# Write everything queued up for a user to their stream
+async def async_send_queue(writer, queue, codec, protocol=1):
+    try:
+        while True:
+            batch = await queue.get_batch()
+            if not batch:  # The queue was closed, the user disconnected
+                break
+            for data in batch_frames(batch, codec, protocol):
+                writer.write(data)
+                metrics.count("bytes_out", len(data))
+            await writer.drain()
+
+    # Stop if the user disconnected while we were sending
+    except ConnectionError:
+        pass
+
+
+# Asyncio counterpart of create_user
+async def async_create_user(reader, writer, addr):
+    user_id = str(total_connections_so_far)
+    user_stats = register_user(user_id, writer, AsyncSendQueue())
+
+    # Send user their ID
+    writer.write(frame_data(pickle.dumps(user_id)))
+
+    # Receive additional user data
+    data = await async_recieve_data(reader)
+    if not data:  # If no data is received, disconnect the user
+        disconnect_user(user_id, addr)
+        writer.close()
+        return None, None
+
+    # Acknowledge a newer protocol, everything after this frame uses it
+    ack = apply_user_metadata(user_id, data)
+    if ack:
+        writer.write(frame_data(pickle.dumps(ack)))
+
+    return user_id, user_stats
+
+
+# Handle communication with a single client on the event loop
+async def async_client(reader, writer):
+    global total_connections_so_far
+    addr = writer.get_extra_info("peername")
+    logger.debug(f"[CONNECTED]: {addr}")
+    total_connections_so_far += 1  # Increment the total connections
+
+    user_id, user_stats = await async_create_user(reader, writer, addr)
+    if not user_id:
+        return
+
+    # Start a task to send messages to the new client
+    codec, protocol = user_codecs[user_id], protocols[user_id]
+    sender = asyncio.create_task(
+        async_send_queue(writer, send_queue[user_id], codec, protocol))
+
+    # Bring the new user up to date and tell everyone about them
+    announce_user(user_id, user_stats)
+
+    data = None
+    while True:
+        try:
+            data = await async_recieve_data(reader, protocol)
+
+            # If no data is received, the client has disconnected
+            if not data:
+                break
+
+            # Compressing a picture takes a while, everyone else is served meanwhile
+            picture = None
+            if user_id in pending_images:
+                picture = await asyncio.get_running_loop().run_in_executor(
+                    None, encode_picture, user_id, data, pending_images[user_id])
+
+            process_frame(user_id, data, picture)
+
+        except Exception as e:
+            logger.warning(
+                f"Error while processing data from {user_id}:\n{e}")
+            break
+
+    # Clean up when the user disconnects
+    disconnect_user(user_id, addr)
+    sender.cancel()
+    writer.close()
+
+
+# Serve every client from a single event loop instead of two threads each
+async def async_main():
+    server = await asyncio.start_server(
+        async_client, IP, PORT, backlog=ASYNC_BACKLOG)
+    logger.info(f"Server started at: {server.sockets[0].getsockname()}")
+    logger.info("Server has started (asyncio). waiting for connections...")
+
+    # Summaries are queued from the event loop too, asyncio queues aren't thread safe
+    async def summarise():
+        while True:
+            await asyncio.sleep(SUMMARY_INTERVAL)
+            send_summary()
+    summaries = asyncio.create_task(summarise())  # Kept, or it may be collected
+
+    async with server:
+        await server.serve_forever()
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description="Sluggy Game Centre server")
+    parser.add_argument(
+        "--mode",
+        choices=["threaded", "asyncio"],
+        default="threaded",
+        help="threaded: two threads per client, asyncio: one event loop for all clients",
+    )
+    parser.add_argument("--port", type=int, default=PORT,
+                        help="port to listen on")
+    parser.add_argument("--metrics-port", type=int,
+                        help="serve metrics over http on this port of localhost")
+    parser.add_argument("--metrics-file",
+                        help="write a metrics snapshot to this file every --metrics-interval seconds")
+    parser.add_argument("--metrics-interval", type=float, default=10)
+    parser.add_argument("--image-bits", type=int, default=IMAGE_BITS, choices=range(1, 9),
+                        help="bits of each colour kept in compressed profile pictures, 8 loses nothing")
+    args = parser.parse_args()
+    PORT = args.port
+    IMAGE_BITS = args.image_bits
+
+    register_gauges()
+    if args.metrics_port is not None:
+        metrics.serve(args.metrics_port)
+    if args.metrics_file:
+        metrics.write_periodically(args.metrics_file, args.metrics_interval)
+
+    if args.mode == "asyncio":
+        asyncio.run(async_main())
+    else:
+        main()
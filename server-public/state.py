@@ -0,0 +1,38 @@
+import threading
+from contextlib import contextmanager
+
+DEFAULT_STRIPES = 256  # Locks shared out between all users
+
+
+class StripedLocks:
+    """
+    A fixed number of locks that users hash onto, so that changes touching
+    a few users only wait for other changes to those same users (or ones
+    sharing their locks) instead of for everything.
+
+    Locks are always taken in index order, so two threads holding some of
+    each other's locks can never wait on each other forever.
+    """
+
+    def __init__(self, stripes=DEFAULT_STRIPES):
+        self.locks = [threading.Lock() for _ in range(stripes)]
+
+    def stripes(self, keys):
+        return sorted({hash(key) % len(self.locks) for key in keys})
+
+    @contextmanager
+    def hold(self, *keys):
+        """Hold the locks of every key given until the block is done."""
+        held = []
+        try:
+            for stripe in self.stripes(keys):
+                self.locks[stripe].acquire()
+                held.append(stripe)
+            yield
+        finally:
+            for stripe in reversed(held):
+                self.locks[stripe].release()
+
+    def holds(self, keys, others):
+        """Whether holding the locks of keys covers every key in others too."""
+        return set(self.stripes(others)) <= set(self.stripes(keys))
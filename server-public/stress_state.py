@@ -0,0 +1,220 @@
+import sys
+import time
+import random
+import logging
+import argparse
+import threading
+import server
+from logger import logger
+from bench_dispatch import NullQueue
+
+
+class ErrorCounter(logging.Handler):
+    """Counts the errors the server logs, which it does when cleanup goes wrong."""
+
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.errors = []
+
+    def emit(self, record):
+        self.errors.append(record.getMessage())
+
+
+class Worker(threading.Thread):
+    """
+    Plays a few users at random, the way their reader threads would: each
+    user's messages are only ever handled by the thread that owns them.
+    """
+
+    def __init__(self, number, users, stop, ids, bots):
+        super().__init__(daemon=True)
+        self.rng = random.Random(number)
+        self.stop = stop
+        self.ids = ids  # Shared source of new user ids
+        self.bots = bots
+        self.users = [self.connect() for _ in range(users)]
+        self.actions = 0
+        self.exceptions = []
+
+    def connect(self):
+        user_id = str(next(self.ids))
+        user = server.register_user(user_id, None, NullQueue())
+        user["bot"] = self.rng.random() < self.bots
+        server.announce_user(user_id, user)
+        return user_id
+
+    def run(self):
+        while not self.stop.is_set():
+            i = self.rng.randrange(len(self.users))
+            try:
+                self.act(i)
+            except Exception as e:
+                self.exceptions.append(repr(e))
+            self.actions += 1
+
+    def act(self, i):
+        user_id = self.users[i]
+        user = server.active_users[user_id]
+        rng = self.rng
+        roll = rng.random()
+
+        if roll < 0.02:
+            # Leave and come back as someone new
+            server.disconnect_user(user_id, "stress")
+            self.users[i] = self.connect()
+        elif roll < 0.3:
+            others = list(server.active_users)
+            game = rng.choice(list(server.games_lookup))
+            server.handle_data(user_id, {"challenge": (rng.choice(others), game)})
+        elif roll < 0.5:
+            # Copied in one go, other threads change these as they go
+            pending = list(user["pending"].items())
+            if pending:
+                player1_id, game = rng.choice(pending)
+                kind = "accepted" if rng.random() < 0.8 else "rejected"
+                server.handle_data(user_id, {kind: {
+                    "player1_id": player1_id, "player2_id": user_id, "game": game}})
+        elif roll < 0.55:
+            challenged = list(user["challenged"].items())
+            if challenged:
+                opp_id, game = challenged[0]
+                server.handle_data(user_id, {"cancel_challenge": {"opp_id": opp_id, "game": game}})
+        else:
+            game_ids = server.games_of(user_id)
+            game = server.games.get(game_ids[0]) if game_ids else None
+            if game is None:
+                return
+            if roll < 0.95:
+                server.handle_data(user_id, {"move": {
+                    "game_id": game_ids[0], "move": random_move(rng, game["details"]["board"])}})
+            else:
+                server.handle_data(user_id, {"quit": game_ids[0]})
+
+
+# A random move on the board, which may no longer be free by the time it's sent
+def random_move(rng, board):
+    if hasattr(board, "heights"):
+        return rng.randrange(board.cols)
+    return (rng.randrange(board.rows), rng.randrange(board.cols))
+
+
+# Everything that must hold between messages, returns the broken ones
+def check_invariants():
+    problems = []
+    users = server.active_users
+
+    for name, table in (("connections", server.connections), ("send_queue", server.send_queue),
+                        ("user_codecs", server.user_codecs)):
+        if set(table) != set(users):
+            problems.append(f"{name} and active_users have different users")
+
+    for user_id, user in users.items():
+        for other_id, game in user["challenged"].items():
+            if other_id not in users:
+                problems.append(f"{user_id} challenged {other_id} who has left")
+            elif users[other_id]["pending"].get(user_id) != game:
+                problems.append(f"{user_id} challenged {other_id} who doesn't know")
+        for other_id, game in user["pending"].items():
+            if other_id not in users:
+                problems.append(f"{user_id} was challenged by {other_id} who has left")
+            elif users[other_id]["challenged"].get(user_id) != game:
+                problems.append(f"{user_id} was challenged by {other_id} who took it back")
+
+    playing = {}
+    for game_id, game in server.games.items():
+        for player_id, player in game["players"].items():
+            if users.get(player_id) is not player:
+                problems.append(f"{player_id} left but game {game_id} goes on")
+            playing[player_id] = playing.get(player_id, 0) + 1
+            if game_id not in server.user_games.get(player_id, ()):
+                problems.append(f"{player_id} plays {game_id} but it isn't in user_games")
+
+    for user_id, game_ids in server.user_games.items():
+        if len(game_ids) != playing.get(user_id):
+            problems.append(f"user_games has {len(game_ids)} games of {user_id} but they play {playing.get(user_id, 0)}")
+
+    for user_id, user in users.items():
+        if user["bot"]:
+            continue  # Bots play any number of games at once
+        games = playing.get(user_id, 0)
+        if games > 1:
+            problems.append(f"{user_id} is in {games} games")
+        if user["engaged"] != (games == 1):
+            problems.append(f"{user_id} engaged is {user['engaged']} while in {games} games")
+
+    return problems
+
+
+# Stop everything by taking every lock, then check
+def checked():
+    locks = server.user_locks.locks
+    for lock in locks:
+        lock.acquire()
+    try:
+        return check_invariants()
+    finally:
+        for lock in reversed(locks):
+            lock.release()
+
+
+def main(n_workers, users_per_worker, seconds, bots, seed):
+    random.seed(seed)
+    sys.setswitchinterval(1e-5)  # Switch threads often to shake out races
+    logger.setLevel(logging.ERROR)
+    errors = ErrorCounter()
+    logger.addHandler(errors)
+
+    stop = threading.Event()
+    ids = iter(range(10 ** 9))
+    workers = [Worker(i + seed * n_workers, users_per_worker, stop, ids, bots)
+               for i in range(n_workers)]
+    for worker in workers:
+        worker.start()
+
+    checks, problems = 0, []
+    end = time.time() + seconds
+    while time.time() < end and not problems:
+        time.sleep(0.05)
+        problems = checked()
+        checks += 1
+
+    stop.set()
+    for worker in workers:
+        worker.join()
+    if not problems:
+        problems = check_invariants()
+        checks += 1
+
+    actions = sum(worker.actions for worker in workers)
+    exceptions = [e for worker in workers for e in worker.exceptions]
+    started = sum(value for (name, _), value in server.metrics.collect().counters.items()
+                  if name == "games_started")
+    print(f"{actions} actions by {n_workers} threads in {seconds}s, {started} games started, "
+          f"{checks} invariant checks")
+    print(f"{len(server.active_users)} users and {len(server.games)} games at the end")
+
+    failed = False
+    for title, found in (("broken invariants", problems), ("handler exceptions", exceptions),
+                         ("errors logged", errors.errors)):
+        if found:
+            failed = True
+            print(f"{len(found)} {title}, the first ones:")
+            for problem in found[:5]:
+                print(f"  {problem}")
+
+    print("FAILED" if failed else "OK")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Hammer the server's state with concurrent challenges, games and disconnects")
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--users", type=int, default=8, help="users played by each thread")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--bots", type=float, default=0.05,
+                        help="chance of each user being a bot, which plays many games at once")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    main(args.threads, args.users, args.seconds, args.bots, args.seed)
@@ -0,0 +1,31 @@
+from games_logic import TTTLogic, ConnectLogic
+
+
+def new_game(logic):
+    return logic({"id": "1"}, {"id": "2"})
+
+
+def test_ttt_win_through_last_move():
+    game = new_game(TTTLogic)
+    x = game.turn_id
+    for to in [(0, 0), (1, 0), (0, 1), (1, 1)]:
+        game_over, _ = game.move(to)
+        assert not game_over
+    game_over, _ = game.move((0, 2))
+    assert game_over["winner_id"] == x
+    assert sorted(game_over["indices"]) == [(0, 0), (0, 1), (0, 2)]
+
+
+def test_ttt_rejects_moves_off_the_board():
+    game = new_game(TTTLogic)
+    for to in [(-1, 0), (0, -1), (3, 0), (0, 3)]:
+        valid, error = game.validate(game.turn_id, to)
+        assert not valid and error == "Invalid move!"
+    assert all(cell is None for row in game.board for cell in row)
+
+
+def test_connect4_rejects_columns_off_the_board():
+    game = new_game(ConnectLogic)
+    for col in [-1, game.cols]:
+        valid, _ = game.validate(game.turn_id, col)
+        assert not valid